@@ -10,6 +10,9 @@ setup(
         namespace_packages=['son', ],
         install_requires=['setuptools', 'twisted', 'psutil',
                           'pymysql', 'netifaces'],
+        extras_require={
+            'msgpack': ['msgpack'],
+        },
         zip_safe=False,
         entry_points={
             'console_scripts': [
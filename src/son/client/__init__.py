@@ -1,4 +1,7 @@
 from son.client.protocol import ClientFactory
+from son.vmmanager.jsonserver import FRAMINGS, LegacyFraming
+from son.vmmanager.jsonserver import CODECS, JsonCodec
+from son.vmmanager.jsonserver import COMPRESSIONS
 from twisted.internet import reactor
 
 import argparse
@@ -10,7 +13,9 @@ class Client(object):
     def __init__(self, hss_mgmt, mme_mgmt, spgw_mgmt,
                  hss_data, mme_data, spgw_data,
                  hss_host, mme_host, spgw_host,
-                 mme_s1_ip, spgw_s1_ip, spgw_sgi_ip):
+                 mme_s1_ip, spgw_s1_ip, spgw_sgi_ip,
+                 framing = LegacyFraming.NAME, codec = JsonCodec.NAME,
+                 negotiate = False, compression = None):
         self.hss_mgmt = hss_mgmt
         self.mme_mgmt = mme_mgmt
         self.spgw_mgmt = spgw_mgmt
@@ -23,6 +28,10 @@ class Client(object):
         self.mme_s1_ip = mme_s1_ip
         self.spgw_s1_ip = spgw_s1_ip
         self.spgw_sgi_ip = spgw_sgi_ip
+        self.framing = framing
+        self.codec = codec
+        self.negotiate = negotiate
+        self.compression = compression
         self._init_configs()
 
     def _init_connection(self, isStopping = False):
@@ -30,7 +39,9 @@ class Client(object):
             (self.hss_mgmt, self.hss_config),
             (self.mme_mgmt, self.mme_config),
             (self.spgw_mgmt, self.spgw_config)
-        ], isStopping = isStopping)
+        ], isStopping = isStopping, framing = self.framing,
+           codec = self.codec, negotiate = self.negotiate,
+           compression = self.compression)
 
     def _init_configs(self):
         self.hosts = {
@@ -115,6 +126,18 @@ def parseGeneralArgs(argv):
                         default=False, help='Verbose')
     parser.add_argument('--stop','-s', action='store_true', dest='stop',
                         default=False, help='Verbose')
+    parser.add_argument('--framing', dest='framing',
+                        default=LegacyFraming.NAME, choices=sorted(FRAMINGS),
+                        help='Wire framing used by the servers')
+    parser.add_argument('--codec', dest='codec',
+                        default=JsonCodec.NAME, choices=sorted(CODECS),
+                        help='Message codec used by the servers')
+    parser.add_argument('--negotiate', action='store_true', dest='negotiate',
+                        default=False,
+                        help='Connect with JSON and negotiate the codec')
+    parser.add_argument('--compression', dest='compression',
+                        default=None, choices=sorted(COMPRESSIONS),
+                        help='Negotiate compression of large replies')
     return parser.parse_known_args(argv)
 
 
@@ -141,7 +164,11 @@ def main(argv = sys.argv[1:]):
                spgw_host = configArgs.spgw_host,
                mme_s1_ip = networkArgs.mme_s1_ip,
                spgw_s1_ip = networkArgs.spgw_s1_ip,
-               spgw_sgi_ip = networkArgs.spgw_sgi_ip)
+               spgw_sgi_ip = networkArgs.spgw_sgi_ip,
+               framing = generalArgs.framing,
+               codec = generalArgs.codec,
+               negotiate = generalArgs.negotiate,
+               compression = generalArgs.compression)
 
     if generalArgs.stop:
         c.stop()
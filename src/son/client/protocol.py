@@ -1,68 +1,155 @@
+from son.vmmanager.jsonserver import IJsonProcessor as P, JsonMsgReader
+from son.vmmanager.jsonserver import FRAMINGS, LegacyFraming
+from son.vmmanager.jsonserver import CODECS, JsonCodec
+from son.vmmanager.jsonserver import COMPRESSIONS
 from twisted.internet.protocol import Protocol, ClientFactory as CF
 from twisted.internet import defer, reactor
 
+import collections
 import logging
-import json
 
 class ClientProtocol(Protocol):
 
-    def __init__(self, config):
+    MSG_ID = JsonMsgReader.MSG_ID
+    MSG_NEGOTIATE = JsonMsgReader.MSG_NEGOTIATE
+
+    def __init__(self, config, framing = LegacyFraming.NAME,
+                 codec = JsonCodec.NAME, negotiate = False,
+                 compression = None, compression_threshold = None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.config = config
-        self._connection_defer = defer.Deferred()
-
-    def onCallback(func):
-        def _tmp(self, *args, **kwargs):
-            returnDefer = defer.Deferred()
+        self._framing = FRAMINGS[framing]()
+        # With negotiation the connection starts with JSON and switches to
+        # the requested codec once the server accepted it. Compression is
+        # always negotiated, but keeps the codec if not asked otherwise.
+        self._negotiate = negotiate or compression is not None
+        self._settings = { JsonMsgReader.NEGOTIATE_CODEC: codec }
+        if compression is not None:
+            self._settings[JsonMsgReader.NEGOTIATE_COMPRESSION] = compression
+        if compression_threshold is not None:
+            self._settings[JsonMsgReader.NEGOTIATE_COMPRESSION_THRESHOLD] = \
+                    compression_threshold
+        self._codec = CODECS[JsonCodec.NAME if negotiate else codec]()
+        self._compression = None
+        self._ready = False
+        self._queued = []
+        self._pending = collections.OrderedDict()
+        self._next_id = 1
+
+    def _send(self, message, description):
+        d = self._request(message)
+        if self._ready:
+            self._write(message, description)
+        else:
+            self._queued.append((message, description))
 
-            def callAndSet():
-                self._current_defer = defer.Deferred()
-                returnValue = func(self, *args, **kwargs)
-                self._current_defer.addCallback(
-                    lambda r: returnDefer.callback(returnValue)
-                )
-                return self._current_defer
+        return d.addCallback(lambda r: self)
 
-            ad = lambda d: callAndSet() if d is None else d.addCallback(ad)
-            self._connection_defer.addCallback(ad)
+    def _request(self, message):
+        request_id = self._next_id
+        self._next_id += 1
+        message[self.MSG_ID] = request_id
 
-            return returnDefer
+        d = defer.Deferred()
+        self._pending[request_id] = d
+        return d
 
-        return _tmp
+    def _write(self, message, description):
+        self._logPeer(description)
+        self.transport.write(self._framing.encode(self._codec.encode(message)))
 
     def dataReceived(self, data):
-        self._logPeer('Received data from')
-        self.logger.info('Data: %s', data)
-        self._current_defer.callback(None)
+        self._framing.feed(data)
+        for frame in self._framing.frames():
+            self._logPeer('Received data from')
+            self.logger.info('Data: %s', frame)
+
+            try:
+                if self._compression is not None:
+                    frame = self._compression.decompress(frame)
+                reply = self._codec.decode(frame)
+            except ValueError:
+                self.logger.error('Unable to parse reply: %s', frame)
+                continue
+
+            request_id = reply.pop(self.MSG_ID, None) \
+                    if isinstance(reply, dict) else None
+            if request_id in self._pending:
+                d = self._pending.pop(request_id)
+            elif request_id is not None:
+                # e.g. a message pushed by a subscription
+                self.logger.info('Got message for request %s', request_id)
+                continue
+            elif len(self._pending) > 0:
+                # Replies without ID are matched in request order
+                _, d = self._pending.popitem(last = False)
+            else:
+                self.logger.warning('Got reply without pending request')
+                continue
+
+            d.callback(reply)
 
     def connectionMade(self):
         self._logPeer('Connection ready to')
-        self._connection_defer.callback(None)
+        if self._negotiate:
+            message = { self.MSG_NEGOTIATE: self._settings }
+            d = self._request(message)
+            # Sent before the queued requests, a reply without ID to it
+            # comes first
+            self._pending.move_to_end(message[self.MSG_ID], last = False)
+            d.addCallback(self._negotiated)
+            self._write(message, 'Negotiating %s with' % self._settings)
+        else:
+            self._flush()
+
+    def _negotiated(self, reply):
+        # A server that does not know negotiation answers without the
+        # negotiate result, the current codec is kept then
+        try:
+            result = P.Result.from_dict(reply[self.MSG_NEGOTIATE])
+        except Exception as e:
+            self.logger.error('Negotiation failed: invalid reply %s (%s)',
+                              reply, e)
+            result = None
+
+        try:
+            if result is not None and result.status == P.Result.OK:
+                codec = self._settings[JsonMsgReader.NEGOTIATE_CODEC]
+                self._codec = CODECS[codec]()
+                compression = self._settings.get(
+                        JsonMsgReader.NEGOTIATE_COMPRESSION)
+                if compression is not None:
+                    self._compression = COMPRESSIONS[compression]()
+            elif result is not None:
+                self.logger.error('Negotiation failed: %s', result.message)
+        finally:
+            self._flush()
+
+    def _flush(self):
+        self._ready = True
+        queued, self._queued = self._queued, []
+        for message, description in queued:
+            self._write(message, description)
 
     def connectionLost(self, reason):
         self._logPeer('Connection lost to')
         self.logger.info('Reason: %s', reason)
+        self._ready = False
+        pending, self._pending = self._pending, collections.OrderedDict()
+        for d in pending.values():
+            d.errback(reason)
 
-    @onCallback
-    def sendStart(self):
-        self._logPeer('Sending start command to')
-        jsonString = json.dumps({ 'command': 'start' })
-        self.transport.write(jsonString.encode())
-        return self
+    def sendStart(self, wait_ready = False):
+        message = { 'command': 'start' }
+        if wait_ready:
+            message['wait_ready'] = True
+        return self._send(message, 'Sending start command to')
 
-    @onCallback
     def sendConfig(self):
-        self._logPeer('Sending configuration to')
-        jsonString = json.dumps(self.config)
-        self.transport.write(jsonString.encode())
-        return self
+        return self._send(dict(self.config), 'Sending configuration to')
 
-    @onCallback
     def sendStop(self):
-        self._logPeer('Sending stop command to')
-        jsonString = json.dumps({ 'command': 'stop' })
-        self.transport.write(jsonString.encode())
-        return self
+        return self._send({ 'command': 'stop' }, 'Sending stop command to')
 
     def _logPeer(self, message):
         dst = self.transport.getPeer()
@@ -71,12 +158,17 @@ class ClientProtocol(Protocol):
 
 class ClientFactory(CF):
 
-    def __init__(self, configs, isStopping = False, port = 38388):
+    def __init__(self, configs, isStopping = False, port = 38388,
+                 framing = LegacyFraming.NAME, codec = JsonCodec.NAME,
+                 negotiate = False, compression = None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.protocols = {}
         for host,config in configs:
             self.logger.info('Creating connection to %s:%s', host, port)
-            self.protocols[host] = ClientProtocol(config)
+            self.protocols[host] = ClientProtocol(config, framing = framing,
+                                                  codec = codec,
+                                                  negotiate = negotiate,
+                                                  compression = compression)
             reactor.connectTCP(host, port, self)
 
         if isStopping:
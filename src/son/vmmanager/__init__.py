@@ -14,7 +14,8 @@ def main(argv = sys.argv[1:]):
     parser.add_argument('--config','-c', action='append', dest='config_files', default=[])
     parser.add_argument('--verbose','-v', action='store_true', dest='verbose', default=False)
     args = parser.parse_args(argv)
-    address, port, processors = server_configuration.parse_configuration_files(args.config_files)
+    address, port, processors, options = \
+        server_configuration.parse_configuration_files(args.config_files)
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
@@ -22,7 +23,14 @@ def main(argv = sys.argv[1:]):
         logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
 
-    factory = JsonMsgReaderFactory()
+    factory = JsonMsgReaderFactory(
+        framing = options[server_configuration.NETWORK_FRAMING],
+        max_frame_size = options[server_configuration.NETWORK_MAX_FRAME_SIZE],
+        max_buffer_size = options[server_configuration.NETWORK_MAX_BUFFER_SIZE],
+        thread_pool_size = options[server_configuration.NETWORK_THREAD_POOL_SIZE],
+        nested_results = options[server_configuration.NETWORK_NESTED_RESULTS],
+        codec = options[server_configuration.NETWORK_CODEC])
+    processor_options = options[server_configuration.PROCESSOR_OPTIONS]
     for p in processors:
         full_name = processors[p]
         module_name = '.'.join(full_name.split('.')[:-1])
@@ -32,15 +40,19 @@ def main(argv = sys.argv[1:]):
         try:
             processorModule = importlib.import_module(module_name)
             processorClass = getattr(processorModule, class_name)
-            factory.addProcessor(p, processorClass())
+            kwargs = processor_options.get(p, {})
+            factory.addProcessor(p, processorClass(**kwargs))
         except ModuleNotFoundError:
             logger.warn('No module named %s has been found', module_name)
         except AttributeError:
             logger.warn('No class named %s has been found in module %s',
                         class_name, module_name)
+        except (TypeError, ValueError) as e:
+            logger.warn('Invalid options for processor %s: %s', p, e)
 
     serverAddress = "tcp:{}:interface={}".format(port, address)
-    logger.info("Starting server on %s" % serverAddress)
+    logger.info("Starting server on %s (framing: %s, codec: %s)",
+                serverAddress, factory.framing, factory.codec)
     endpoint = serverFromString(reactor, serverAddress)
     endpoint.listen(factory)
 
@@ -1,8 +1,19 @@
 from twisted.internet.protocol import Protocol
 from twisted.internet.protocol import Factory
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 
+import threading
 import logging
+import struct
+import zlib
 import json
+import re
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 class IJsonProcessor(object):
 
@@ -39,16 +50,30 @@ class IJsonProcessor(object):
             self.message = message
             self.args = args
 
-        def json(self):
+        def as_dict(self):
             result = { self.STATUS: self.status, self.MESSAGE: self.message }
             if self.args is not None:
                 result.update(self.args)
 
-            return json.dumps(result)
+            return result
+
+        def json(self):
+            return json.dumps(self.as_dict())
+
+        def encode(self, codec = 'json'):
+            return CODECS[codec]().encode(self.as_dict())
 
         @classmethod
         def parse(cls, jsonString):
-            jsonDict = json.loads(jsonString)
+            return cls.from_dict(json.loads(jsonString))
+
+        @classmethod
+        def decode(cls, data, codec = 'json'):
+            return cls.from_dict(CODECS[codec]().decode(data))
+
+        @classmethod
+        def from_dict(cls, jsonDict):
+            jsonDict = dict(jsonDict)
 
             if cls.STATUS not in jsonDict:
                 raise Exception('Invalid JSON: No %s field', cls.STATUS)
@@ -84,14 +109,480 @@ class IJsonProcessor(object):
             return cls(cls.WARNING, message % args, kwords)
 
 
+    class Subscription(object):
+        """Returned by process() instead of a Result to keep pushing
+        messages to the client after the reply.
+
+        The reply contains result. Once it is sent, start() is called with
+        a push function, which may be called from any thread with a dict
+        to send. stop() is called when the client cancels the
+        subscription or disconnects.
+        """
+
+        def __init__(self, result):
+            self.result = result
+
+        def start(self, push):
+            pass
+
+        def stop(self):
+            pass
+
+
+    class Pending(object):
+        """Returned by process() instead of a Result which is only known
+        later, e.g. once a started task is ready.
+
+        deferred fires with the Result on the reactor thread. Unlike a
+        Deferred returned by process(), it is waited for after the
+        processor is released, so the next message is processed in the
+        meantime and a blocking processor does not keep its thread.
+        Callbacks are added to deferred on the reactor thread, so they
+        may be added on any thread.
+        """
+
+        def __init__(self, deferred):
+            self._deferred = deferred
+            self._callbacks = []
+
+        def addCallback(self, callback, *args, **kwargs):
+            self._callbacks.append((callback, args, kwargs))
+            return self
+
+        def deferred(self):
+            """The Deferred with the callbacks added, on the reactor
+            thread."""
+            for callback, args, kwargs in self._callbacks:
+                self._deferred.addCallback(callback, *args, **kwargs)
+            self._callbacks = []
+            return self._deferred
+
+
+    # Processors doing blocking I/O (files, databases, subprocesses) set
+    # this to True to be executed on the server's thread pool instead of
+    # the reactor thread. process() may also return a Deferred firing
+    # with the Result.
+    BLOCKING = False
+
     def process(self, json):
         pass
 
+    def isQuery(self, json):
+        """Whether json only reads the state of the processor. Queries
+        are not queued behind the other messages to the processor, they
+        may run while one of them is processed."""
+        return False
+
+
+class JsonFrameScanner(object):
+    """Incremental scanner finding the top level JSON objects in a buffer.
+
+    The scanner works on the raw UTF-8 bytes and keeps its state between
+    calls, so every byte of the buffer is inspected only once, no matter
+    how many chunks a message is received in. Braces inside JSON strings
+    (including escaped quotes) are not counted.
+    """
+
+    RE_FRAME_TOKEN = re.compile(rb'[{}"]')
+    RE_STRING_TOKEN = re.compile(rb'["\\]')
 
-class JsonMsgReaderFactory(Factory):
     def __init__(self):
+        self._pos = 0
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def scan(self, data):
+        segments = []
+        pos, end = self._pos, len(data)
+        while pos < end:
+            if self._escape:
+                self._escape = False
+                pos += 1
+                continue
+
+            if self._depth == 0:
+                pos = data.find(b'{', pos)
+                if pos == -1:
+                    pos = end
+                    break
+                self._start = pos
+                self._depth = 1
+                pos += 1
+                continue
+
+            if self._in_string:
+                m = self.RE_STRING_TOKEN.search(data, pos)
+            else:
+                m = self.RE_FRAME_TOKEN.search(data, pos)
+
+            if m is None:
+                pos = end
+                break
+
+            pos = m.end()
+            token = m.group()
+            if token == b'"':
+                self._in_string = not self._in_string
+            elif token == b'\\':
+                self._escape = True
+            elif token == b'{':
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    segments.append({ 'start': self._start, 'end': pos - 1 })
+                    self._start = -1
+
+        self._pos = pos
+        return segments
+
+    def consumable(self):
+        """Number of leading bytes which are not needed any more."""
+        return self._start if self._start != -1 else self._pos
+
+    def consume(self, count):
+        """Shift the scanner state after dropping count leading bytes."""
+        self._pos -= count
+        if self._start != -1:
+            self._start -= count
+
+
+class JsonFraming(object):
+    """Splits the received byte stream into frames and encodes replies.
+
+    feed() appends received data, frames() returns the complete frames
+    (as bytes) which are available so far and encode() wraps an outgoing
+    encoded message into a frame. If a frame exceeds max_frame_size, no
+    more frames are returned and its size is stored in overflow. Decoding
+    the frames is left to a codec.
+
+    Received data is kept in a single bytearray. Frames are consumed by
+    moving a read offset and the buffer is only compacted once the consumed
+    part dominates it, so data is only copied once a whole frame is
+    available.
+    """
+
+    NAME = None
+    # Whether any byte may appear in a frame, which binary codecs require
+    BINARY = False
+
+    def __init__(self, max_frame_size = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_frame_size = max_frame_size
+        self.overflow = None
+        self._data = bytearray()
+        self._offset = 0
+
+    def feed(self, data):
+        self._data += data
+
+    def frames(self):
+        raise NotImplementedError()
+
+    def encode(self, message):
+        raise NotImplementedError()
+
+    def pending(self):
+        """Number of received bytes which are not consumed yet."""
+        return len(self._data) - self._offset
+
+    def _fits(self, size):
+        if self.max_frame_size is not None and size > self.max_frame_size:
+            self.logger.error('Frame of %d bytes exceeds the limit of %d bytes',
+                              size, self.max_frame_size)
+            self.overflow = size
+            return False
+
+        return True
+
+    def _frame(self, start, end):
+        with memoryview(self._data) as view, view[start:end] as frame:
+            return bytes(frame)
+
+    def _consume(self, end):
+        self._offset = end
+        if self._offset > 0 and self._offset * 2 >= len(self._data):
+            del self._data[:self._offset]
+            self._compacted(self._offset)
+            self._offset = 0
+
+    def _compacted(self, count):
+        """Called after count leading bytes were removed from the buffer."""
+        pass
+
+
+class LegacyFraming(JsonFraming):
+    """Frames are top level JSON objects found by brace counting."""
+
+    NAME = 'legacy'
+
+    def __init__(self, **kwargs):
+        self._scanner = JsonFrameScanner()
+        super(LegacyFraming, self).__init__(**kwargs)
+
+    def frames(self):
+        frames = []
+        if self.overflow is not None:
+            return frames
+
+        for s in self._scanner.scan(self._data):
+            if not self._fits(s['end'] + 1 - s['start']):
+                return frames
+
+            frames.append(self._frame(s['start'], s['end'] + 1))
+
+        self._consume(self._scanner.consumable())
+        self._fits(self.pending())
+
+        return frames
+
+    def encode(self, message):
+        return message
+
+    def _compacted(self, count):
+        self._scanner.consume(count)
+
+
+class LineFraming(JsonFraming):
+    """Newline delimited JSON (NDJSON), one message per line."""
+
+    NAME = 'ndjson'
+    DELIMITER = b'\n'
+
+    def __init__(self, **kwargs):
+        self._searched = 0
+        super(LineFraming, self).__init__(**kwargs)
+
+    def frames(self):
+        frames = []
+        if self.overflow is not None:
+            return frames
+
+        start = self._offset
+        while True:
+            end = self._data.find(self.DELIMITER, max(start, self._searched))
+            if end == -1:
+                break
+
+            if not self._fits(end - start):
+                return frames
+
+            frame = self._frame(start, end)
+            start = end + len(self.DELIMITER)
+            if len(frame.strip()) > 0:
+                frames.append(frame)
+
+        self._searched = len(self._data)
+        self._consume(start)
+        self._fits(self.pending())
+
+        return frames
+
+    def encode(self, message):
+        return message + self.DELIMITER
+
+    def _compacted(self, count):
+        self._searched -= count
+
+
+class LengthPrefixedFraming(JsonFraming):
+    """Every message is preceded by its length as a 4 byte big endian int."""
+
+    NAME = 'length'
+    BINARY = True
+    HEADER = struct.Struct('!I')
+
+    def frames(self):
+        frames = []
+        if self.overflow is not None:
+            return frames
+
+        start = self._offset
+        while len(self._data) - start >= self.HEADER.size:
+            length, = self.HEADER.unpack_from(self._data, start)
+            if not self._fits(length):
+                return frames
+
+            end = start + self.HEADER.size + length
+            if end > len(self._data):
+                break
+
+            frames.append(self._frame(start + self.HEADER.size, end))
+            start = end
+
+        self._consume(start)
+
+        return frames
+
+    def encode(self, message):
+        return self.HEADER.pack(len(message)) + message
+
+
+FRAMINGS = { f.NAME: f for f in [LegacyFraming, LineFraming,
+                                 LengthPrefixedFraming] }
+
+
+class JsonCodec(object):
+    """Encodes messages as compact UTF-8 JSON."""
+
+    NAME = 'json'
+    BINARY = False
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def encode(self, message):
+        return json.dumps(message, separators = (',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        # UnicodeDecodeError and JSONDecodeError are both ValueErrors
+        return json.loads(str(data, 'utf-8'))
+
+
+class MsgPackCodec(object):
+    """Encodes messages as MessagePack, requires the msgpack package."""
+
+    NAME = 'msgpack'
+    BINARY = True
+
+    @classmethod
+    def available(cls):
+        return msgpack is not None
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type = True)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw = False)
+        except Exception as e:
+            raise ValueError('Invalid MessagePack data: %s' % e)
+
+
+CODECS = { c.NAME: c for c in [JsonCodec, MsgPackCodec] }
+
+
+def check_codec(codec, framing):
+    """Raise an exception if the codec can not be used with the framing."""
+    if codec not in CODECS:
+        raise Exception('Unknown codec: %s' % codec)
+
+    if not CODECS[codec].available():
+        raise Exception('Codec %s is not available, '
+                        'the required package is not installed' % codec)
+
+    if CODECS[codec].BINARY and not FRAMINGS[framing].BINARY:
+        raise Exception('Codec %s requires a binary framing (%s)' %
+                        (codec, ', '.join(n for n, f in FRAMINGS.items()
+                                          if f.BINARY)))
+
+
+class ZlibCompression(object):
+    """Compresses frames bigger than a threshold with zlib.
+
+    Every frame starts with a flag byte telling whether the rest of the
+    frame is compressed, so small frames are sent as they are.
+    """
+
+    NAME = 'zlib'
+    # Window bits of the zlib container format
+    WBITS = zlib.MAX_WBITS
+    LEVEL = 6
+    THRESHOLD = 1024
+
+    FLAG_PLAIN = b'\x00'
+    FLAG_COMPRESSED = b'\x01'
+
+    def __init__(self, threshold = THRESHOLD, level = LEVEL):
+        self.threshold = threshold
+        self.level = level
+
+    def compress(self, data):
+        if len(data) < self.threshold:
+            return self.FLAG_PLAIN + data
+
+        c = zlib.compressobj(self.level, zlib.DEFLATED, self.WBITS)
+        return self.FLAG_COMPRESSED + c.compress(data) + c.flush()
+
+    def decompress(self, data):
+        flag, data = data[:1], data[1:]
+        if flag == self.FLAG_PLAIN:
+            return data
+
+        if flag != self.FLAG_COMPRESSED:
+            raise ValueError('Invalid compression flag: %r' % flag)
+
+        try:
+            return zlib.decompress(data, self.WBITS)
+        except zlib.error as e:
+            raise ValueError('Invalid %s data: %s' % (self.NAME, e))
+
+
+class DeflateCompression(ZlibCompression):
+    """Raw deflate stream without the zlib header and checksum."""
+
+    NAME = 'deflate'
+    WBITS = -zlib.MAX_WBITS
+
+
+COMPRESSIONS = { c.NAME: c for c in [ZlibCompression, DeflateCompression] }
+
+
+def check_compression(compression, framing):
+    """Raise an exception if the compression can not be used with the
+    framing. None means no compression."""
+    if compression is None:
+        return
+
+    if compression not in COMPRESSIONS:
+        raise Exception('Unknown compression: %s' % compression)
+
+    if not FRAMINGS[framing].BINARY:
+        raise Exception('Compression requires a binary framing (%s)' %
+                        ', '.join(n for n, f in FRAMINGS.items() if f.BINARY))
+
+
+class JsonMsgReaderFactory(Factory):
+
+    THREAD_POOL_SIZE = 4
+
+    def __init__(self, framing = LegacyFraming.NAME,
+                 max_frame_size = None, max_buffer_size = None,
+                 thread_pool_size = THREAD_POOL_SIZE, nested_results = False,
+                 codec = JsonCodec.NAME):
         self.logger = logging.getLogger(JsonMsgReader.__name__)
         self.processors = []
+        self.locks = {}
+        self.threadpool = ThreadPool(minthreads = 0,
+                                     maxthreads = thread_pool_size,
+                                     name = 'JsonProcessors')
+
+        if framing not in FRAMINGS:
+            self.logger.error('Unknown framing: %s', framing)
+            raise Exception('Invalid framing is given')
+
+        check_codec(codec, framing)
+
+        if max_frame_size is None:
+            max_frame_size = JsonMsgReader.MAX_FRAME_SIZE
+
+        if max_buffer_size is None:
+            max_buffer_size = JsonMsgReader.MAX_BUFFER_SIZE
+
+        if max_buffer_size < max_frame_size:
+            self.logger.error('Buffer size (%d) is smaller than the maximal '
+                              'frame size (%d)', max_buffer_size,
+                              max_frame_size)
+            raise Exception('Invalid buffer size is given')
+
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        self.max_buffer_size = max_buffer_size
+        self.nested_results = nested_results
+        self.codec = codec
 
     def addProcessor(self, processorName, jsonProcessor):
         if not issubclass(type(jsonProcessor), IJsonProcessor):
@@ -100,91 +591,400 @@ class JsonMsgReaderFactory(Factory):
             raise Exception('Invalid processor is given')
 
         self.processors.append((processorName, jsonProcessor))
+        self.locks[processorName] = defer.DeferredLock()
         self.logger.info('Added processor: %s (%s)', processorName,
                          jsonProcessor.__class__.__name__)
 
+    def startFactory(self):
+        self.threadpool.start()
+
+    def stopFactory(self):
+        self.threadpool.stop()
+
     def buildProtocol(self, addr):
-        return JsonMsgReader(self.processors)
+        return JsonMsgReader(self.processors, framing = self.framing,
+                             max_frame_size = self.max_frame_size,
+                             max_buffer_size = self.max_buffer_size,
+                             threadpool = self.threadpool,
+                             locks = self.locks,
+                             nested_results = self.nested_results,
+                             codec = self.codec)
 
 
 class JsonMsgReader(Protocol):
-    def __init__(self, jsonProcessors = []):
+
+    # Optional request ID, echoed back in the reply so clients can match
+    # replies to pipelined requests.
+    MSG_ID = 'id'
+    # Optional processor name or list of names the message is meant for.
+    # Without it the message is passed to every processor.
+    MSG_TARGET = 'target'
+    # Changes the settings of the connection, e.g. the codec with
+    # { "negotiate": { "codec": "msgpack" } }. The reply is sent with the
+    # old settings, the following messages use the new ones.
+    MSG_NEGOTIATE = 'negotiate'
+    NEGOTIATE_CODEC = 'codec'
+    # Replies bigger than the threshold (in bytes) are compressed, e.g.
+    # { "negotiate": { "compression": "zlib", "compression_threshold": 512 } }
+    # Requests are never compressed. A null compression turns it off.
+    NEGOTIATE_COMPRESSION = 'compression'
+    NEGOTIATE_COMPRESSION_THRESHOLD = 'compression_threshold'
+    # Stops the subscriptions started by the request with the given ID,
+    # e.g. { "cancel": 3 }
+    MSG_CANCEL = 'cancel'
+    # Number of pushed messages dropped since the last one, as the client
+    # did not read them
+    PUSH_DROPPED = 'dropped'
+
+    MAX_FRAME_SIZE = 4 * 1024 * 1024
+    MAX_BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, jsonProcessors = [], framing = LegacyFraming.NAME,
+                 max_frame_size = MAX_FRAME_SIZE,
+                 max_buffer_size = MAX_BUFFER_SIZE,
+                 threadpool = None, locks = None, nested_results = False,
+                 codec = JsonCodec.NAME):
         self.logger = logging.getLogger(JsonMsgReader.__name__)
         self.processors = jsonProcessors
+        self.max_frame_size = max_frame_size
+        self.max_buffer_size = max_buffer_size
+        # Old clients expect every result as a JSON encoded string inside
+        # the reply instead of a plain JSON object.
+        self.nested_results = nested_results
+        self._threadpool = threadpool
+        # Messages are passed to a processor one at a time and in order,
+        # different processors work on them concurrently.
+        self._locks = locks if locks is not None else {}
+        self._inflight = 0
+        self._framing_name = framing
+        self._framing = self._new_framing_()
+        self._codec_name = codec
+        self._codec = CODECS[codec]()
+        self._compression = None
+        # Request ID -> list of started subscriptions
+        self._subscriptions = {}
+        self._push_dropped = 0
+        self._reading_paused = False
+        self._writing_blocked = False
+
+    def _new_framing_(self):
+        return FRAMINGS[self._framing_name](max_frame_size = self.max_frame_size)
 
     def connectionMade(self):
         self.logger.info("New connection from %s", self.transport.getPeer())
-        self._data = ""
+        self._framing = self._new_framing_()
+        self._codec = CODECS[self._codec_name]()
+        self._compression = None
+        # The reactor's thread, pushes from other threads are passed to it
+        self._thread = threading.get_ident()
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        subscriptions, self._subscriptions = self._subscriptions, {}
+        for subs in subscriptions.values():
+            for s in subs:
+                s.stop()
+
+    def pauseProducing(self):
+        # The transport's write buffer is full, the peer does not read
+        # our replies. Stop reading its requests until it catches up.
+        self._writing_blocked = True
+        self._update_backpressure_()
+
+    def resumeProducing(self):
+        self._writing_blocked = False
+        self._update_backpressure_()
+
+    def stopProducing(self):
+        pass
 
     def dataReceived(self, data):
-        try:
-            self._data += data.decode('utf-8')
-        except UnicodeDecodeError:
-            self.logger.error('Unable to decode received data. '
-                              'Skipping %s bytes', len(data))
+        self.logger.debug("New data from %s: %s", self.transport.getPeer(), data)
+        self._framing.feed(data)
+        for js, size in self._get_messages_():
+            if isinstance(js, dict) and self.MSG_NEGOTIATE in js:
+                self._negotiate_(js)
+                continue
+
+            if isinstance(js, dict) and self.MSG_CANCEL in js:
+                self._cancel_(js)
+                continue
+
+            self._inflight += size
+            subscriptions = []
+            d = self._process_message_(js, subscriptions)
+            d.addCallback(self._reply_)
+            d.addCallback(lambda _, js = js, subscriptions = subscriptions:
+                          self._subscribe_(js, subscriptions))
+            d.addErrback(self._log_failure_)
+            d.addBoth(self._message_done_, size)
+
+        if self._framing.overflow is not None:
+            self._reject_frame_(self._framing.overflow)
             return
 
-        self.logger.debug("New data from %s: %s", self.transport.getPeer(), self._data)
-        for js in self._get_complete_jsons_():
-            results = {}
-            for name, instance in self.processors:
-                self.logger.debug("Passing JSON %s to precessor %s", js, name)
-                result = instance.process(js)
-                if isinstance(result, IJsonProcessor.Result):
-                    results[name] = result.json()
-                else:
-                    r = IJsonProcessor.Result(IJsonProcessor.Result.UNKNOWN,
-                                              'Processor returned with invalid result',
-                                              {'RETURN_TYPE': str(type(result))})
-                    results[name] = r.json()
+        self._update_backpressure_()
 
-            self.transport.write(json.dumps(results).encode('utf-8'))
+    def _negotiate_(self, js):
+        settings = js[self.MSG_NEGOTIATE]
+        if not isinstance(settings, dict):
+            r = IJsonProcessor.Result.fail('Invalid negotiation: %s', settings)
+        elif self._inflight > 0:
+            r = IJsonProcessor.Result.fail('Unable to negotiate while '
+                                           'requests are processed')
+        else:
+            try:
+                codec, compression = self._negotiated_settings_(settings)
+                name = compression.NAME if compression is not None else None
+                r = IJsonProcessor.Result.ok('Negotiated', codec = codec.NAME,
+                                             compression = name)
+            except Exception as e:
+                r = IJsonProcessor.Result.fail('%s', e)
+
+        self.logger.info('Negotiation with %s: %s', self.transport.getPeer(),
+                         r.message)
+        reply = { self.MSG_NEGOTIATE: self._result_(r) }
+        if self.MSG_ID in js:
+            reply[self.MSG_ID] = js[self.MSG_ID]
+        self._reply_(reply)
+
+        if r.status == IJsonProcessor.Result.OK:
+            self._codec = codec
+            self._compression = compression
+
+    def _negotiated_settings_(self, settings):
+        codec = settings.get(self.NEGOTIATE_CODEC, self._codec.NAME)
+        check_codec(codec, self._framing_name)
+
+        compression = self._compression
+        if self.NEGOTIATE_COMPRESSION in settings:
+            name = settings[self.NEGOTIATE_COMPRESSION]
+            check_compression(name, self._framing_name)
+            compression = COMPRESSIONS[name]() if name is not None else None
+
+        if self.NEGOTIATE_COMPRESSION_THRESHOLD in settings:
+            threshold = settings[self.NEGOTIATE_COMPRESSION_THRESHOLD]
+            if type(threshold) is not int or threshold < 0:
+                raise Exception('Invalid compression threshold: %s' %
+                                threshold)
+            if compression is None:
+                raise Exception('Compression threshold is given '
+                                'without compression')
+            compression.threshold = threshold
+
+        return CODECS[codec](), compression
+
+    def _cancel_(self, js):
+        request_id = js[self.MSG_CANCEL]
+        subscriptions = []
+        if isinstance(request_id, (type(None), int, str)):
+            subscriptions = self._subscriptions.pop(request_id, [])
+
+        for s in subscriptions:
+            s.stop()
+
+        if len(subscriptions) > 0:
+            r = IJsonProcessor.Result.ok('Cancelled %d subscription(s)',
+                                         len(subscriptions))
+        else:
+            r = IJsonProcessor.Result.fail('No subscription for request %s',
+                                           request_id)
+
+        reply = { self.MSG_CANCEL: self._result_(r) }
+        if self.MSG_ID in js:
+            reply[self.MSG_ID] = js[self.MSG_ID]
+        self._reply_(reply)
+
+    def _subscribe_(self, js, subscriptions):
+        if len(subscriptions) == 0:
+            return
 
-    def _get_json_segments_(self, jsonString):
-        # Let's hope that there is no '{' or '}' in any string data
-        # of the JSON...
-        boundaries = 0
-        start = -1
-        segments = []
-        for i in range(0, len(jsonString)):
-            if jsonString[i] == '{':
-                if start == -1:
-                    start = i
-                    boundaries = 1
-                else:
-                    boundaries += 1
+        request_id = js.get(self.MSG_ID) if isinstance(js, dict) else None
+        for name, subscription in subscriptions:
+            if not self.connected or \
+                    not isinstance(request_id, (type(None), int, str)):
+                self.logger.warning('Not starting subscription of %s for '
+                                    'request %s', name, request_id)
+                subscription.stop()
+                continue
+
+            self.logger.info('Starting subscription of %s for %s', name,
+                             self.transport.getPeer())
+            self._subscriptions.setdefault(request_id, []).append(subscription)
+            subscription.start(self._pusher_(request_id, name, subscription))
+
+    def _pusher_(self, request_id, name, subscription):
+        def push(message):
+            if threading.get_ident() == self._thread:
+                self._push_(request_id, name, subscription, message)
+            else:
+                reactor.callFromThread(self._push_, request_id, name,
+                                       subscription, message)
+        return push
+
+    def _push_(self, request_id, name, subscription, message):
+        if not self.connected or \
+                subscription not in self._subscriptions.get(request_id, []):
+            return
 
-            if jsonString[i] == '}':
-                if start != -1:
-                    boundaries -= 1
+        if self._writing_blocked:
+            # The client does not keep up, do not buffer its messages
+            self._push_dropped += 1
+            return
 
-            if start != -1 and boundaries == 0:
-                segments.append({ 'start': start, 'end': i })
-                start = -1
+        if self._push_dropped > 0:
+            message = dict(message)
+            message[self.PUSH_DROPPED] = self._push_dropped
+            self._push_dropped = 0
+
+        reply = { name: message }
+        if request_id is not None:
+            reply[self.MSG_ID] = request_id
+        self._reply_(reply)
+
+    def _process_message_(self, js, subscriptions = None):
+        processors, reply = self._route_message_(js)
+        ds = [self._run_processor_(name, instance, js, subscriptions)
+              for name, instance in processors]
+        d = defer.gatherResults(ds, consumeErrors = True)
+
+        def collect(results):
+            reply.update(zip([name for name, _ in processors], results))
+            if isinstance(js, dict) and self.MSG_ID in js:
+                reply[self.MSG_ID] = js[self.MSG_ID]
+            return reply
+
+        return d.addCallback(collect)
+
+    def _route_message_(self, js):
+        if not isinstance(js, dict) or self.MSG_TARGET not in js:
+            return self.processors, {}
+
+        target = js[self.MSG_TARGET]
+        if isinstance(target, str):
+            target = [target]
+
+        if not isinstance(target, list) or \
+                not all(isinstance(t, str) for t in target):
+            self.logger.warning('Got invalid target: %s', target)
+            r = IJsonProcessor.Result.fail('Invalid target: %s', target)
+            return [], { self.MSG_TARGET: self._result_(r) }
+
+        processors = [(n, p) for n, p in self.processors if n in target]
+        known = [n for n, _ in processors]
+        failures = {}
+        for name in target:
+            if name not in known:
+                self.logger.warning('Got message for unknown processor %s',
+                                    name)
+                r = IJsonProcessor.Result.fail('No processor named %s', name)
+                failures[name] = self._result_(r)
+
+        return processors, failures
+
+    def _run_processor_(self, name, instance, js, subscriptions = None):
+        def call():
+            self.logger.debug("Passing JSON %s to precessor %s", js, name)
+            if instance.BLOCKING and self._threadpool is not None:
+                return threads.deferToThreadPool(reactor, self._threadpool,
+                                                 instance.process, js)
+            return defer.maybeDeferred(instance.process, js)
+
+        def check(result):
+            if isinstance(result, IJsonProcessor.Pending):
+                return result.deferred().addCallbacks(check, failed)
+
+            if isinstance(result, IJsonProcessor.Subscription):
+                if subscriptions is not None:
+                    subscriptions.append((name, result))
+                else:
+                    result.stop()
+                result = result.result
+
+            if isinstance(result, IJsonProcessor.Result):
+                return self._result_(result)
+
+            r = IJsonProcessor.Result(IJsonProcessor.Result.UNKNOWN,
+                                      'Processor returned with invalid result',
+                                      {'RETURN_TYPE': str(type(result))})
+            return self._result_(r)
+
+        def failed(failure):
+            self.logger.error('Processor %s failed: %s', name,
+                              failure.getTraceback())
+            return self._result_(IJsonProcessor.Result.fail(
+                'Processor failed: %s', failure.getErrorMessage()))
+
+        if instance.isQuery(js):
+            d = call()
+        else:
+            lock = self._locks.setdefault(name, defer.DeferredLock())
+            d = lock.run(call)
+        return d.addCallbacks(check, failed)
+
+    def _result_(self, result):
+        return result.json() if self.nested_results else result.as_dict()
+
+    def _reply_(self, reply):
+        message = self._codec.encode(reply)
+        if self._compression is not None:
+            message = self._compression.compress(message)
+        self.transport.write(self._framing.encode(message))
+
+    def _log_failure_(self, failure):
+        self.logger.error('Unable to reply: %s', failure.getTraceback())
+
+    def _message_done_(self, _, size):
+        self._inflight -= size
+        self._update_backpressure_()
+
+    def _buffered_(self):
+        return self._framing.pending() + self._inflight
+
+    def _update_backpressure_(self):
+        buffered = self._buffered_()
+        if not self._reading_paused and (self._writing_blocked or
+                                         buffered > self.max_buffer_size):
+            self.logger.warning('Pausing %s (buffered: %d bytes, '
+                                'write blocked: %s)', self.transport.getPeer(),
+                                buffered, self._writing_blocked)
+            self._reading_paused = True
+            self.transport.pauseProducing()
+        elif self._reading_paused and not self._writing_blocked and \
+                buffered <= self.max_buffer_size // 2:
+            self.logger.info('Resuming %s (buffered: %d bytes)',
+                             self.transport.getPeer(), buffered)
+            self._reading_paused = False
+            self.transport.resumeProducing()
+
+    def _reject_frame_(self, size):
+        r = IJsonProcessor.Result.fail('Frame of %d bytes exceeds the limit '
+                                       'of %d bytes', size, self.max_frame_size)
+        self.logger.error('Closing connection to %s: %s',
+                          self.transport.getPeer(), r.message)
+        self._reply_(r.as_dict())
+        self.transport.loseConnection()
 
-        return segments
+    def _get_json_segments_(self, jsonString):
+        return JsonFrameScanner().scan(jsonString.encode('utf-8'))
 
     def _get_complete_jsons_(self):
-        jsons = []
-        self.logger.debug("Checking data for socket %s", self._data)
-        segments = self._get_json_segments_(self._data)
-        self.logger.debug("Found %d segment(s)", len(segments))
-        for s in segments:
-            subJsonString = self._data[s['start']:s['end']+1]
-            self.logger.debug("Parsing %s at %d-%d", subJsonString, s['start'], s['end']+1)
+        return [js for js, _ in self._get_messages_()]
+
+    def _get_messages_(self):
+        # Frames are decoded one by one, so a negotiated codec applies to
+        # the frames following the negotiation.
+        frames = self._framing.frames()
+        self.logger.debug("Found %d frame(s)", len(frames))
+        for frame in frames:
+            self.logger.debug("Parsing %s", frame)
             try:
-                js = json.loads(subJsonString)
-                jsons.append(js)
-            except json.decoder.JSONDecodeError as e:
-                self.logger.error("Unable to parse JSON message. Ignoring it!")
-                self.logger.error("\tJSON message: %s", subJsonString)
-                self.logger.error("\tDecoding error: %s", e.msg)
-
-            if len(segments) > 0:
-                end = segments.pop()['end'] + 1
-                self._data = self._data[end:]
-
-        return jsons
-
-
-
+                js = self._codec.decode(frame)
+            except ValueError as e:
+                self.logger.error("Unable to parse %s message. Ignoring it!",
+                                  self._codec.NAME)
+                self.logger.error("\tMessage: %s", frame)
+                self.logger.error("\tDecoding error: %s", e)
+                continue
+
+            yield js, len(frame)
@@ -0,0 +1,267 @@
+import re
+
+
+class ParseError(Exception):
+    pass
+
+
+class Setting(object):
+    """A value of a libconfig document. Scalars keep their parsed value,
+    groups, lists and arrays only their kind. start and end are the span
+    of the value in the text."""
+
+    GROUP = 'group'
+    LIST = 'list'
+    ARRAY = 'array'
+    SCALAR = 'scalar'
+
+    def __init__(self, path, name, kind, value, start, end):
+        self.path = path
+        self.name = name
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+
+class Document(object):
+    """A parsed libconfig document.
+
+    Every setting is found by its path: the names of the groups it is in
+    and its own name joined by dots, elements of lists and arrays are
+    indexed, like 'MME.GUMMEI_LIST[0].MCC'. Rendering changes only
+    replaces the text of the changed values, comments and formatting
+    are kept as they are.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._settings = {}
+        self._names = {}
+        _Parser(text, self._add).parse()
+
+    def _add(self, setting):
+        self._settings[setting.path] = setting
+        if setting.name is not None:
+            self._names.setdefault(setting.name, []).append(setting.path)
+
+    def __contains__(self, path):
+        return path in self._settings
+
+    def paths(self):
+        return list(self._settings.keys())
+
+    def setting(self, path):
+        return self._settings[path]
+
+    def get(self, path, default = None):
+        """Value of the scalar at path."""
+        setting = self._settings.get(path)
+        if setting is None:
+            return default
+        if setting.kind != Setting.SCALAR:
+            raise ParseError('Setting %s is a %s' % (path, setting.kind))
+        return setting.value
+
+    def find(self, name):
+        """Paths of the settings called name, in document order."""
+        return list(self._names.get(name, []))
+
+    def render(self, changes):
+        """Text of the document with the scalars at the paths of changes
+        set to their values."""
+        replaced = []
+        for path, value in changes.items():
+            setting = self._settings[path]
+            if setting.kind != Setting.SCALAR:
+                raise ParseError('Setting %s is a %s, only scalars can be '
+                                 'set' % (path, setting.kind))
+            replaced.append((setting.start, setting.end, format_value(value)))
+
+        replaced.sort()
+        pieces = []
+        pos = 0
+        for start, end, text in replaced:
+            pieces.append(self.text[pos:start])
+            pieces.append(text)
+            pos = end
+        pieces.append(self.text[pos:])
+
+        return ''.join(pieces)
+
+
+class _Parser(object):
+
+    TOKENS = re.compile(r'''
+          (?P<space>\s+)
+        | (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/)
+        | (?P<include>@include[^\n]*)
+        | (?P<string>"(?:[^"\\]|\\.)*")
+        | (?P<float>[-+]?(?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][-+]?\d+)?)
+        | (?P<hex>0[xX][0-9A-Fa-f]+L{0,2})
+        | (?P<int>[-+]?\d+L{0,2})
+        | (?P<bool>(?i:true|false)\b)
+        | (?P<name>[A-Za-z*][-A-Za-z0-9_*]*)
+        | (?P<punct>[=:;,{}()\[\]])
+        ''', re.S | re.X)
+    SKIPPED = ('space', 'comment', 'include')
+    ESCAPES = {'\\': '\\', '"': '"', 'n': '\n', 'r': '\r', 't': '\t',
+               'f': '\f'}
+    RE_ESCAPE = re.compile(r'\\(x[0-9A-Fa-f]{2}|.)', re.S)
+
+    def __init__(self, text, add):
+        self._text = text
+        self._add = add
+        self._tokens = self._tokenize(text)
+        self._pos = 0
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        while pos < len(text):
+            m = self.TOKENS.match(text, pos)
+            if m is None:
+                raise ParseError('Unexpected character %r at %s' %
+                                 (text[pos], self._where(pos)))
+            if m.lastgroup not in self.SKIPPED:
+                tokens.append((m.lastgroup, m.group(), m.start(), m.end()))
+            pos = m.end()
+
+        return tokens
+
+    def _where(self, pos):
+        line = self._text.count('\n', 0, pos) + 1
+        column = pos - self._text.rfind('\n', 0, pos)
+        return 'line %d column %d' % (line, column)
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None, len(self._text), len(self._text))
+
+    def _next(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+
+    def _expect(self, *texts):
+        kind, text, start, _ = self._next()
+        if kind != 'punct' or text not in texts:
+            found = 'end of file' if kind is None else repr(text)
+            raise ParseError('Expected %s but found %s at %s' %
+                             (' or '.join(texts), found, self._where(start)))
+
+    def _accept(self, *texts):
+        kind, text, _, _ = self._peek()
+        if kind == 'punct' and text in texts:
+            self._pos += 1
+            return True
+        return False
+
+    def parse(self):
+        self._parseSettings('', None)
+
+    def _parseSettings(self, prefix, closing):
+        while True:
+            kind, text, start, _ = self._peek()
+            if kind is None and closing is None:
+                return
+            if kind == 'punct' and text == closing:
+                return
+            if kind != 'name':
+                found = 'end of file' if kind is None else repr(text)
+                raise ParseError('Expected a setting name but found %s at %s'
+                                 % (found, self._where(start)))
+
+            self._next()
+            self._expect('=', ':')
+            self._parseValue(prefix + text, text)
+            self._accept(';', ',')
+
+    def _parseValue(self, path, name):
+        kind, text, start, _ = self._peek()
+        if kind == 'punct' and text == '{':
+            self._next()
+            self._parseSettings(path + '.', '}')
+            _, _, _, end = self._next()
+            self._add(Setting(path, name, Setting.GROUP, None, start, end))
+        elif kind == 'punct' and text in ('(', '['):
+            self._next()
+            closing = ')' if text == '(' else ']'
+            index = 0
+            while not self._accept(closing):
+                if index > 0:
+                    self._expect(',')
+                    # A trailing comma is allowed
+                    if self._accept(closing):
+                        break
+                element = '%s[%d]' % (path, index)
+                if closing == ']':
+                    self._parseScalar(element, None)
+                else:
+                    self._parseValue(element, None)
+                index += 1
+            end = self._tokens[self._pos - 1][3]
+            kind = Setting.LIST if closing == ')' else Setting.ARRAY
+            self._add(Setting(path, name, kind, None, start, end))
+        else:
+            self._parseScalar(path, name)
+
+    def _parseScalar(self, path, name):
+        kind, text, start, end = self._next()
+        if kind == 'string':
+            value = self._unquote(text)
+            # Adjacent strings are concatenated
+            while self._peek()[0] == 'string':
+                _, text, _, end = self._next()
+                value += self._unquote(text)
+        elif kind == 'float':
+            value = float(text)
+        elif kind == 'hex':
+            value = int(text.rstrip('L'), 16)
+        elif kind == 'int':
+            value = int(text.rstrip('L'))
+        elif kind == 'bool':
+            value = text.lower() == 'true'
+        else:
+            found = 'end of file' if kind is None else repr(text)
+            raise ParseError('Expected a value but found %s at %s' %
+                             (found, self._where(start)))
+
+        self._add(Setting(path, name, Setting.SCALAR, value, start, end))
+
+    def _unquote(self, text):
+        def unescape(m):
+            escape = m.group(1)
+            if escape[0] == 'x' and len(escape) == 3:
+                return chr(int(escape[1:], 16))
+            return self.ESCAPES.get(escape, escape)
+
+        return self.RE_ESCAPE.sub(unescape, text[1:-1])
+
+
+def format_value(value):
+    """libconfig text of a scalar value."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        text = repr(value)
+        return text if '.' in text or 'e' in text else text + '.0'
+    if isinstance(value, str):
+        text = value.replace('\\', '\\\\').replace('"', '\\"')
+        for char, escape in [('\n', '\\n'), ('\r', '\\r'), ('\t', '\\t'),
+                             ('\f', '\\f')]:
+            text = text.replace(char, escape)
+        return '"%s"' % text
+    raise ParseError('Unable to format %r as a libconfig value' % (value,))
+
+
+def parse(text):
+    return Document(text)
+
+
+def load(path):
+    with open(path) as f:
+        return Document(f.read())
@@ -1,9 +1,9 @@
 from son.vmmanager.jsonserver import IJsonProcessor as P
 from son.vmmanager.processors import utils
-from son.vmmanager.processors.utils import RE_ASSIGNMENT, RE_NAME
+from son.vmmanager.processors.utils import RE_NAME
+from son.vmmanager.processors.utils import SubstitutionRule as Rule
 
 import pymysql.cursors
-import tempfile
 import logging
 import re
 import os
@@ -49,11 +49,13 @@ class HSS_Config(utils.HostConfig, utils.CommandConfig):
 
 class HSS_Configurator(utils.ConfiguratorHelpers):
 
-    RE_MYSQL_USER = '(.*)"@MYSQL_user@"'
-    RE_MYSQL_PASS = '(.*)"@MYSQL_pass@"'
+    HSS_RULES = utils.SubstitutionRules(
+        mysql_user = Rule('(.*)"@MYSQL_user@"', '@MYSQL_user@'),
+        mysql_pass = Rule('(.*)"@MYSQL_pass@"', '@MYSQL_pass@'))
 
-    RE_IDENTITY = RE_ASSIGNMENT('^Identity', RE_NAME)
-    RE_REALM = RE_ASSIGNMENT('[Rr]ealm', RE_NAME)
+    HSS_FD_RULES = utils.SubstitutionRules(
+        identity = Rule.assignment('^Identity', RE_NAME),
+        realm = Rule.assignment('[Rr]ealm', RE_NAME))
 
     MYSQL_HOST = 'localhost'
     MYSQL_DB = 'oai_db'
@@ -113,7 +115,9 @@ class HSS_Configurator(utils.ConfiguratorHelpers):
                                  host_file=host_result.message,
                                  cert=cert_result.message)
 
-        return self.ok('HSS is fully configured')
+        unchanged = all(r.args.get('unchanged', False)
+                        for r in [hss_result, hss_fd_result, host_result])
+        return self.ok('HSS is fully configured', unchanged = unchanged)
 
     def _configure_hss_freediameter(self, hss_config):
         if not os.path.isfile(self._hss_fd_config_path):
@@ -126,22 +130,11 @@ class HSS_Configurator(utils.ConfiguratorHelpers):
         if hss_host is None and realm is None:
             return self.warn('No HSS freediameter configuration is privded')
 
-        new_content = ""
-        with open(self._hss_fd_config_path) as f:
-            for line in f:
-                self._current_line = line
+        written = self.substitute(self.HSS_FD_RULES, self._hss_fd_config_path,
+                                  identity = hss_host, realm = realm)
 
-                if hss_host is not None:
-                    self.sed_it(self.RE_IDENTITY, hss_host)
-
-                if realm is not None:
-                    self.sed_it(self.RE_REALM, realm)
-
-                new_content += self._current_line
-
-        self.write_out(new_content, self._hss_fd_config_path)
-
-        return self.ok('HSS freediameter is configured')
+        return self.ok('HSS freediameter is configured',
+                       unchanged = not written)
 
     def _configure_hss(self, hss_config):
         if not os.path.isfile(self._hss_config_path):
@@ -155,19 +148,10 @@ class HSS_Configurator(utils.ConfiguratorHelpers):
             return self.warn('Unable to configure HSS '
                              'no MySQL user and password provided')
 
-        new_content = ""
-        with open(self._hss_config_path) as f:
-            for line in f:
-                self._current_line  = line
-
-                self.sed_it(self.RE_MYSQL_USER, user)
-                self.sed_it(self.RE_MYSQL_PASS, password)
+        written = self.substitute(self.HSS_RULES, self._hss_config_path,
+                                  mysql_user = user, mysql_pass = password)
 
-                new_content += self._current_line
-
-        self.write_out(new_content, self._hss_config_path)
-
-        return self.ok('HSS is configured')
+        return self.ok('HSS is configured', unchanged = not written)
 
     def _configure_mysql_mme(self, hss_config):
         user = hss_config.mysql_user
@@ -244,6 +228,8 @@ class HSS_Configurator(utils.ConfiguratorHelpers):
 
 class HSS_Processor(P):
 
+    BLOCKING = True
+
     HSS_FREEDIAMETER_CONFIG_PATH = '/usr/local/etc/oai/freeDiameter/hss_fd.conf'
     HSS_CONFIG_PATH = '/usr/local/etc/oai/hss.conf'
     HOST_FILE_PATH = '/etc/hosts'
@@ -255,7 +241,8 @@ class HSS_Processor(P):
                  hss_freediameter_config_path = HSS_FREEDIAMETER_CONFIG_PATH,
                  hss_certificate_exe = HSS_CERTIFICATE_EXECUTABLE,
                  hss_certificate_path = HSS_CERTIFICATE_PATH,
-                 host_file_path = HOST_FILE_PATH):
+                 host_file_path = HOST_FILE_PATH,
+                 **runner_options):
         self.logger = logging.getLogger(HSS_Processor.__name__)
 
         self._configurator = HSS_Configurator(hss_config_path,
@@ -263,10 +250,8 @@ class HSS_Processor(P):
                                               host_file_path,
                                               hss_certificate_exe,
                                               hss_certificate_path)
-        self._log_dir = tempfile.TemporaryDirectory(prefix='hss.processor')
-        self._log_dir_name = self._log_dir.name
-        self._runner = utils.Runner(self.HSS_EXECUTABLE,
-                                    log_dir=self._log_dir_name)
+        self._runner = utils.Runner.from_options(
+            self.HSS_EXECUTABLE, 'hss.processor', **runner_options)
 
     def process(self, json_dict):
         parser = HSS_MessageParser(json_dict)
@@ -278,21 +263,21 @@ class HSS_Processor(P):
                                  'it will be not executed',
                                  **config_result.args)
 
-        return self._execute_command(hss_config)
+        return utils.merge_result(self._execute_command(hss_config),
+                                  config_result)
+
+    def isQuery(self, json_dict):
+        return utils.CommandMessageParser.isQuery(json_dict)
 
     def _execute_command(self, hss_config):
         if hss_config.command == utils.CommandConfig.START:
-            return self._runner.start()
+            return self._runner.start(wait_ready = hss_config.wait_ready)
         elif hss_config.command == utils.CommandConfig.STOP:
             return self._runner.stop()
         elif hss_config.command == utils.CommandConfig.RESTART:
-            return self._runner.restart()
-        elif hss_config.command == utils.CommandConfig.STATUS:
-            status = 'Running' if self._runner.isRunning() else 'Stopped'
-            stdout = self._runner.getOutput()
-            stderr = self._runner.getOutput(stderr=True)
-            return P.Result.ok('Status', task_status = status,
-                               stderr = stderr, stdout = stdout)
+            return self._runner.restart(wait_ready = hss_config.wait_ready)
+        elif hss_config.command in utils.CommandConfig.QUERIES:
+            return utils.query(self._runner, hss_config)
         elif hss_config.command is None:
             return P.Result.warn('No command is given')
         else:
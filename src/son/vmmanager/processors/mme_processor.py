@@ -1,9 +1,9 @@
 from son.vmmanager.jsonserver import IJsonProcessor as P
 from son.vmmanager.processors import utils
-from son.vmmanager.processors.utils import RE_IPV4_MASK, RE_IPV4
-from son.vmmanager.processors.utils import RE_ASSIGNMENT, RE_NAME
+from son.vmmanager.processors.utils import RE_IPV4, RE_NAME
+from son.vmmanager.processors.utils import SubstitutionRule as Rule
+from son.vmmanager import libconfig
 
-import tempfile
 import logging
 import re
 import os
@@ -43,17 +43,20 @@ class MME_Config(utils.HostConfig, utils.CommandConfig):
 
 class MME_Configurator(utils.ConfiguratorHelpers):
 
-    RE_S1_INTERFACE = RE_ASSIGNMENT('MME_INTERFACE_NAME_FOR_S1_MME', RE_NAME)
-    RE_S1_IPV4 = RE_ASSIGNMENT('MME_IPV4_ADDRESS_FOR_S1_MME', RE_IPV4_MASK)
-    RE_S11_INTERFACE = RE_ASSIGNMENT('MME_INTERFACE_NAME_FOR_S11_MME', RE_NAME)
-    RE_S11_IPV4 = RE_ASSIGNMENT('MME_IPV4_ADDRESS_FOR_S11_MME', RE_IPV4_MASK)
-    RE_SGW_IPV4 = RE_ASSIGNMENT('SGW_IPV4_ADDRESS_FOR_S11', RE_IPV4_MASK)
-    RE_HSS_HOSTNAME = RE_ASSIGNMENT('HSS_HOSTNAME', RE_NAME)
-
-    RE_IDENTITY = RE_ASSIGNMENT('^Identity', RE_NAME)
-    RE_CONNECT_PEER = RE_ASSIGNMENT('^ConnectPeer', RE_NAME)
-    RE_CONNECT_TO = RE_ASSIGNMENT('ConnectTo', RE_IPV4)
-    RE_REALM = RE_ASSIGNMENT('[Rr]ealm', RE_NAME)
+    MME_FD_RULES = utils.SubstitutionRules(
+        identity = Rule.assignment('^Identity', RE_NAME),
+        connect_peer = Rule.assignment('^ConnectPeer', RE_NAME),
+        connect_to = Rule.assignment('ConnectTo', RE_IPV4),
+        realm = Rule.assignment('[Rr]ealm', RE_NAME))
+
+    MME_SETTINGS = {
+        's1_interface': 'MME.NETWORK_INTERFACES.MME_INTERFACE_NAME_FOR_S1_MME',
+        's1_ip': 'MME.NETWORK_INTERFACES.MME_IPV4_ADDRESS_FOR_S1_MME',
+        's11_interface':
+            'MME.NETWORK_INTERFACES.MME_INTERFACE_NAME_FOR_S11_MME',
+        's11_ip': 'MME.NETWORK_INTERFACES.MME_IPV4_ADDRESS_FOR_S11_MME',
+        'hss_host': 'MME.S6A.HSS_HOSTNAME',
+        'sgw_ip': 'S-GW.SGW_IPV4_ADDRESS_FOR_S11'}
 
     def __init__(self, config_path, fd_config_path, host_file_path,
                  cert_exe = None, cert_path = None):
@@ -86,7 +89,9 @@ class MME_Configurator(utils.ConfiguratorHelpers):
                                  host_file=host_result.message,
                                  cert=cert_result.message)
 
-        return self.ok('MME is fully configured')
+        unchanged = all(r.args.get('unchanged', False)
+                        for r in [mme_result, mme_fd_result, host_result])
+        return self.ok('MME is fully configured', unchanged = unchanged)
 
     def _configure_mme_freediameter(self, mme_config):
         if not os.path.isfile(self._mme_fd_config_path):
@@ -103,28 +108,13 @@ class MME_Configurator(utils.ConfiguratorHelpers):
                 and hss_ip is None and realm is None:
             return self.warn('No MME freediameter configuration is privded')
 
-        new_content = ""
-        with open(self._mme_fd_config_path) as f:
-            for line in f:
-                self._current_line = line
-
-                if mme_host is not None:
-                    self.sed_it(self.RE_IDENTITY, mme_host)
-
-                if realm is not None:
-                    self.sed_it(self.RE_REALM, realm)
-
-                if hss_host is not None:
-                    self.sed_it(self.RE_CONNECT_PEER, hss_host)
-
-                if hss_ip is not None:
-                    self.sed_it(self.RE_CONNECT_TO, hss_ip)
+        written = self.substitute(self.MME_FD_RULES, self._mme_fd_config_path,
+                                  identity = mme_host, realm = realm,
+                                  connect_peer = hss_host,
+                                  connect_to = hss_ip)
 
-                new_content += self._current_line
-
-        self.write_out(new_content, self._mme_fd_config_path)
-
-        return self.ok('MME freediameter is configured')
+        return self.ok('MME freediameter is configured',
+                       unchanged = not written)
 
     def _configure_mme(self, mme_config):
         if not os.path.isfile(self._mme_config_path):
@@ -145,38 +135,24 @@ class MME_Configurator(utils.ConfiguratorHelpers):
 
         hss_host = hss_host.split('.')[0]
 
-        new_content = ""
-        with open(self._mme_config_path) as f:
-            for line in f:
-                self._current_line  = line
-
-                if s1_intf is not None:
-                    self.sed_it(self.RE_S1_INTERFACE, s1_intf)
-
-                if s11_intf is not None:
-                    self.sed_it(self.RE_S11_INTERFACE, s11_intf)
+        try:
+            written = self.set_settings(self.MME_SETTINGS,
+                                        self._mme_config_path,
+                                        s1_interface = s1_intf, s1_ip = s1_ip,
+                                        s11_interface = s11_intf,
+                                        s11_ip = mme_ip, sgw_ip = spgw_ip,
+                                        hss_host = hss_host)
+        except libconfig.ParseError as e:
+            return self.fail('MME config file %s is invalid: %s',
+                             self._mme_config_path, e)
 
-                if mme_ip is not None:
-                    self.sed_it(self.RE_S11_IPV4, mme_ip)
-
-                if s1_ip is not None:
-                    self.sed_it(self.RE_S1_IPV4, s1_ip)
-
-                if spgw_ip is not None:
-                    self.sed_it(self.RE_SGW_IPV4, spgw_ip)
-
-                if hss_host is not None:
-                    self.sed_it(self.RE_HSS_HOSTNAME, hss_host)
-
-                new_content += self._current_line
-
-        self.write_out(new_content, self._mme_config_path)
-
-        return self.ok('MME is configured')
+        return self.ok('MME is configured', unchanged = not written)
 
 
 class MME_Processor(P):
 
+    BLOCKING = True
+
     MME_FREEDIAMETER_CONFIG_PATH = '/usr/local/etc/oai/freeDiameter/mme_fd.conf'
     MME_CONFIG_PATH = '/usr/local/etc/oai/mme.conf'
     HOST_FILE_PATH = '/etc/hosts'
@@ -188,17 +164,16 @@ class MME_Processor(P):
                  mme_freediameter_config_path = MME_FREEDIAMETER_CONFIG_PATH,
                  host_file_path = HOST_FILE_PATH,
                  cert_exe = MME_CERTIFICATE_CREATOR,
-                 cert_path = MME_CERTIFICATE_PATH):
+                 cert_path = MME_CERTIFICATE_PATH,
+                 **runner_options):
         self.logger = logging.getLogger(MME_Processor.__name__)
 
         self._configurator = MME_Configurator(mme_config_path,
                                               mme_freediameter_config_path,
                                               host_file_path,
                                               cert_exe, cert_path)
-        self._log_dir = tempfile.TemporaryDirectory(prefix='mme.processor')
-        self._log_dir_name = self._log_dir.name
-        self._runner = utils.Runner(self.MME_EXECUTABLE,
-                                    log_dir = self._log_dir_name)
+        self._runner = utils.Runner.from_options(
+            self.MME_EXECUTABLE, 'mme.processor', **runner_options)
 
     def process(self, json_dict):
         parser = MME_MessageParser(json_dict)
@@ -210,21 +185,21 @@ class MME_Processor(P):
                                  'it will be not executed.',
                                  **config_result.args)
 
-        return self._execute_command(mme_config)
+        return utils.merge_result(self._execute_command(mme_config),
+                                  config_result)
+
+    def isQuery(self, json_dict):
+        return utils.CommandMessageParser.isQuery(json_dict)
 
     def _execute_command(self, mme_config):
         if mme_config.command == utils.CommandConfig.START:
-            return self._runner.start()
+            return self._runner.start(wait_ready = mme_config.wait_ready)
         elif mme_config.command == utils.CommandConfig.STOP:
             return self._runner.stop()
         elif mme_config.command == utils.CommandConfig.RESTART:
-            return self._runner.restart()
-        elif mme_config.command == utils.CommandConfig.STATUS:
-            status = 'Running' if self._runner.isRunning() else 'Stopped'
-            stdout = self._runner.getOutput()
-            stderr = self._runner.getOutput(stderr=True)
-            return P.Result.ok('Status', task_status = status,
-                               stderr = stderr, stdout = stdout)
+            return self._runner.restart(wait_ready = mme_config.wait_ready)
+        elif mme_config.command in utils.CommandConfig.QUERIES:
+            return utils.query(self._runner, mme_config)
         elif mme_config.command is None:
             return P.Result.warn('No command is given')
         else:
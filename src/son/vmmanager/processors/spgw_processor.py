@@ -1,9 +1,7 @@
 from son.vmmanager.jsonserver import IJsonProcessor as P
 from son.vmmanager.processors import utils
-from son.vmmanager.processors.utils import RE_IPV4_MASK
-from son.vmmanager.processors.utils import RE_ASSIGNMENT, RE_NAME
+from son.vmmanager import libconfig
 
-import tempfile
 import logging
 import re
 import os
@@ -50,11 +48,12 @@ class SPGW_Config(utils.CommandConfig, utils.HostConfig):
 
 class SPGW_Configurator(utils.ConfiguratorHelpers):
 
-    RE_S11_INTERFACE = RE_ASSIGNMENT('SGW_INTERFACE_NAME_FOR_S11', RE_NAME)
-    RE_S11_IP = RE_ASSIGNMENT('SGW_IPV4_ADDRESS_FOR_S11', RE_IPV4_MASK)
-    RE_SGI_INTERFACE = RE_ASSIGNMENT('PGW_INTERFACE_NAME_FOR_SGI', RE_NAME)
-    RE_S1U_IP = RE_ASSIGNMENT('SGW_IPV4_ADDRESS_FOR_S1U_S12_S4_UP', RE_IPV4_MASK)
-    RE_PGW_MASQ = RE_ASSIGNMENT('PGW_MASQUERADE_SGI', 'no')
+    SPGW_SETTINGS = {
+        's11_interface': 'S-GW.NETWORK_INTERFACES.SGW_INTERFACE_NAME_FOR_S11',
+        's11_ip': 'S-GW.NETWORK_INTERFACES.SGW_IPV4_ADDRESS_FOR_S11',
+        's1u_ip': 'S-GW.NETWORK_INTERFACES.SGW_IPV4_ADDRESS_FOR_S1U_S12_S4_UP',
+        'sgi_interface': 'P-GW.NETWORK_INTERFACES.PGW_INTERFACE_NAME_FOR_SGI',
+        'masquerade_sgi': 'P-GW.NETWORK_INTERFACES.PGW_MASQUERADE_SGI'}
 
     def __init__(self, config_path):
         self._spgw_config_path = config_path
@@ -74,41 +73,34 @@ class SPGW_Configurator(utils.ConfiguratorHelpers):
                 and sgi_intf is None and s1u_ip is None:
             return self.warn('No SPGW configuration is privded')
 
-        new_content = ""
-        with open(self._spgw_config_path) as f:
-            for line in f:
-                self._current_line  = line
+        try:
+            written = self.set_settings(self.SPGW_SETTINGS,
+                                        self._spgw_config_path,
+                                        s11_interface = s11_intf,
+                                        s11_ip = s11_ip, s1u_ip = s1u_ip,
+                                        sgi_interface = sgi_intf,
+                                        masquerade_sgi = 'yes')
+        except libconfig.ParseError as e:
+            return self.fail('SPGW config file %s is invalid: %s',
+                             self._spgw_config_path, e)
 
-                if s11_intf is not None:
-                    self.sed_it(self.RE_S11_INTERFACE, s11_intf)
-                if s11_ip  is not None:
-                    self.sed_it(self.RE_S11_IP, s11_ip)
-                if sgi_intf is not None:
-                    self.sed_it(self.RE_SGI_INTERFACE, sgi_intf)
-                if s1u_ip is not None:
-                    self.sed_it(self.RE_S1U_IP, s1u_ip)
-
-                self.sed_it(self.RE_PGW_MASQ, 'yes')
-
-                new_content += self._current_line
-
-        self.write_out(new_content, self._spgw_config_path)
-
-        return self.ok('SPGW is configured')
+        return self.ok('SPGW is configured', unchanged = not written)
 
 
 class SPGW_Processor(P):
 
+    BLOCKING = True
+
     SPGW_CONFIG_PATH = '/usr/local/etc/oai/spgw.conf'
     SPGW_EXECUTABLE = '~/openair-cn/SCRIPTS/run_spgw'
 
-    def __init__(self, spgw_config_path = SPGW_CONFIG_PATH):
+    def __init__(self, spgw_config_path = SPGW_CONFIG_PATH,
+                 **runner_options):
         self.logger = logging.getLogger(SPGW_Processor.__name__)
 
         self._configurator = SPGW_Configurator(config_path = spgw_config_path)
-        self._log_dir = tempfile.TemporaryDirectory(prefix='spgw.processor')
-        self._log_dir_name = self._log_dir.name
-        self._runner = utils.Runner(self.SPGW_EXECUTABLE, log_dir = self._log_dir_name)
+        self._runner = utils.Runner.from_options(
+            self.SPGW_EXECUTABLE, 'spgw.processor', **runner_options)
 
     def process(self, json_dict):
         parser = SPGW_MessageParser(json_dict)
@@ -120,21 +112,21 @@ class SPGW_Processor(P):
                                  'it will be not exectued',
                                  **config_result.args)
 
-        return self._execute_command(spgw_config)
+        return utils.merge_result(self._execute_command(spgw_config),
+                                  config_result)
+
+    def isQuery(self, json_dict):
+        return utils.CommandMessageParser.isQuery(json_dict)
 
     def _execute_command(self, spgw_config):
         if spgw_config.command == utils.CommandConfig.START:
-            return self._runner.start()
+            return self._runner.start(wait_ready = spgw_config.wait_ready)
         elif spgw_config.command == utils.CommandConfig.STOP:
             return self._runner.stop()
         elif spgw_config.command == utils.CommandConfig.RESTART:
-            return self._runner.restart()
-        elif spgw_config.command == utils.CommandConfig.STATUS:
-            status = 'Running' if self._runner.isRunning() else 'Stopped'
-            stdout = self._runner.getOutput()
-            stderr = self._runner.getOutput(stderr=True)
-            return P.Result.ok('Status', task_status = status,
-                               stderr = stderr, stdout = stdout)
+            return self._runner.restart(wait_ready = spgw_config.wait_ready)
+        elif spgw_config.command in utils.CommandConfig.QUERIES:
+            return utils.query(self._runner, spgw_config)
         elif spgw_config.command is None:
             return P.Result.warn('No command is given')
         else:
@@ -1,4 +1,6 @@
 from son.vmmanager.jsonserver import IJsonProcessor as P
+from son.vmmanager.jsonserver import JsonMsgReader
+from son.vmmanager import libconfig
 import re
 import os
 import time
@@ -9,7 +11,19 @@ import psutil
 import shutil
 import tempfile
 import threading
+import collections
+import signal
+import array
+import itertools
+import gzip
+import configparser
+import errno
+import stat
 from netifaces import interfaces, ifaddresses
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet import defer, reactor, threads, task
+from twisted.python import threadable
 
 RE_IPV4_NUMBER = '\d{1,3}'
 RE_IPV4 = r'\.'.join([RE_IPV4_NUMBER] * 4)
@@ -17,28 +31,302 @@ RE_IPV4_MASK = RE_IPV4 + '/\d{1,2}'
 RE_ASSIGNMENT = lambda variable, value: r'(%s\s*=\s*)"%s"' % (variable, value)
 RE_NAME = r'[\w\.-]+'
 
-class ConfiguratorHelpers(object):
+def to_bool(value):
+    """Accepts booleans and the boolean strings of configuration files."""
+    if isinstance(value, bool):
+        return value
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[str(value).lower()]
+    except KeyError:
+        raise ValueError('Not a boolean: %s' % value)
+
+def merge_result(result, config_result):
+    """Adds the arguments of config_result, like whether the configuration
+    was unchanged, to the result of a command. Results that arrive later
+    get them once they arrive, subscriptions are returned as they are."""
+    if isinstance(result, (defer.Deferred, P.Pending)):
+        return result.addCallback(merge_result, config_result)
+    if not isinstance(result, P.Result) or config_result.args is None:
+        return result
+
+    args = dict(config_result.args)
+    args.update(result.args or {})
+    result.args = args
+    return result
+
+class SubstitutionRule(object):
+    """A regex compiled once, capturing the text kept before the value in
+    its first group. Only the lines containing key are matched."""
+
+    def __init__(self, regex, key):
+        self.regex = re.compile(regex)
+        self.key = key
+
+    @classmethod
+    def assignment(cls, variable, value):
+        """Rule for RE_ASSIGNMENT(variable, value), keyed by the longest
+        literal word of variable."""
+        literal = re.sub(r'\[[^\]]*\]', ' ', variable)
+        key = max(re.findall(r'\w+', literal), key = len)
+        return cls(RE_ASSIGNMENT(variable, value), key)
+
+    def substitute(self, line, value):
+        return self.regex.sub(lambda m: '%s"%s"' % (m.group(1), value), line)
+
+
+class SubstitutionRules(object):
+    """Named substitution rules applied to a whole file in one pass.
+
+    A line reaches the regexes only if it contains the key of one of the
+    rules, which is found by a single scan of the line.
+    """
+
+    def __init__(self, **rules):
+        self.rules = rules
+        keys = sorted(set(r.key for r in rules.values()), key = len,
+                      reverse = True)
+        self._prefilter = re.compile('|'.join(re.escape(k) for k in keys))
+
+    def candidates(self, lines):
+        """Indexes of the lines containing the key of a rule."""
+        search = self._prefilter.search
+        return [i for i, line in enumerate(lines) if search(line) is not None]
+
+    def changes(self, lines, candidates, values):
+        """Returns the substituted lines which changed by index. The value
+        of every rule named in values is substituted, rules with a None
+        value are skipped."""
+        active = [(self.rules[name], value) for name, value in values.items()
+                  if value is not None]
+        changed = {}
+        for i in candidates:
+            line = lines[i]
+            for rule, value in active:
+                if rule.key in line:
+                    line = rule.substitute(line, value)
+            if line != lines[i]:
+                changed[i] = line
+
+        return changed
+
+    def apply(self, lines, **values):
+        """Returns the text of lines with the values substituted."""
+        lines = list(lines)
+        for i, line in self.changes(lines, self.candidates(lines),
+                                    values).items():
+            lines[i] = line
+
+        return ''.join(lines)
+
+
+class ConfigFile(object):
+    """Content of a file split in lines. The lines which are candidates
+    of a set of substitution rules and the parsed libconfig document
+    are remembered."""
+
+    def __init__(self, content, key):
+        self.content = content
+        self.lines = content.splitlines(True)
+        self.key = key
+        self._candidates = {}
+        self._document = None
+
+    def libconfig(self):
+        if self._document is None:
+            self._document = libconfig.parse(self.content)
+        return self._document
+
+    def candidates(self, rules):
+        candidates = self._candidates.get(rules)
+        if candidates is None:
+            candidates = rules.candidates(self.lines)
+            self._candidates[rules] = candidates
+        return candidates
+
+
+class ConfigFileCache(object):
+    """Keeps the files read until they change on disk, which is told by
+    their modification time, size and inode."""
 
     def __init__(self):
-        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger = logging.getLogger(ConfigFileCache.__name__)
+        self._lock = threading.Lock()
+        self._files = {}
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self, path):
+        """The ConfigFile of path, read again only if it has changed."""
+        # Stated before reading, a change while reading makes the next
+        # call read it again.
+        key = self._key(path)
+        with self._lock:
+            config_file = self._files.get(path)
+        if config_file is not None and config_file.key == key:
+            return config_file
+
+        self.logger.debug('Reading %s', path)
+        with open(path) as f:
+            config_file = ConfigFile(f.read(), key)
+        with self._lock:
+            self._files[path] = config_file
+        return config_file
+
+    def update(self, path, content):
+        """Keeps content just written to path."""
+        config_file = ConfigFile(content, self._key(path))
+        with self._lock:
+            self._files[path] = config_file
+        return config_file
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+
+CONFIG_FILES = ConfigFileCache()
 
-    def write_out(self, content, file_path):
-        os_fd, tmp_file = tempfile.mkstemp()
-        os.close(os_fd)
 
-        with open(tmp_file, 'w') as f:
-            f.write(content)
+class ConfiguratorHelpers(object):
 
-        backup_path = '%s.%s.back' % (file_path, int(time.time()))
-        shutil.copy(file_path, backup_path)
-        shutil.copy(tmp_file, file_path)
-        shutil.copymode(backup_path, file_path)
+    def __init__(self, config_files = None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if config_files is None:
+            config_files = CONFIG_FILES
+        self._config_files = config_files
+
+    def write_out(self, content, file_path, current = None):
+        """Writes content to file_path keeping a backup of it. Returns
+        False without writing if the file has the same content, current
+        is its content if it was read already."""
+        if current is None:
+            current = self._config_files.get(file_path).content
+        if current == content:
+            self.logger.debug('File %s is unchanged', file_path)
+            return False
 
-        os.remove(tmp_file)
+        cache_path = file_path
+
+        # The file is replaced by a new one written next to it, so it is
+        # never seen half written. A link of the replaced file is the
+        # backup, the content is not copied.
+        file_path = os.path.realpath(file_path)
+        dir_path = os.path.dirname(file_path)
+        st = os.stat(file_path)
+        os_fd, tmp_file = tempfile.mkstemp(
+            dir = dir_path, prefix = '.%s.' % os.path.basename(file_path))
+        try:
+            with os.fdopen(os_fd, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            self._copyOwnership(st, tmp_file)
+
+            backup_path = '%s.%s.back' % (file_path, int(time.time()))
+            linked = self._backup(file_path, backup_path)
+            try:
+                os.replace(tmp_file, file_path)
+            except OSError as e:
+                if e.errno not in (errno.EBUSY, errno.EXDEV):
+                    raise
+                # Bind mounted files, like /etc/hosts of containers, can
+                # not be replaced, they are overwritten in place.
+                self.logger.debug('Unable to replace %s (%s), overwriting it',
+                                  file_path, e)
+                if linked:
+                    # A link would be overwritten too
+                    os.remove(backup_path)
+                    shutil.copy2(file_path, backup_path)
+                with open(tmp_file, 'rb') as src, open(file_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(tmp_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+        self._fsyncDirectory(dir_path)
+        self._config_files.update(cache_path, content)
+        return True
+
+    def _backup(self, file_path, backup_path):
+        """Keeps the content of file_path in backup_path, as a link of it
+        if possible. Returns whether it is a link."""
+        if os.path.lexists(backup_path):
+            os.remove(backup_path)
+        try:
+            os.link(file_path, backup_path)
+            return True
+        except OSError as e:
+            # e.g. file systems without hard links or protected_hardlinks
+            self.logger.debug('Unable to link %s (%s), copying it',
+                              file_path, e)
+            shutil.copy2(file_path, backup_path)
+            return False
 
-    def sed_it(self, regex, sub):
-        self._current_line =  re.sub(regex, r'\1"%s"' % sub, self._current_line)
-        return self._current_line
+    def _copyOwnership(self, st, path):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+        tmp_st = os.stat(path)
+        if (tmp_st.st_uid, tmp_st.st_gid) == (st.st_uid, st.st_gid):
+            return
+        try:
+            os.chown(path, st.st_uid, st.st_gid)
+        except PermissionError:
+            self.logger.warning('Unable to set owner %d:%d of %s',
+                                st.st_uid, st.st_gid, path)
+
+    @staticmethod
+    def _fsyncDirectory(dir_path):
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def substitute(self, rules, file_path, **values):
+        """Returns False if the rules did not change the file."""
+        config_file = self._config_files.get(file_path)
+        changed = rules.changes(config_file.lines,
+                                config_file.candidates(rules), values)
+        if len(changed) == 0:
+            self.logger.debug('File %s is unchanged', file_path)
+            return False
+
+        lines = list(config_file.lines)
+        for i, line in changed.items():
+            lines[i] = line
+        return self.write_out(''.join(lines), file_path, config_file.content)
+
+    def set_settings(self, settings, file_path, **values):
+        """Sets the settings of a libconfig file, settings maps the
+        keywords to the paths of the settings, like
+        'MME.NETWORK_INTERFACES.MME_IPV4_ADDRESS_FOR_S1_MME'. None values
+        are skipped. Returns False if the file did not change, raises
+        libconfig.ParseError if the file is not valid."""
+        config_file = self._config_files.get(file_path)
+        document = config_file.libconfig()
+        changes = {}
+        for name, value in values.items():
+            if value is None:
+                continue
+            path = settings[name]
+            if path not in document:
+                self.logger.warning('Setting %s is not found in %s',
+                                    path, file_path)
+            elif document.get(path) != value:
+                changes[path] = value
+
+        if len(changes) == 0:
+            self.logger.debug('File %s is unchanged', file_path)
+            return False
+
+        return self.write_out(document.render(changes), file_path,
+                              config_file.content)
 
     def ip(self, masked_ip):
         return masked_ip.split('/')[0] if masked_ip is not None else None
@@ -75,10 +363,55 @@ class CommandConfig(object):
     RESTART = 3
     STATUS = 4
 
-    def __init__(self, command = None, **kwargs):
+    TAIL = 5
+    METRICS = 6
+    SEARCH = 7
+
+    def __init__(self, command = None, since = None, stream = None,
+                 pattern = None, wait_ready = False, until = None,
+                 context = 0, max_matches = None, logs = False,
+                 log_file = None, **kwargs):
         self.command = command
+        self.wait_ready = wait_ready
+        self.since = since
+        self.until = until
+        self.context = context
+        self.max_matches = max_matches
+        self.logs = logs
+        self.log_file = log_file
+        self.stream = stream
+        self.pattern = pattern
         super(CommandConfig, self).__init__(**kwargs)
 
+    # Commands only reading the state of the task
+    QUERIES = (STATUS, TAIL, METRICS, SEARCH)
+
+
+def query(runner, config):
+    """Result of a query command of config about the task of runner."""
+    if config.command == CommandConfig.STATUS:
+        status = 'Running' if runner.isRunning() else 'Stopped'
+        stdout, stderr, cursor = runner.getOutputSince(config.since)
+        return P.Result.ok('Status', task_status = status,
+                           stderr = stderr, stdout = stdout,
+                           cursor = cursor,
+                           stderr_stats = runner.getOutputStats(stderr=True),
+                           stdout_stats = runner.getOutputStats(),
+                           supervision = runner.getSupervision(),
+                           readiness = runner.getReadiness())
+    elif config.command == CommandConfig.METRICS:
+        return P.Result.ok('Metrics', metrics = runner.getMetrics())
+    elif config.command == CommandConfig.TAIL:
+        return runner.tail(config.stream, config.pattern)
+    elif config.command == CommandConfig.SEARCH:
+        return runner.search(config.pattern, stream = config.stream,
+                             since = config.since, until = config.until,
+                             context = config.context,
+                             max_matches = config.max_matches,
+                             logs = config.logs,
+                             log_file = config.log_file)
+    return P.Result.fail('Invalid query: %s', config.command)
+
 
 class CommandMessageParser(object):
 
@@ -87,17 +420,55 @@ class CommandMessageParser(object):
     MSG_COMMAND_STOP = 'stop'
     MSG_COMMAND_RESTART = 'restart'
     MSG_COMMAND_STATUS = 'status'
+    MSG_COMMAND_TAIL = 'tail'
+    MSG_COMMAND_METRICS = 'metrics'
+    MSG_COMMAND_SEARCH = 'search'
+    # Cursor returned by a previous status, only newer output is returned
+    MSG_SINCE = 'since'
+    # Search: last line searched, number of context lines around a match,
+    # maximum number of matches, searching the log files and the log file
+    # since and until count the lines of
+    MSG_UNTIL = 'until'
+    MSG_CONTEXT = 'context'
+    MSG_MAX_MATCHES = 'max_matches'
+    MSG_LOGS = 'logs'
+    MSG_LOG_FILE = 'log_file'
+    # Filters of tail: output stream (stdout or stderr) and regex
+    MSG_STREAM = 'stream'
+    MSG_PATTERN = 'pattern'
+    # Start and restart reply once the task is ready
+    MSG_WAIT_READY = 'wait_ready'
     MSG_COMMANDS = {
         MSG_COMMAND_START: CommandConfig.START,
         MSG_COMMAND_STOP: CommandConfig.STOP,
         MSG_COMMAND_RESTART: CommandConfig.RESTART,
-        MSG_COMMAND_STATUS: CommandConfig.STATUS
+        MSG_COMMAND_STATUS: CommandConfig.STATUS,
+        MSG_COMMAND_TAIL: CommandConfig.TAIL,
+        MSG_COMMAND_METRICS: CommandConfig.METRICS,
+        MSG_COMMAND_SEARCH: CommandConfig.SEARCH
     }
 
+    # Fields of a message running a query
+    QUERY_FIELDS = {MSG_COMMAND, MSG_SINCE, MSG_UNTIL, MSG_CONTEXT,
+                    MSG_MAX_MATCHES, MSG_LOGS, MSG_LOG_FILE, MSG_STREAM,
+                    MSG_PATTERN, JsonMsgReader.MSG_ID,
+                    JsonMsgReader.MSG_TARGET}
+
     def __init__(self, json_dict = None):
         self.logger = logging.getLogger(CommandMessageParser.__name__)
         self.msg_dict = json_dict
 
+    @classmethod
+    def isQuery(cls, json_dict):
+        """Whether json_dict runs a query command and has nothing to
+        configure."""
+        if not isinstance(json_dict, dict) or \
+                not isinstance(json_dict.get(cls.MSG_COMMAND), str):
+            return False
+        command = cls.MSG_COMMANDS.get(json_dict[cls.MSG_COMMAND])
+        return command in CommandConfig.QUERIES and \
+            set(json_dict.keys()) <= cls.QUERY_FIELDS
+
     def parse(self, command_config = None):
         if command_config is None:
             cc = CommandConfig()
@@ -112,6 +483,39 @@ class CommandMessageParser(object):
                 cc.command = self.MSG_COMMANDS[cmd]
             self.logger.info('Got command: %s' % cc.command)
 
+        for key, attr, minimum in [(self.MSG_SINCE, 'since', 0),
+                                   (self.MSG_UNTIL, 'until', 0),
+                                   (self.MSG_CONTEXT, 'context', 0),
+                                   (self.MSG_MAX_MATCHES, 'max_matches', 1)]:
+            if key in self.msg_dict:
+                value = self.msg_dict[key]
+                if type(value) is not int or value < minimum:
+                    self.logger.warning('Got invalid %s: %s', key, value)
+                else:
+                    setattr(cc, attr, value)
+                    self.logger.info('Got %s: %d', key, value)
+
+        for key, attr in [(self.MSG_STREAM, 'stream'),
+                          (self.MSG_PATTERN, 'pattern'),
+                          (self.MSG_LOG_FILE, 'log_file')]:
+            if key in self.msg_dict:
+                value = self.msg_dict[key]
+                if type(value) is not str:
+                    self.logger.warning('Got invalid %s: %s', key, value)
+                else:
+                    setattr(cc, attr, value)
+                    self.logger.info('Got %s: %s', key, value)
+
+        for key, attr in [(self.MSG_WAIT_READY, 'wait_ready'),
+                          (self.MSG_LOGS, 'logs')]:
+            if key in self.msg_dict:
+                value = self.msg_dict[key]
+                if type(value) is not bool:
+                    self.logger.warning('Got invalid %s: %s', key, value)
+                else:
+                    setattr(cc, attr, value)
+                    self.logger.info('Got %s: %s', key, value)
+
         return cc
 
 
@@ -215,29 +619,29 @@ class HostConfigurator(ConfiguratorHelpers):
         if not config_mme and not config_hss:
             return self.warn('No host name and IP given for HSS amd MME')
 
-        new_content = ""
-        with open(self._host_file_path, 'r') as f:
-            for line in f:
-                self._current_line = line
-                if config_mme and (mme_host in line or mme_ip in line):
-                    self._current_line = '%s %s\n' % (mme_ip, mme_host)
-                    config_mme = False
+        host_file = self._config_files.get(self._host_file_path)
+        new_content = []
+        for line in host_file.lines:
+            if config_mme and (mme_host in line or mme_ip in line):
+                line = '%s %s\n' % (mme_ip, mme_host)
+                config_mme = False
 
-                if config_hss and (hss_host in line or hss_ip in line):
-                    self._current_line = '%s %s\n' % (hss_ip, hss_host)
-                    config_hss = False
+            if config_hss and (hss_host in line or hss_ip in line):
+                line = '%s %s\n' % (hss_ip, hss_host)
+                config_hss = False
 
-                new_content += self._current_line
+            new_content.append(line)
 
         if config_mme:
-            new_content += '%s %s\n' % (mme_ip, mme_host)
+            new_content.append('%s %s\n' % (mme_ip, mme_host))
 
         if config_hss:
-            new_content += '%s %s\n' % (hss_ip, hss_host)
+            new_content.append('%s %s\n' % (hss_ip, hss_host))
 
-        self.write_out(new_content, self._host_file_path)
+        written = self.write_out(''.join(new_content), self._host_file_path,
+                                 host_file.content)
 
-        return self.ok('Host file is configured')
+        return self.ok('Host file is configured', unchanged = not written)
 
 
 class CertificateConfigurator(ConfiguratorHelpers):
@@ -279,154 +683,1211 @@ class CertificateConfigurator(ConfiguratorHelpers):
         return self.ok('Certificates are configured')
 
 
-class Runner(object):
+class OutputBuffer(object):
+    """Keeps the last lines of an output, at most max_size bytes of them
+    in UTF-8.
+
+    Older lines are dropped once the limit is reached, a single line
+    longer than the limit is truncated to its end, without splitting a
+    character. Besides the lines it
+    counts how many lines and bytes were seen and dropped.
+
+    Every line gets a number from sequence, so readers can ask for the
+    lines after the last one they saw. Buffers sharing a sequence have to
+    share their lock too, so the lines are numbered in order.
+    """
+
+    def __init__(self, max_size, sequence = None, lock = None):
+        self.max_size = max_size
+        self._sequence = sequence if sequence is not None \
+                else itertools.count(1)
+        self._lines = collections.deque()
+        self._size = 0
+        self._lock = lock if lock is not None else threading.Lock()
+        self._listeners = []
+        self.last_seq = 0
+        self.lines_seen = 0
+        self.bytes_seen = 0
+        self.lines_dropped = 0
+        self.bytes_dropped = 0
+
+    def append(self, line, size = None):
+        if size is None:
+            size = len(line.encode())
+
+        with self._lock:
+            self.lines_seen += 1
+            self.bytes_seen += size
+
+            if size > self.max_size:
+                data = line.encode()[-self.max_size:]
+                line = data.decode(errors = 'ignore')
+                self.bytes_dropped += size - len(line.encode())
+                size = len(line.encode())
+
+            self.last_seq = seq = next(self._sequence)
+            self._lines.append((seq, line, size))
+            self._size += size
+            while self._size > self.max_size:
+                _, _, dropped_size = self._lines.popleft()
+                self._size -= dropped_size
+                self.lines_dropped += 1
+                self.bytes_dropped += dropped_size
+
+            listeners = self._listeners
+
+        for listener in listeners:
+            listener(seq, line)
+
+    def subscribe(self, listener):
+        """listener is called with the number and the text of every new
+        line, on the thread appending it."""
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l != listener]
+
+    def clear(self):
+        with self._lock:
+            self._lines.clear()
+            self._size = 0
+            self.lines_seen = self.bytes_seen = 0
+            self.lines_dropped = self.bytes_dropped = 0
+
+    def getvalue(self, since = None, until = None):
+        """Text of the lines with a sequence number after since and up
+        to until, all kept lines without them. Only the returned lines
+        are visited, from the newest one backwards."""
+        with self._lock:
+            if since is None and until is None:
+                return ''.join(line for _, line, _ in self._lines)
+
+        return ''.join(line for _, line in self.lines(since, until))
+
+    def lines(self, since = None, until = None):
+        """List of the numbers and texts of the lines in (since, until]."""
+        with self._lock:
+            lines = []
+            for seq, line, _ in reversed(self._lines):
+                if since is not None and seq <= since:
+                    break
+                if until is None or seq <= until:
+                    lines.append((seq, line))
+
+            lines.reverse()
+            return lines
+
+    def stats(self):
+        with self._lock:
+            return { 'lines_seen': self.lines_seen,
+                     'bytes_seen': self.bytes_seen,
+                     'lines_dropped': self.lines_dropped,
+                     'bytes_dropped': self.bytes_dropped,
+                     'buffered_lines': len(self._lines),
+                     'buffered_bytes': self._size }
+
+    def __len__(self):
+        return self._size
+
+
+class OutputSearch(object):
+    """Collects the lines matching a regex with up to context lines
+    before and after each of them. Once max_matches lines are found the
+    search is truncated. The context is carried over from one searched
+    part of the lines to the next, like the segments of a log file."""
+
+    def __init__(self, regex, context = 0, max_matches = 100):
+        self.regex = regex
+        self.context = context
+        self.max_matches = max_matches
+        self.matches = []
+        self.truncated = False
+        self._before = collections.deque(maxlen = context)
+        self._collecting = []
+
+    def search(self, lines, key, **fields):
+        """Searches the (number, text) pairs of lines. A match holds the
+        number under key and fields. Returns False once truncated."""
+        before = self._before
+        for number, line in lines:
+            if len(self._collecting) > 0:
+                for match in self._collecting:
+                    match['after'].append(line)
+                self._collecting = [m for m in self._collecting
+                                    if len(m['after']) < self.context]
+
+            if self.regex.search(line) is not None:
+                if len(self.matches) >= self.max_matches:
+                    self.truncated = True
+                    if len(self._collecting) == 0:
+                        break
+                else:
+                    match = dict(fields, line = line, before = list(before),
+                                 after = [])
+                    match[key] = number
+                    self.matches.append(match)
+                    if self.context > 0:
+                        self._collecting.append(match)
+
+            before.append(line)
+
+        return not self.truncated
+
+
+class OutputSubscription(P.Subscription):
+    """Pushes the new output lines of a Runner, optionally only of one
+    stream or the ones matching a regex."""
+
+    def __init__(self, buffers, pattern, result):
+        self._buffers = buffers
+        self._pattern = pattern
+        self._listeners = []
+        super(OutputSubscription, self).__init__(result)
+
+    def start(self, push):
+        for name, buf in self._buffers:
+            def listener(seq, line, stream = name):
+                if self._pattern is None or self._pattern.search(line):
+                    push({ 'stream': stream, 'seq': seq, 'line': line })
+
+            buf.subscribe(listener)
+            self._listeners.append((buf, listener))
+
+    def stop(self):
+        listeners, self._listeners = self._listeners, []
+        for buf, listener in listeners:
+            buf.unsubscribe(listener)
 
-    def __init__(self, executable, log_dir=None, start_shell=False):
+
+class MetricsRing(object):
+    """Fixed size history of resource samples.
+
+    Every field is kept in its own preallocated array of doubles, new
+    samples overwrite the oldest ones once the ring is full.
+    """
+
+    FIELDS = ('time', 'cpu_percent', 'rss', 'num_fds', 'num_threads',
+              'ctx_switches')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._columns = { f: array.array('d', [0.0]) * capacity
+                          for f in self.FIELDS }
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def append(self, **sample):
+        if self.capacity < 1:
+            return
+
+        with self._lock:
+            for f in self.FIELDS:
+                self._columns[f][self._next] = sample.get(f, 0.0)
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def samples(self):
+        """Returns the samples from the oldest one as a list per field."""
+        with self._lock:
+            start = (self._next - self._count) % self.capacity \
+                    if self.capacity > 0 else 0
+            result = {}
+            for f in self.FIELDS:
+                column = self._columns[f]
+                values = column[start:start + self._count]
+                if start + self._count > self.capacity:
+                    values += column[:self._next]
+                result[f] = values.tolist()
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._next = 0
+            self._count = 0
+
+    def __len__(self):
+        return self._count
+
+
+class RotatingLogFile(object):
+    """Log file written in batches and rotated by size.
+
+    Writes are buffered and flushed once FLUSH_SIZE bytes are pending or
+    FLUSH_INTERVAL seconds after the first pending write. Once the file
+    reaches max_size it is renamed to <path>.1 and gzip compressed to
+    <path>.1.gz in a thread, older segments are shifted up to
+    <path>.<backups>.gz and dropped after it.
+
+    The compression may outlive the instance, e.g. when a restarted task
+    reopens its log file, so it is kept per path and a rotation of the
+    same path waits until it is done.
+    """
+
+    FLUSH_SIZE = 64 * 1024
+    FLUSH_INTERVAL = 1.0
+    MAX_SIZE = 10 * 1024 * 1024
+    BACKUPS = 5
+
+    # Absolute path -> Deferred of the compression of its last segment
+    _compressing = {}
+
+    def __init__(self, path, max_size = MAX_SIZE, backups = BACKUPS):
+        self.logger = logging.getLogger(RotatingLogFile.__name__)
+        self.path = path
+        self._key = os.path.abspath(path)
+        self.max_size = max_size
+        self.backups = backups
+        self._file = open(path, 'ab')
+        self._size = self._file.tell()
+        self._pending = []
+        self._pending_size = 0
+        self._flush_call = None
+
+    def write(self, text):
+        data = text.encode()
+        self._pending.append(data)
+        self._pending_size += len(data)
+
+        if self._pending_size >= self.FLUSH_SIZE:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.FLUSH_INTERVAL,
+                                                 self.flush)
+
+    def flush(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        if self._pending_size > 0:
+            self._file.write(b''.join(self._pending))
+            self._file.flush()
+            self._size += self._pending_size
+            self._pending = []
+            self._pending_size = 0
+
+        # A rotation waits until the previous segment is compressed
+        if self._size >= self.max_size and \
+                self._key not in self._compressing:
+            self._rotate()
+
+    def _rotate(self):
+        self.logger.info('Rotating log file %s (%d bytes)', self.path,
+                         self._size)
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            segment = '%s.%d.gz' % (self.path, i)
+            if os.path.exists(segment):
+                os.replace(segment, '%s.%d.gz' % (self.path, i + 1))
+
+        segment = '%s.1' % self.path
+        os.replace(self.path, segment)
+        self._file = open(self.path, 'ab')
+        self._size = 0
+
+        if self.backups < 1:
+            os.remove(segment)
+            return
+
+        def failed(failure):
+            self.logger.error('Unable to compress %s: %s', segment,
+                              failure.getErrorMessage())
+
+        def done(_):
+            del self._compressing[self._key]
+
+        d = threads.deferToThread(self._compress, segment)
+        self._compressing[self._key] = d
+        d.addErrback(failed)
+        d.addBoth(done)
+
+    @staticmethod
+    def _compress(segment):
+        with open(segment, 'rb') as src, \
+                gzip.open(segment + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(segment)
+
+    @staticmethod
+    def segments(path, backups = BACKUPS):
+        """The existing segments of the log file at path, oldest first."""
+        paths = ['%s.%d.gz' % (path, i) for i in range(backups, 0, -1)]
+        paths += ['%s.1' % path, path]
+        return [p for p in paths if os.path.exists(p)]
+
+    def close(self):
+        """Flushes and closes the file. Returns a Deferred firing once the
+        last rotated segment is compressed."""
+        self.flush()
+        self._file.close()
+
+        compressing = self._compressing.get(self._key)
+        if compressing is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        compressing.addBoth(lambda r: d.callback(None))
+        return d
+
+
+class ReadinessProbe(object):
+    """Tells whether a started task is ready: a regex matched a line of
+    its output, a TCP or SCTP port is listened on or a file exists. All
+    of the configured conditions have to be met."""
+
+    TCP_SOCKETS = ['/proc/net/tcp', '/proc/net/tcp6']
+    TCP_LISTEN = '0A'
+    SCTP_ENDPOINTS = '/proc/net/sctp/eps'
+
+    def __init__(self, pattern=None, port=None, path=None):
+        try:
+            self.pattern = re.compile(pattern) if pattern is not None else None
+        except re.error as e:
+            raise ValueError('Invalid readiness pattern: %s' % e)
+        self.port = port
+        self.path = os.path.expanduser(path) if path is not None else None
+        self.reset()
+
+    def isConfigured(self):
+        return self.pattern is not None or self.port is not None \
+            or self.path is not None
+
+    def isPolled(self):
+        return self.port is not None or self.path is not None
+
+    def reset(self):
+        self._matched = self.pattern is None
+
+    def match(self, line):
+        if not self._matched and self.pattern.search(line) is not None:
+            self._matched = True
+        return self._matched
+
+    def check(self):
+        if not self._matched:
+            return False
+        if self.path is not None and not os.path.exists(self.path):
+            return False
+        if self.port is not None and self.port not in self.listeningPorts():
+            return False
+        return True
+
+    @classmethod
+    def listeningPorts(cls):
+        ports = set()
+        for path in cls.TCP_SOCKETS:
+            try:
+                with open(path) as f:
+                    next(f)
+                    for line in f:
+                        fields = line.split()
+                        if fields[3] == cls.TCP_LISTEN:
+                            ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+            except (IOError, StopIteration):
+                pass
+
+        try:
+            with open(cls.SCTP_ENDPOINTS) as f:
+                next(f)
+                for line in f:
+                    ports.add(int(line.split()[5]))
+        except (IOError, StopIteration):
+            pass
+
+        return ports
+
+
+class RunnerProtocol(ProcessProtocol):
+    """Collects the output of a task started by Runner.
+
+    Output is read in chunks as it arrives and split into lines in bulk.
+    The chunks of an incomplete last line are kept until the rest of it
+    arrives or the task exits. A line growing past max_line bytes is
+    passed on in parts, so output without newlines is not kept in memory.
+    """
+
+    def __init__(self, runner, log_files, max_line = None):
+        self.logger = logging.getLogger(RunnerProtocol.__name__)
+        self._runner = runner
+        self._log_files = log_files
+        self._max_line = max_line
+        self._partial = {1: [], 2: []}
+        self._partial_size = {1: 0, 2: 0}
+
+    def childDataReceived(self, std, data):
+        if std not in self._partial:
+            self.logger.warning('Invalid output descriptor: %d', std)
+            return
+
+        end = data.rfind(b'\n') + 1
+        if end > 0:
+            partial = self._partial[std]
+            partial.append(data[:end])
+            self._lines(std, b''.join(partial))
+            del partial[:]
+            self._partial_size[std] = 0
+            data = data[end:]
+
+        if len(data) > 0:
+            self._partial[std].append(data)
+            self._partial_size[std] += len(data)
+            if self._max_line is not None and \
+                    self._partial_size[std] > self._max_line:
+                self._flushPartial(std)
+
+    def _flushPartial(self, std):
+        partial = self._partial[std]
+        if len(partial) > 0:
+            self._lines(std, b''.join(partial))
+        del partial[:]
+        self._partial_size[std] = 0
+
+    def _lines(self, std, data):
+        try:
+            lines = data.decode().splitlines(True)
+        except UnicodeDecodeError:
+            lines = []
+            for line in data.splitlines(True):
+                try:
+                    lines.append(line.decode())
+                except UnicodeDecodeError:
+                    self.logger.warning('Invalid characters on output %d: %s',
+                                        std, line.hex())
+
+        self._runner._appendOutput(std, lines)
+        if self._log_files.get(std) is not None:
+            self._log_files[std].write(''.join(lines))
+
+    def processEnded(self, reason):
+        for std in self._partial:
+            self._flushPartial(std)
+
+        for log_file in self._log_files.values():
+            if log_file is not None:
+                log_file.close()
+
+        self._runner._ended(reason)
+
+
+class Runner(object):
+    """Starts and stops a task and keeps its output.
+
+    The task is managed by the reactor, so the reactor has to run for the
+    output to be read and the exit to be noticed. The methods may be
+    called from any thread: from other threads they wait for the reactor
+    to do the work, on the reactor's thread stop() returns a Deferred.
+    Waiting for the task to get ready is left to the reactor, other
+    threads get a pending result of it.
+    """
+
+    STREAMS = {'stdout': 1, 'stderr': 2}
+
+    # Bytes of output kept per standard output
+    OUTPUT_BUFFER_SIZE = 1024 * 1024
+    LOG_MAX_SIZE = RotatingLogFile.MAX_SIZE
+    LOG_BACKUPS = RotatingLogFile.BACKUPS
+    # Seconds to wait for the task to exit after SIGTERM before SIGKILL
+    STOP_TIMEOUT = 5.0
+    WAIT_INTERVAL = 0.1
+    # Seconds between resource samples of the task's process tree (0 turns
+    # sampling off) and the number of samples kept
+    SAMPLE_INTERVAL = 5.0
+    SAMPLE_HISTORY = 720
+    # A supervised task exiting without being stopped is restarted after a
+    # delay doubling from RESTART_BACKOFF up to RESTART_BACKOFF_MAX seconds.
+    # CRASH_LOOP_RESTARTS restarts within CRASH_LOOP_WINDOW seconds make a
+    # crash loop, the task is left stopped then.
+    RESTART_BACKOFF = 1.0
+    RESTART_BACKOFF_MAX = 60.0
+    CRASH_LOOP_RESTARTS = 5
+    CRASH_LOOP_WINDOW = 300.0
+    # Number of restart times reported
+    RESTART_HISTORY = 10
+    # Seconds a started task has to get ready and between two checks of
+    # the port and file readiness probes
+    READY_TIMEOUT = 60.0
+    READY_INTERVAL = 0.2
+    # Matching lines returned by a search at most
+    SEARCH_MAX_MATCHES = 100
+    # Types of the options of from_options
+    OPTION_TYPES = {'start_shell': to_bool,
+                    'output_buffer_size': int,
+                    'log_max_size': int,
+                    'log_backups': int,
+                    'stop_timeout': float,
+                    'sample_interval': float,
+                    'sample_history': int,
+                    'supervise': to_bool,
+                    'restart_backoff': float,
+                    'restart_backoff_max': float,
+                    'crash_loop_restarts': int,
+                    'crash_loop_window': float,
+                    'ready_pattern': str,
+                    'ready_port': int,
+                    'ready_file': str,
+                    'ready_timeout': float}
+
+    def __init__(self, executable, log_dir=None, start_shell=False,
+                 output_buffer_size=OUTPUT_BUFFER_SIZE,
+                 log_max_size=LOG_MAX_SIZE, log_backups=LOG_BACKUPS,
+                 stop_timeout=STOP_TIMEOUT,
+                 sample_interval=SAMPLE_INTERVAL,
+                 sample_history=SAMPLE_HISTORY,
+                 supervise=False,
+                 restart_backoff=RESTART_BACKOFF,
+                 restart_backoff_max=RESTART_BACKOFF_MAX,
+                 crash_loop_restarts=CRASH_LOOP_RESTARTS,
+                 crash_loop_window=CRASH_LOOP_WINDOW,
+                 ready_pattern=None, ready_port=None, ready_file=None,
+                 ready_timeout=READY_TIMEOUT):
         self.logger = logging.getLogger(Runner.__name__)
         self._executable = os.path.expanduser(executable)
-        self._task = None
+        self._process = None
+        self._running = False
+        self._returncode = None
+        self._waiters = []
+        self._stopping = None
+        self._stop_timeout = stop_timeout
+        self._killed_task = 0
         self._isShell = start_shell
-        self._std_contents = {1: "", 2: ""}
+        # Lines of both outputs are numbered by one sequence, which is not
+        # reset on restart, so a single cursor covers stdout and stderr.
+        self._sequence = itertools.count(1)
+        self._output_lock = threading.Lock()
+        self._std_contents = {1: OutputBuffer(output_buffer_size,
+                                              self._sequence,
+                                              self._output_lock),
+                              2: OutputBuffer(output_buffer_size,
+                                              self._sequence,
+                                              self._output_lock)}
         self._log_dir = log_dir
-
-    def start(self):
-        if self._task is not None:
+        self._log_max_size = log_max_size
+        self._log_backups = log_backups
+        self._metrics = MetricsRing(sample_history)
+        self._sample_interval = sample_interval
+        self._sampler = task.LoopingCall(self._sample)
+        # PID -> psutil.Process, CPU usage is measured between two calls
+        # on the same object
+        self._sampled = {}
+        self._supervise = supervise
+        self._restart_backoff = restart_backoff
+        self._restart_backoff_max = restart_backoff_max
+        self._crash_loop_restarts = crash_loop_restarts
+        self._crash_loop_window = crash_loop_window
+        self._restart_call = None
+        self._restart_count = 0
+        self._restart_history = collections.deque(maxlen=self.RESTART_HISTORY)
+        # Restarts within the crash loop window
+        self._recent_restarts = collections.deque()
+        self._crash_loop = False
+        self._last_exit = None
+        self._probe = ReadinessProbe(ready_pattern, ready_port, ready_file)
+        self._ready_timeout = ready_timeout
+        self._prober = task.LoopingCall(self._checkReady)
+        self._ready_call = None
+        self._ready_waiters = []
+        # Result of the readiness of the current run, None while pending
+        self._ready_result = None
+        self._ready_time = None
+        self._started = None
+        self._tmp_log_dir = None
+
+    @classmethod
+    def from_options(cls, executable, prefix, log_dir=None, **options):
+        """Runner of executable with options as they are given to a
+        processor, values read from configuration files are converted to
+        their types. Without log_dir the logs are written to a temporary
+        directory named with prefix, which is removed on exit."""
+        for name, value in options.items():
+            if name in cls.OPTION_TYPES and value is not None:
+                options[name] = cls.OPTION_TYPES[name](value)
+
+        tmp_log_dir = None
+        if log_dir is None:
+            tmp_log_dir = tempfile.TemporaryDirectory(prefix=prefix)
+            log_dir = tmp_log_dir.name
+        else:
+            os.makedirs(log_dir, exist_ok=True)
+
+        runner = cls(executable, log_dir=log_dir, **options)
+        runner._tmp_log_dir = tmp_log_dir
+        return runner
+
+    def _inReactor(self, f, *args):
+        if not reactor.running or threadable.isInIOThread():
+            return f(*args)
+        return threads.blockingCallFromThread(reactor, f, *args)
+
+    def start(self, wait_ready=False):
+        """Starts the task. With wait_ready the result is given once the
+        task is ready, or it failed to get ready."""
+        return self._readyResult(self._inReactor(self._start), wait_ready)
+
+    def _readyResult(self, result, wait_ready):
+        if isinstance(result, defer.Deferred):
+            return result.addCallback(self._readyResult, wait_ready)
+        if not wait_ready or result.status != P.Result.OK:
+            return result
+        if not reactor.running or threadable.isInIOThread():
+            return self.whenReady()
+        # Other threads are not kept waiting for up to the ready timeout,
+        # they get the readiness as a pending result
+        return threads.blockingCallFromThread(
+            reactor, lambda: P.Pending(self.whenReady()))
+
+    def _start(self, supervised=False):
+        # A task which exited on its own can be started again without
+        # being stopped first
+        if self._running or self._stopping is not None:
             return P.Result.fail('Unable to start task %s, '
                                  'it\'s already started', self._executable)
 
-        self.logger.debug("Starting task %s", self._executable)
-        self._task = subprocess.Popen(self._executable,
-                                      stdin = subprocess.PIPE,
-                                      stdout = subprocess.PIPE,
-                                      stderr = subprocess.PIPE,
-                                      shell = self._isShell,
-                                      bufsize = 0)
-
-        self.logger.debug("Starting IO threads")
-        self._std_contents[1] = ""
-        self._std_contents[2] = ""
-        self._stdout_thread = threading.Thread(target=self._getOutput,
-                                               args=[1, self._log_dir])
-        self._stderr_thread = threading.Thread(target=self._getOutput,
-                                               args=[2, self._log_dir])
-        self._stdout_thread.start()
-        self._stderr_thread.start()
+        if self._isShell:
+            args = ['/bin/sh', '-c', self._executable]
+        else:
+            args = [self._executable]
+
+        executable = shutil.which(args[0])
+        if executable is None:
+            return P.Result.fail('Unable to start task %s, '
+                                 'executable is not found', self._executable)
 
+        self.logger.debug("Starting task %s", self._executable)
+        if not supervised:
+            # Starting by hand replaces a pending restart and gives the
+            # task a new chance after a crash loop. The output of a
+            # crashed run is kept over supervised restarts, the sequence
+            # numbers tell the runs apart.
+            self._cancelRestart()
+            self._recent_restarts.clear()
+            self._crash_loop = False
+            self._std_contents[1].clear()
+            self._std_contents[2].clear()
+        protocol = RunnerProtocol(self, { 1: self._getLogFile(1),
+                                          2: self._getLogFile(2) },
+                                  self._std_contents[1].max_size)
+        self._returncode = None
+        self._running = True
+        self._started = time.time()
+        self._process = reactor.spawnProcess(protocol, executable, args,
+                                             env = os.environ)
+
+        self._metrics.clear()
+        self._sampled = {}
+        if self._sample_interval > 0:
+            self._sampler.start(self._sample_interval, now = True)
+
+        self._watchReadiness()
         return P.Result.ok('Task %s is started', self._executable)
 
-    def _getOutputAndLogFile(self, std, log_dir):
-        log_file = None
-        if log_dir is None:
+    def _watchReadiness(self):
+        self._ready_result = None
+        self._ready_time = None
+        if not self._probe.isConfigured():
+            self._setReady()
+            return
+
+        self._probe.reset()
+        if self._probe.pattern is not None:
+            for std in self._std_contents:
+                self._std_contents[std].subscribe(self._readyLine)
+        self._ready_call = reactor.callLater(self._ready_timeout,
+                                             self._readyFailed,
+                                             'Task %s is not ready after %.1f '
+                                             'seconds', self._executable,
+                                             self._ready_timeout)
+        if self._probe.isPolled():
+            self._prober.start(self.READY_INTERVAL, now = True)
+
+    def _readyLine(self, seq, line):
+        if self._probe.match(line):
+            self._checkReady()
+
+    def _checkReady(self):
+        if self._ready_result is None and self._running \
+                and self._probe.check():
+            self._setReady()
+
+    def _setReady(self):
+        self._ready_time = time.time() - self._started
+        self.logger.info('Task %s is ready in %.3f seconds',
+                         self._executable, self._ready_time)
+        self._readinessDone(P.Result.ok('Task %s is ready', self._executable,
+                                        ready_time = self._ready_time))
+
+    def _readyFailed(self, message, *args):
+        self.logger.warning(message, *args)
+        self._readinessDone(P.Result.fail(message, *args))
+
+    def _readinessDone(self, result):
+        for std in self._std_contents:
+            self._std_contents[std].unsubscribe(self._readyLine)
+        if self._prober.running:
+            self._prober.stop()
+        if self._ready_call is not None and self._ready_call.active():
+            self._ready_call.cancel()
+        self._ready_call = None
+
+        self._ready_result = result
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for d in waiters:
+            d.callback(result)
+
+    def whenReady(self):
+        """Deferred firing with the result of the readiness of the task."""
+        if self._ready_result is not None:
+            return defer.succeed(self._ready_result)
+        if not self._running:
+            return defer.succeed(P.Result.fail('Task %s is not running',
+                                               self._executable))
+
+        d = defer.Deferred()
+        self._ready_waiters.append(d)
+        return d
+
+    def isReady(self):
+        return self._running and self._ready_result is not None \
+            and self._ready_result.status == P.Result.OK
+
+    def getReadiness(self):
+        return {'ready': self.isReady(), 'ready_time': self._ready_time}
+
+    def _getLogFile(self, std):
+        if self._log_dir is None:
             self.logger.debug('No logging directory is given')
-        elif os.path.isdir(log_dir):
-            if std == 1:
-                file_name = os.path.join(log_dir, "stdout")
-                self.logger.debug('Writing stdout in file %s', file_name)
-            elif std == 2:
-                file_name = os.path.join(log_dir, "stderr")
-                self.logger.debug('Writing stderr in file %s', file_name)
-
-            log_file = open(file_name, 'w')
-        else:
-            self.logger.debug('Logging directory %s is not a valid directory',
-                              log_dir)
+            return None
 
-        if std == 1:
-            output = self._task.stdout
-        elif std == 2:
-            output = self._task.stderr
+        if not os.path.isdir(self._log_dir):
+            self.logger.debug('Logging directory %s is not a valid directory',
+                              self._log_dir)
+            return None
+
+        file_name = os.path.join(self._log_dir,
+                                 'stdout' if std == 1 else 'stderr')
+        self.logger.debug('Writing output %d in file %s', std, file_name)
+        return RotatingLogFile(file_name, max_size = self._log_max_size,
+                               backups = self._log_backups)
+
+    def _appendOutput(self, std, lines):
+        output = self._std_contents[std]
+        for line in lines:
+            output.append(line)
+
+    def _ended(self, reason):
+        self._returncode = reason.value.exitCode
+        if self._returncode is None:
+            self._returncode = -reason.value.signal
+        self._running = False
+        self.logger.info('Task %s exited with %s', self._executable,
+                         self._returncode)
+        if self._sampler.running:
+            self._sampler.stop()
+        if self._ready_result is None:
+            self._readyFailed('Task %s exited before it was ready',
+                              self._executable)
+
+        self._last_exit = time.time()
+        if self._supervise and self._stopping is None:
+            self._scheduleRestart()
+
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(self._returncode)
+
+    def _scheduleRestart(self):
+        now = time.time()
+        while len(self._recent_restarts) > 0 and \
+                self._recent_restarts[0] <= now - self._crash_loop_window:
+            self._recent_restarts.popleft()
+
+        if len(self._recent_restarts) >= self._crash_loop_restarts:
+            self._crash_loop = True
+            self.logger.error('Task %s is in a crash loop, it was restarted '
+                              '%d times in %.0f seconds, giving up',
+                              self._executable, len(self._recent_restarts),
+                              self._crash_loop_window)
+            return
 
-        return (output, log_file)
+        delay = min(self._restart_backoff * 2 ** len(self._recent_restarts),
+                    self._restart_backoff_max)
+        self.logger.warning('Task %s exited unexpectedly, restarting it in '
+                            '%.1f seconds', self._executable, delay)
+        self._restart_call = reactor.callLater(delay, self._supervisedRestart)
+
+    def _supervisedRestart(self):
+        self._restart_call = None
+        now = time.time()
+        self._recent_restarts.append(now)
+        self._restart_history.append(now)
+        self._restart_count += 1
+        self._process = None
+
+        result = self._start(supervised=True)
+        if result.status == P.Result.FAILED:
+            self.logger.error('Restarting task %s failed: %s',
+                              self._executable, result.message)
+            self._scheduleRestart()
+
+    def _cancelRestart(self):
+        if self._restart_call is None:
+            return False
 
-    def _getOutput(self, std, log_dir):
-        if std not in [1,2]:
-            self.logger.warning('Invalid output descriptor: %d', std)
+        self.logger.debug('Cancelling restart of task %s', self._executable)
+        self._restart_call.cancel()
+        self._restart_call = None
+        return True
+
+    def getSupervision(self):
+        return self._inReactor(self._getSupervision)
+
+    def _getSupervision(self):
+        next_restart = None
+        if self._restart_call is not None:
+            next_restart = time.time() + max(self._restart_call.getTime() -
+                                             reactor.seconds(), 0)
+
+        return {'enabled': self._supervise,
+                'restarts': self._restart_count,
+                'restart_times': list(self._restart_history),
+                'last_exit': self._last_exit,
+                'next_restart': next_restart,
+                'crash_loop': self._crash_loop}
+
+    def _sample(self):
+        if not self._running:
             return
 
-        self.logger.debug('IO thread started for output %d', std)
-
-        output, log_file = self._getOutputAndLogFile(std, log_dir)
+        try:
+            root = psutil.Process(self._process.pid)
+            procs = [root] + root.children(recursive=True)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return
 
-        while True:
+        sample = dict.fromkeys(MetricsRing.FIELDS[1:], 0)
+        sampled = {}
+        for proc in procs:
+            proc = self._sampled.get(proc.pid, proc)
             try:
-                line = output.readline()
-                decoded_line = line.decode()
-            except UnicodeDecodeError:
-                self.logger.warning('Invalid characters on output %d: %s',
-                                    std, line.hex())
+                with proc.oneshot():
+                    if proc.status() == psutil.STATUS_ZOMBIE:
+                        continue
+                    sample['cpu_percent'] += proc.cpu_percent(None)
+                    sample['rss'] += proc.memory_info().rss
+                    sample['num_fds'] += proc.num_fds()
+                    sample['num_threads'] += proc.num_threads()
+                    ctx = proc.num_ctx_switches()
+                    sample['ctx_switches'] += ctx.voluntary + ctx.involuntary
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
                 continue
-            except ValueError:
-                self.logger.error('Output is closed')
-                break
-            except OSError:
-                self.logger.error('Output is closed')
-                break
-
-            self._std_contents[std] += decoded_line
-            if log_file is not None:
-                log_file.write(decoded_line)
-                log_file.flush()
+            sampled[proc.pid] = proc
+
+        self._sampled = sampled
+        if len(sampled) > 0:
+            self._metrics.append(time = time.time(), **sample)
+
+    def getMetrics(self):
+        return self._metrics.samples()
 
-        self.logger.debug('Output %d has been closed, exiting IO thread.', std)
+    def whenExited(self):
+        """Deferred firing with the return code once the task exited."""
+        if not self._running:
+            return defer.succeed(self._returncode)
 
-        if log_file is not None:
-            log_file.close()
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
 
     def stop(self):
+        return self._inReactor(self._stop)
+
+    def _stop(self):
         self.logger.info('Stopping task %s', self._executable)
-        if self._task is None:
+        cancelled = self._cancelRestart()
+        if self._process is None:
+            if cancelled:
+                return P.Result.ok('Restart of task %s is cancelled',
+                                   self._executable)
             return P.Result.warn('Unable to stop task %s, it\'s not started',
                                  self._executable)
 
-        self.logger.debug('Killing task %s', self._executable)
-        if self.isRunning():
-            p = psutil.Process(self._task.pid)
-            for ch in p.children(recursive=True):
-                if ch.is_running():
-                    self.logger.debug('Killing subprocess %s for task %s',
-                                      ch.name(), self._executable)
-                    ch.terminate()
-            p.terminate()
-
-        self.logger.debug('Closing task\'s standard IOs')
-        self._task.stdin.close()
-        self._task.stdout.close()
-        self._task.stderr.close()
-
-        self.logger.debug('Waiting task to stop')
-        self._task.wait()
-        self._task = None
-
-        self.logger.debug('Waiting standard IO threads to stop')
-        self._stderr_thread.join()
-        self._stdout_thread.join()
-
-        return P.Result.ok('Task %s is stopped', self._executable)
-
-    def restart(self):
-        if self._task is None:
-            self.start()
-        else:
-            self.stop()
-            self.start()
+        if self._stopping is None:
+            self._stopping = self._terminate()
+            self._stopping.addBoth(self._stopped)
+
+        d = defer.Deferred()
+        self._stopping.addBoth(lambda r: d.callback(r) or r)
+        return d
+
+    def _terminate(self):
+        """Signals the task and all of its children at once with SIGTERM.
+        The ones still running after stop_timeout seconds are killed."""
+        started = time.time()
+        self._killed_task = 0
+        children = []
+        if self._running:
+            self.logger.debug('Terminating task %s', self._executable)
+            children = self._signalTree(signal.SIGTERM)
+
+        # The task itself is reaped by the reactor, it is watched through
+        # whenExited(). Its children are waited for in a thread.
+        kill_call = reactor.callLater(self._stop_timeout, self._killTask)
+        d_task = self.whenExited()
+        d_task.addBoth(lambda r: kill_call.cancel() if kill_call.active()
+                       else None)
+        d_children = threads.deferToThread(self._waitForChildren, children,
+                                           self._stop_timeout)
+        d_children.addCallback(self._killChildren)
+
+        def result(results):
+            _, killed = results
+            killed += self._killed_task
+            duration = time.time() - started
+            self.logger.info('Task %s stopped in %.3f seconds (killed: %d)',
+                             self._executable, duration, killed)
+            return P.Result.ok('Task %s is stopped', self._executable,
+                               shutdown_time = duration, killed = killed)
+
+        d = defer.gatherResults([d_task, d_children], consumeErrors = True)
+        return d.addCallback(result)
+
+    def _signalTree(self, sig):
+        try:
+            p = psutil.Process(self._process.pid)
+            # Suspended, the task can not start a child which would
+            # outlive it and keep its outputs open.
+            p.suspend()
+        except psutil.NoSuchProcess:
+            return []
+        except psutil.AccessDenied as e:
+            self.logger.warning('Unable to suspend task %s: %s',
+                                self._executable, e)
+
+        try:
+            children = p.children(recursive=True)
+        except psutil.NoSuchProcess:
+            children = []
+        except psutil.AccessDenied as e:
+            self.logger.warning('Unable to list subprocesses of task %s: %s',
+                                self._executable, e)
+            children = []
+
+        signalled = []
+        for proc in children + [p]:
+            try:
+                proc.send_signal(sig)
+                signalled.append(proc)
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.AccessDenied as e:
+                # e.g. a setuid helper, it is left running
+                self.logger.warning('Unable to signal subprocess %s of task '
+                                    '%s: %s', proc.pid, self._executable, e)
+
+        try:
+            p.resume()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+
+        return [c for c in children if c in signalled]
+
+    @staticmethod
+    def _waitForChildren(children, timeout):
+        """Returns the children still running after timeout seconds."""
+        deadline = time.time() + timeout
+        alive = children
+        while len(alive) > 0 and time.time() < deadline:
+            _, alive = psutil.wait_procs(alive, timeout = min(
+                Runner.WAIT_INTERVAL, max(deadline - time.time(), 0)))
+            # Orphans already exited once they are zombies, their new
+            # parent may take its time to reap them.
+            alive = [p for p in alive if not Runner._isZombie(p)]
+
+        return alive
+
+    @staticmethod
+    def _isZombie(proc):
+        try:
+            return proc.status() == psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return True
+
+    def _killTask(self):
+        self.logger.warning('Task %s did not stop in %.1f seconds, killing it',
+                            self._executable, self._stop_timeout)
+        try:
+            self._process.signalProcess('KILL')
+            self._killed_task = 1
+        except ProcessExitedAlready:
+            pass
+
+    def _killChildren(self, alive):
+        killed = 0
+        for proc in alive:
+            self.logger.warning('Subprocess %s of task %s did not stop, '
+                                'killing it', proc.pid, self._executable)
+            try:
+                proc.kill()
+                killed += 1
+            except psutil.NoSuchProcess:
+                pass
+            except psutil.AccessDenied as e:
+                self.logger.warning('Unable to kill subprocess %s of task '
+                                    '%s: %s', proc.pid, self._executable, e)
+
+        return killed
+
+    def _stopped(self, result):
+        self._stopping = None
+        self._process = None
+        return result
+
+    def restart(self, wait_ready=False):
+        return self._readyResult(self._inReactor(self._restart), wait_ready)
+
+    def _restart(self):
+        if self._process is None:
+            return self._start()
+
+        return self._stop().addCallback(lambda r: self._start())
 
     def getOutput(self, stderr=False):
         if stderr:
-            return self._std_contents[2]
+            return self._std_contents[2].getvalue()
         else:
-            return self._std_contents[1]
+            return self._std_contents[1].getvalue()
+
+    def getOutputSince(self, since=None):
+        """Returns the stdout and stderr lines after the cursor since and
+        the cursor of the last returned line."""
+        # Lines appended while reading get a higher number than the cursor
+        # and are returned by the next call.
+        with self._output_lock:
+            cursor = max(self._std_contents[1].last_seq,
+                         self._std_contents[2].last_seq)
+        stdout = self._std_contents[1].getvalue(since, cursor)
+        stderr = self._std_contents[2].getvalue(since, cursor)
+        return stdout, stderr, cursor
+
+    def tail(self, stream=None, pattern=None):
+        """Returns a subscription pushing new output lines."""
+        if stream is not None and stream not in self.STREAMS:
+            return P.Result.fail('Invalid stream: %s', stream)
+
+        if pattern is not None:
+            try:
+                pattern = re.compile(pattern)
+            except re.error as e:
+                return P.Result.fail('Invalid pattern: %s', e)
+
+        buffers = [(name, self._std_contents[std])
+                   for name, std in sorted(self.STREAMS.items())
+                   if stream is None or stream == name]
+        result = P.Result.ok('Tailing output of task %s', self._executable)
+        return OutputSubscription(buffers, pattern, result)
+
+    def search(self, pattern, stream=None, since=None, until=None,
+               context=0, max_matches=None, logs=False, log_file=None):
+        """Returns the output lines matching the regex pattern with context
+        lines around them.
+
+        The kept output is searched between the cursors (since, until],
+        the matches of both streams in the order they were output.
+
+        With logs the log files are searched instead, rotated segments
+        included, the context of a match reaching into the neighbouring
+        segments. A match holds the name of its file and its line number
+        in it. since and until bound the line numbers of log_file, which
+        is the only file searched then; the names of rotated segments
+        move on with the next rotation. The log files do not tell when a
+        line was output, so the matches are given per stream and each
+        stream has its own max_matches. The last second of output may
+        not be written to the log files yet.
+        """
+        if stream is not None and stream not in self.STREAMS:
+            return P.Result.fail('Invalid stream: %s', stream)
+        if pattern is None:
+            return P.Result.fail('No search pattern is given')
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            return P.Result.fail('Invalid pattern: %s', e)
+        if logs and self._log_dir is None:
+            return P.Result.fail('Task %s has no log files', self._executable)
+        if logs and log_file is None and \
+                (since is not None or until is not None):
+            return P.Result.fail('Searching the log files by lines '
+                                 'needs a log file')
+
+        if max_matches is None:
+            max_matches = self.SEARCH_MAX_MATCHES
+        streams = [(name, std) for name, std in sorted(self.STREAMS.items())
+                   if stream is None or stream == name]
+
+        if logs and log_file is not None:
+            streams = [(name, std) for name, std in streams
+                       if log_file in self._logSegments(name)]
+            if len(streams) == 0:
+                return P.Result.fail('No log file %s', log_file)
+
+        searches = []
+        for name, std in streams:
+            search = OutputSearch(regex, context, max_matches)
+            if logs:
+                self._searchLogs(search, name, log_file, since, until)
+            else:
+                lines = self._std_contents[std].lines(since, until)
+                search.search(lines, 'seq', stream = name)
+            searches.append(search)
+
+        matches = list(itertools.chain(*[s.matches for s in searches]))
+        truncated = any(s.truncated for s in searches)
+        if not logs:
+            # Both outputs are numbered by one sequence
+            matches.sort(key = lambda m: m['seq'])
+            truncated = truncated or len(matches) > max_matches
+            matches = matches[:max_matches]
+        return P.Result.ok('Found %d matching lines', len(matches),
+                           matches = matches, truncated = truncated)
+
+    def _logSegments(self, name):
+        path = os.path.join(self._log_dir, name)
+        return [os.path.basename(p)
+                for p in RotatingLogFile.segments(path, self._log_backups)]
+
+    def _searchLogs(self, search, name, log_file, since, until):
+        def numbered(f):
+            for number, line in enumerate(f, 1):
+                if until is not None and number > until:
+                    return
+                if since is None or number > since:
+                    yield number, line
+
+        for segment in self._logSegments(name):
+            if log_file is not None and segment != log_file:
+                continue
+            path = os.path.join(self._log_dir, segment)
+            opener = gzip.open if segment.endswith('.gz') else open
+            try:
+                with opener(path, 'rt', errors = 'replace') as f:
+                    if not search.search(numbered(f), 'line_no', stream = name,
+                                         file = segment):
+                        return
+            except IOError as e:
+                # Rotated away while searching
+                self.logger.debug('Unable to search %s: %s', path, e)
+
+    def getOutputStats(self, stderr=False):
+        if stderr:
+            return self._std_contents[2].stats()
+        else:
+            return self._std_contents[1].stats()
 
     def isRunning(self):
-        if self._task is None:
-            return False
-
-        returncode = self._task.poll()
-        if returncode is None:
-            return True
-        else:
-            return False
+        return self._running
 
     def getReturnCode(self):
-        return self._task.poll()
+        return self._returncode
 
 
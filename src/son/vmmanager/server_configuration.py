@@ -1,3 +1,6 @@
+from son.vmmanager.jsonserver import FRAMINGS, LegacyFraming, JsonMsgReader
+from son.vmmanager.jsonserver import JsonMsgReaderFactory
+from son.vmmanager.jsonserver import CODECS, JsonCodec
 from configparser import ConfigParser
 
 import logging
@@ -6,18 +9,46 @@ import os
 NETWORK_SECTION = 'network'
 NETWORK_SERVER_PORT = 'port'
 NETWORK_SERVER_ADDRESS = 'address'
+NETWORK_FRAMING = 'framing'
+NETWORK_MAX_FRAME_SIZE = 'max_frame_size'
+NETWORK_MAX_BUFFER_SIZE = 'max_buffer_size'
+NETWORK_THREAD_POOL_SIZE = 'thread_pool_size'
+NETWORK_NESTED_RESULTS = 'nested_results'
+NETWORK_CODEC = 'codec'
 
 PROCESSORS_SECTION = 'processors'
+# Options of the section [processor:<name>] are passed to the constructor
+# of the named processor as keyword arguments (as strings).
+PROCESSOR_SECTION_PREFIX = 'processor:'
+PROCESSOR_OPTIONS = 'processor_options'
 
 DEFAULT_PORT = 38388
 DEFAULT_ADDRESS = "0.0.0.0"
+DEFAULT_FRAMING = LegacyFraming.NAME
+DEFAULT_MAX_FRAME_SIZE = JsonMsgReader.MAX_FRAME_SIZE
+DEFAULT_MAX_BUFFER_SIZE = JsonMsgReader.MAX_BUFFER_SIZE
+DEFAULT_THREAD_POOL_SIZE = JsonMsgReaderFactory.THREAD_POOL_SIZE
+DEFAULT_NESTED_RESULTS = False
+DEFAULT_CODEC = JsonCodec.NAME
 
 logger = logging.getLogger(__name__)
 
+def _set_option(options, option, value, config_file):
+    if option in options:
+        logger.warn('Option %s has been already set (%s)'
+                    'Ignoring value "%s" from file "%s"',
+                    option, options[option], value, config_file)
+    else:
+        options[option] = value
+        logger.info('Setting %s to "%s" from file "%s"',
+                    option, value, config_file)
+
 def parse_configuration_files(config_files):
     port = None
     address = None
     processors = {}
+    options = {}
+    processor_options = {}
     for config_file in config_files:
         if not os.path.isfile(config_file):
             logger.warn('Configuration file "%s" does not exist.', config_file)
@@ -49,6 +80,37 @@ def parse_configuration_files(config_files):
                                 'Ignoring value "%s" from file "%s"',
                                 address, a, config_file)
 
+            if conf_parser.has_option(NETWORK_SECTION, NETWORK_FRAMING):
+                f = conf_parser.get(NETWORK_SECTION, NETWORK_FRAMING)
+                if f not in FRAMINGS:
+                    logger.warn('Unknown framing "%s" in file "%s". '
+                                'Valid framings: %s', f, config_file,
+                                ', '.join(sorted(FRAMINGS)))
+                else:
+                    _set_option(options, NETWORK_FRAMING, f, config_file)
+
+            if conf_parser.has_option(NETWORK_SECTION, NETWORK_CODEC):
+                c = conf_parser.get(NETWORK_SECTION, NETWORK_CODEC)
+                if c not in CODECS:
+                    logger.warn('Unknown codec "%s" in file "%s". '
+                                'Valid codecs: %s', c, config_file,
+                                ', '.join(sorted(CODECS)))
+                else:
+                    _set_option(options, NETWORK_CODEC, c, config_file)
+
+            for o in [NETWORK_MAX_FRAME_SIZE, NETWORK_MAX_BUFFER_SIZE,
+                      NETWORK_THREAD_POOL_SIZE]:
+                if conf_parser.has_option(NETWORK_SECTION, o):
+                    _set_option(options, o,
+                                conf_parser.getint(NETWORK_SECTION, o),
+                                config_file)
+
+            if conf_parser.has_option(NETWORK_SECTION, NETWORK_NESTED_RESULTS):
+                _set_option(options, NETWORK_NESTED_RESULTS,
+                            conf_parser.getboolean(NETWORK_SECTION,
+                                                   NETWORK_NESTED_RESULTS),
+                            config_file)
+
         if conf_parser.has_section(PROCESSORS_SECTION):
             for p in conf_parser.options(PROCESSORS_SECTION):
                 if p in processors:
@@ -61,13 +123,31 @@ def parse_configuration_files(config_files):
                 logger.info('Adding processor "%s" (%s) from file %s',
                             p, processors[p], config_file)
 
+        for section in conf_parser.sections():
+            if not section.startswith(PROCESSOR_SECTION_PREFIX):
+                continue
+
+            p = section[len(PROCESSOR_SECTION_PREFIX):].lower()
+            p_options = processor_options.setdefault(p, {})
+            for o in conf_parser.options(section):
+                _set_option(p_options, o, conf_parser.get(section, o),
+                            config_file)
+
     if port is None:
         port = DEFAULT_PORT
 
     if address is None:
         address = DEFAULT_ADDRESS
 
-    return address, port, processors
+    options.setdefault(NETWORK_FRAMING, DEFAULT_FRAMING)
+    options.setdefault(NETWORK_MAX_FRAME_SIZE, DEFAULT_MAX_FRAME_SIZE)
+    options.setdefault(NETWORK_MAX_BUFFER_SIZE, DEFAULT_MAX_BUFFER_SIZE)
+    options.setdefault(NETWORK_THREAD_POOL_SIZE, DEFAULT_THREAD_POOL_SIZE)
+    options.setdefault(NETWORK_NESTED_RESULTS, DEFAULT_NESTED_RESULTS)
+    options.setdefault(NETWORK_CODEC, DEFAULT_CODEC)
+    options[PROCESSOR_OPTIONS] = processor_options
+
+    return address, port, processors, options
 
 
 
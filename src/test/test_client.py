@@ -0,0 +1,119 @@
+from son.client.protocol import ClientProtocol
+from son.vmmanager.jsonserver import LineFraming, LengthPrefixedFraming
+from son.vmmanager.jsonserver import MsgPackCodec, JsonCodec
+from son.vmmanager.jsonserver import DeflateCompression
+
+from twisted.test import proto_helpers
+
+import unittest
+import logging
+import json
+
+logging.basicConfig(level=logging.DEBUG)
+
+class Protocol(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = ClientProtocol({'config': 1}, framing = LineFraming.NAME)
+        self.tr = proto_helpers.StringTransport()
+
+    def requests(self):
+        return [json.loads(r) for r in self.tr.value().decode().splitlines()]
+
+    def testPipelining(self):
+        fired = []
+        self.proto.sendConfig().addCallback(lambda p: fired.append('config'))
+        self.proto.sendStart().addCallback(lambda p: fired.append('start'))
+        self.proto.makeConnection(self.tr)
+
+        requests = self.requests()
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0]['config'], 1)
+        self.assertEqual(requests[1]['command'], 'start')
+        self.assertNotEqual(requests[0]['id'], requests[1]['id'])
+
+        self.proto.dataReceived(b'{"id": %d}\n' % requests[1]['id'])
+        self.assertEqual(fired, ['start'])
+        self.proto.dataReceived(b'{"id": %d}\n' % requests[0]['id'])
+        self.assertEqual(fired, ['start', 'config'])
+
+    def testReplyWithoutId(self):
+        fired = []
+        self.proto.makeConnection(self.tr)
+        self.proto.sendConfig().addCallback(lambda p: fired.append('config'))
+        self.proto.sendStop().addCallback(lambda p: fired.append('stop'))
+
+        self.proto.dataReceived(b'{}\n{}\n')
+        self.assertEqual(fired, ['config', 'stop'])
+
+    @unittest.skipUnless(MsgPackCodec.available(), 'msgpack is not installed')
+    def testNegotiation(self):
+        self.proto = ClientProtocol({}, framing = LengthPrefixedFraming.NAME,
+                                    codec = MsgPackCodec.NAME,
+                                    negotiate = True)
+        self.proto.sendStart()
+        self.proto.makeConnection(self.tr)
+
+        framing = LengthPrefixedFraming()
+        framing.feed(self.tr.value())
+        negotiation, = framing.frames()
+        negotiation = json.loads(negotiation)
+        self.assertEqual(negotiation['negotiate'], {'codec': 'msgpack'})
+
+        self.tr.clear()
+        self.proto.dataReceived(framing.encode(json.dumps({
+            'id': negotiation['id'],
+            'negotiate': {'status': 1, 'message': 'Negotiated'}
+        }).encode()))
+
+        framing.feed(self.tr.value())
+        start, = framing.frames()
+        self.assertEqual(MsgPackCodec().decode(start)['command'], 'start')
+
+    @unittest.skipUnless(MsgPackCodec.available(), 'msgpack is not installed')
+    def testNegotiationNotSupported(self):
+        self.proto = ClientProtocol({}, framing = LengthPrefixedFraming.NAME,
+                                    codec = MsgPackCodec.NAME,
+                                    negotiate = True)
+        self.proto.sendStart()
+        self.proto.makeConnection(self.tr)
+
+        framing = LengthPrefixedFraming()
+        framing.feed(self.tr.value())
+        framing.frames()
+
+        self.tr.clear()
+        self.proto.dataReceived(framing.encode(json.dumps({
+            'status': 1, 'message': 'Unknown request'}).encode()))
+
+        framing.feed(self.tr.value())
+        start, = framing.frames()
+        self.assertEqual(JsonCodec().decode(start)['command'], 'start')
+
+    def testCompression(self):
+        self.proto = ClientProtocol({}, framing = LengthPrefixedFraming.NAME,
+                                    compression = DeflateCompression.NAME)
+        fired = []
+        self.proto.sendStart().addCallback(lambda p: fired.append('start'))
+        self.proto.makeConnection(self.tr)
+
+        framing, codec = LengthPrefixedFraming(), JsonCodec()
+        framing.feed(self.tr.value())
+        negotiation, = framing.frames()
+        negotiation = codec.decode(negotiation)
+        self.assertEqual(negotiation['negotiate']['compression'], 'deflate')
+
+        self.tr.clear()
+        self.proto.dataReceived(framing.encode(codec.encode({
+            'id': negotiation['id'],
+            'negotiate': {'status': 1, 'message': 'Negotiated'}
+        })))
+
+        framing.feed(self.tr.value())
+        start, = framing.frames()
+        start = codec.decode(start)
+
+        reply = codec.encode({'id': start['id'], 'output': 'x' * 4096})
+        self.proto.dataReceived(framing.encode(
+            DeflateCompression(threshold = 0).compress(reply)))
+        self.assertEqual(fired, ['start'])
@@ -21,23 +21,47 @@ class ServerConfigurationParsing(unittest.TestCase):
             f.write(config_string)
 
     def testDefaultConfig(self):
-        address, port, processors = sc.parse_configuration_files([self.conf_path])
+        address, port, processors, options = sc.parse_configuration_files([self.conf_path])
 
         self.assertEqual(address, sc.DEFAULT_ADDRESS)
         self.assertEqual(port, sc.DEFAULT_PORT)
         self.assertEqual(len(processors), 0)
+        self.assertEqual(options[sc.NETWORK_FRAMING], sc.DEFAULT_FRAMING)
+        self.assertEqual(options[sc.NETWORK_MAX_FRAME_SIZE],
+                         sc.DEFAULT_MAX_FRAME_SIZE)
 
     def testNetworkingConfig(self):
         self._write_config('''
                            [network]
                            port=11111
                            address=10.0.0.1
+                           framing=ndjson
+                           max_frame_size=1024
+                           max_buffer_size=4096
+                           thread_pool_size=2
+                           nested_results=yes
+                           codec=msgpack
                            ''')
-        address, port, processors = sc.parse_configuration_files([self.conf_path])
+        address, port, processors, options = sc.parse_configuration_files([self.conf_path])
 
         self.assertEqual(address, "10.0.0.1")
         self.assertEqual(port, 11111)
         self.assertEqual(len(processors), 0)
+        self.assertEqual(options[sc.NETWORK_FRAMING], 'ndjson')
+        self.assertEqual(options[sc.NETWORK_MAX_FRAME_SIZE], 1024)
+        self.assertEqual(options[sc.NETWORK_MAX_BUFFER_SIZE], 4096)
+        self.assertEqual(options[sc.NETWORK_THREAD_POOL_SIZE], 2)
+        self.assertEqual(options[sc.NETWORK_NESTED_RESULTS], True)
+        self.assertEqual(options[sc.NETWORK_CODEC], 'msgpack')
+
+    def testInvalidFraming(self):
+        self._write_config('''
+                           [network]
+                           framing=carrier_pigeon
+                           ''')
+        address, port, processors, options = sc.parse_configuration_files([self.conf_path])
+
+        self.assertEqual(options[sc.NETWORK_FRAMING], sc.DEFAULT_FRAMING)
 
     def testPorcessorConfig(self):
         self._write_config('''
@@ -46,10 +70,24 @@ class ServerConfigurationParsing(unittest.TestCase):
                            secondTestProcessor=module.name.Processor2
                            ''')
 
-        address, port, processors = sc.parse_configuration_files([self.conf_path])
+        address, port, processors, options = sc.parse_configuration_files([self.conf_path])
 
         self.assertEqual(len(processors), 2)
         self.assertIn('firsttestprocessor', processors)
         self.assertEqual(processors['firsttestprocessor'], 'module.name.Processor')
         self.assertIn('secondtestprocessor', processors)
         self.assertEqual(processors['secondtestprocessor'], 'module.name.Processor2')
+
+    def testProcessorOptions(self):
+        self._write_config('''
+                           [processors]
+                           mme=module.name.Processor
+
+                           [processor:MME]
+                           output_buffer_size=4096
+                           ''')
+
+        address, port, processors, options = sc.parse_configuration_files([self.conf_path])
+
+        self.assertEqual(options[sc.PROCESSOR_OPTIONS],
+                         {'mme': {'output_buffer_size': '4096'}})
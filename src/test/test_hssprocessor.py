@@ -19,7 +19,7 @@ class HSS_Processor(unittest.TestCase):
     def testProcess(self, HSS_MessageParserMock, HSS_ConfiguratorMock, RunnerMock):
         HSS_MessageParserMock.return_value = Mock(wraps = HSS_MessageParserMock)
         HSS_ConfiguratorMock.return_value = Mock(wraps = HSS_ConfiguratorMock)
-        RunnerMock.return_value = Mock(wraps = RunnerMock)
+        RunnerMock.from_options.return_value = Mock(wraps = RunnerMock)
 
         config_dict = {}
 
@@ -32,7 +32,7 @@ class HSS_Processor(unittest.TestCase):
         HSS_ConfiguratorMock.assert_called_once()
         HSS_ConfiguratorMock.configure.assert_called_once()
 
-        RunnerMock.assert_called_once()
+        RunnerMock.from_options.assert_called_once()
 
     @patch('son.vmmanager.processors.utils.Runner')
     @patch('son.vmmanager.processors.hss_processor.HSS_Configurator')
@@ -43,7 +43,7 @@ class HSS_Processor(unittest.TestCase):
         HSS_MessageParserMock.parse.return_value = hss_p.HSS_Config(
             command = CommandConfig.START)
         HSS_ConfiguratorMock.return_value = Mock(wraps = HSS_ConfiguratorMock)
-        RunnerMock.return_value = Mock(wraps = RunnerMock)
+        RunnerMock.from_options.return_value = Mock(wraps = RunnerMock)
 
         config_dict = {}
 
@@ -56,7 +56,7 @@ class HSS_Processor(unittest.TestCase):
         HSS_ConfiguratorMock.assert_called_once()
         HSS_ConfiguratorMock.configure.assert_called_once()
 
-        RunnerMock.assert_called_once()
+        RunnerMock.from_options.assert_called_once()
         RunnerMock.start.assert_called_once()
 
         HSS_MessageParserMock.parse.return_value = hss_p.HSS_Config(
@@ -72,10 +72,27 @@ class HSS_Processor(unittest.TestCase):
         RunnerMock.restart.assert_called_once()
 
         HSS_MessageParserMock.parse.return_value = hss_p.HSS_Config(
-            command = CommandConfig.STATUS)
+            command = CommandConfig.STATUS, since = 42)
+        RunnerMock.getOutputSince.return_value = ('out', 'err', 43)
+        HSS_ConfiguratorMock.configure.return_value = P.Result.ok(
+            'HSS is configured', unchanged = True)
+        result = processor.process(config_dict)
+
+        RunnerMock.getOutputSince.assert_called_once_with(42)
+        self.assertEqual(result.args['stdout'], 'out')
+        self.assertEqual(result.args['cursor'], 43)
+        self.assertTrue(result.args['unchanged'])
+
+        HSS_MessageParserMock.parse.return_value = hss_p.HSS_Config(
+            command = CommandConfig.SEARCH, pattern = 'ERROR', context = 2)
         processor.process(config_dict)
 
-        self.assertEqual(RunnerMock.getOutput.call_count, 2)
+        RunnerMock.search.assert_called_once_with('ERROR', stream = None,
+                                                  since = None, until = None,
+                                                  context = 2,
+                                                  max_matches = None,
+                                                  logs = False,
+                                                  log_file = None)
 
 
 class HSS_MsgParser(unittest.TestCase):
@@ -1,9 +1,15 @@
 import unittest
 from son.vmmanager.jsonserver import JsonMsgReader
+from son.vmmanager.jsonserver import LineFraming, LengthPrefixedFraming
 import logging
+import json
 
 logging.basicConfig(level=logging.DEBUG)
 
+def pending(jsonMsgReader):
+    framing = jsonMsgReader._framing
+    return bytes(framing._data[framing._offset:]).decode('utf-8')
+
 class GetJsonSegments(unittest.TestCase):
     def testGetSegments_validSegment(self):
         msgReader = JsonMsgReader()
@@ -51,11 +57,27 @@ class GetJsonSegments(unittest.TestCase):
         segments = msgReader._get_json_segments_(jsonString)
         self.assertEqual(len(segments), 0)
 
+    def testGetSegments_bracesInString(self):
+        msgReader = JsonMsgReader()
+        jsonString = '{"a": "}{", "b": "\\"}"}garbage'
+        segments = msgReader._get_json_segments_(jsonString)
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(segments[0]['start'], 0)
+        self.assertEqual(segments[0]['end'], jsonString.rindex('}'))
+
+    def testGetSegments_multiple(self):
+        msgReader = JsonMsgReader()
+        jsonString = '{"a": 1}x{"b": {"c": 2}}{"d": 3}'
+        segments = msgReader._get_json_segments_(jsonString)
+        self.assertEqual(len(segments), 3)
+        self.assertEqual([jsonString[s['start']:s['end']+1] for s in segments],
+                         ['{"a": 1}', '{"b": {"c": 2}}', '{"d": 3}'])
+
 
 class GetCompleteJsons(unittest.TestCase):
     def testCompleteJson(self):
         jsonMsgReader = JsonMsgReader()
-        jsonMsgReader._data = '{"key1": 1, "key2": {"subKey1": [1,2,3]}}'
+        jsonMsgReader._framing.feed(b'{"key1": 1, "key2": {"subKey1": [1,2,3]}}')
         jsons = jsonMsgReader._get_complete_jsons_()
         self.assertEqual(len(jsons), 1)
         self.assertEqual(len(jsons[0]), 2)
@@ -64,11 +86,11 @@ class GetCompleteJsons(unittest.TestCase):
         self.assertEqual(jsons[0]["key1"], 1)
         self.assertIn("subKey1", jsons[0]["key2"])
         self.assertEqual(jsons[0]["key2"]["subKey1"], [1,2,3])
-        self.assertEqual(jsonMsgReader._data, "")
+        self.assertEqual(pending(jsonMsgReader), "")
 
     def testIncompleteJson(self):
         jsonMsgReader = JsonMsgReader()
-        jsonMsgReader._data = '{"key1": 1, "key2": {"subKey1": [1,2,3]}}{"key5":'
+        jsonMsgReader._framing.feed(b'{"key1": 1, "key2": {"subKey1": [1,2,3]}}{"key5":')
         jsons = jsonMsgReader._get_complete_jsons_()
         self.assertEqual(len(jsons), 1)
         self.assertEqual(len(jsons[0]), 2)
@@ -77,13 +99,95 @@ class GetCompleteJsons(unittest.TestCase):
         self.assertEqual(jsons[0]["key1"], 1)
         self.assertIn("subKey1", jsons[0]["key2"])
         self.assertEqual(jsons[0]["key2"]["subKey1"], [1,2,3])
-        self.assertEqual(jsonMsgReader._data, '{"key5":')
+        self.assertEqual(pending(jsonMsgReader), '{"key5":')
 
     def testInvalidJson(self):
         jsonMsgReader = JsonMsgReader()
-        jsonMsgReader._data = '{"key1": 1, "key2": {"subKey1: [1,2,3]}}'
+        jsonMsgReader._framing.feed(b'{"key1": 1, "key2": {"subKey1": [1,2,3],}}')
+        jsons = jsonMsgReader._get_complete_jsons_()
+        self.assertEqual(len(jsons), 0)
+        self.assertEqual(pending(jsonMsgReader), '')
+
+    def testUnterminatedString(self):
+        jsonMsgReader = JsonMsgReader()
+        jsonMsgReader._framing.feed(b'{"key1": 1, "key2": {"subKey1: [1,2,3]}}')
         jsons = jsonMsgReader._get_complete_jsons_()
         self.assertEqual(len(jsons), 0)
-        self.assertEqual(jsonMsgReader._data, '')
+        self.assertEqual(pending(jsonMsgReader),
+                         '{"key1": 1, "key2": {"subKey1: [1,2,3]}}')
+
+    def testMultipleJsons(self):
+        jsonMsgReader = JsonMsgReader()
+        jsonMsgReader._framing.feed(b'{"key1": 1}{"key2": 2}{"key3": 3}')
+        jsons = jsonMsgReader._get_complete_jsons_()
+        self.assertEqual(jsons, [{"key1": 1}, {"key2": 2}, {"key3": 3}])
+        self.assertEqual(pending(jsonMsgReader), '')
+
+    def testChunkedJson(self):
+        jsonMsgReader = JsonMsgReader()
+        message = '{"key1": "a\\"}\u00e9", "key2": {"subKey1": [1,2,3]}}'
+        jsons = []
+        for c in message.encode('utf-8'):
+            jsonMsgReader._framing.feed(bytes([c]))
+            jsons += jsonMsgReader._get_complete_jsons_()
+        self.assertEqual(jsons, [json.loads(message)])
+        self.assertEqual(pending(jsonMsgReader), '')
+
+
+class Framing(unittest.TestCase):
+    def testLineFraming(self):
+        framing = LineFraming()
+        framing.feed(b'{"a": 1}\n\n{"b": "}{"}\n{"c":')
+        self.assertEqual(framing.frames(), [b'{"a": 1}', b'{"b": "}{"}'])
+        framing.feed(b' 3}')
+        self.assertEqual(framing.frames(), [])
+        framing.feed(b'\n')
+        self.assertEqual(framing.frames(), [b'{"c": 3}'])
+        self.assertEqual(framing.pending(), 0)
+
+    def testLineFramingEncode(self):
+        framing = LineFraming()
+        framing.feed(framing.encode(b'{"a": 1}'))
+        self.assertEqual(framing.frames(), [b'{"a": 1}'])
+
+    def testLengthPrefixedFraming(self):
+        framing = LengthPrefixedFraming()
+        data = framing.encode(b'{"a": "\n"}') + framing.encode(b'{"b": 2}')
+        framing.feed(data[:3])
+        self.assertEqual(framing.frames(), [])
+        framing.feed(data[3:-1])
+        self.assertEqual(framing.frames(), [b'{"a": "\n"}'])
+        framing.feed(data[-1:])
+        self.assertEqual(framing.frames(), [b'{"b": 2}'])
+        self.assertEqual(framing.pending(), 0)
+
+    def testLengthPrefixedFramingMultiByte(self):
+        framing = LengthPrefixedFraming()
+        framing.feed(framing.encode('{"a": "\u00e9"}'.encode('utf-8')))
+        self.assertEqual(json.loads(framing.frames()[0]), {"a": "\u00e9"})
+
+    def testInvalidFrameIsSkipped(self):
+        msgReader = JsonMsgReader(framing = LineFraming.NAME)
+        msgReader._framing.feed(b'{"a": "\xff"}\n{"b": 2}\n')
+        self.assertEqual(msgReader._get_complete_jsons_(), [{"b": 2}])
+
+    def testBufferCompaction(self):
+        framing = LengthPrefixedFraming()
+        first, second = framing.encode(b'{"a": 1}'), framing.encode(b'{"b": 2}')
+        framing.feed(first + second[:5])
+        self.assertEqual(framing.frames(), [b'{"a": 1}'])
+        self.assertEqual(framing._offset, 0)
+        self.assertEqual(bytes(framing._data), second[:5])
 
+    def testFrameSizeLimit(self):
+        framing = LengthPrefixedFraming(max_frame_size = 8)
+        framing.feed(framing.encode(b'{"a": 1}') + framing.HEADER.pack(1024))
+        self.assertEqual(framing.frames(), [b'{"a": 1}'])
+        self.assertEqual(framing.overflow, 1024)
+        self.assertEqual(framing.frames(), [])
 
+    def testIncompleteFrameSizeLimit(self):
+        msgReader = JsonMsgReader(max_frame_size = 8)
+        msgReader._framing.feed(b'{"a": 1, "b":')
+        self.assertEqual(msgReader._get_complete_jsons_(), [])
+        self.assertEqual(msgReader._framing.overflow, 13)
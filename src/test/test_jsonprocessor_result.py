@@ -1,4 +1,5 @@
 from son.vmmanager.jsonserver import IJsonProcessor as P
+from son.vmmanager.jsonserver import MsgPackCodec
 
 import unittest
 import logging
@@ -51,3 +52,31 @@ class ProcessorResult(unittest.TestCase):
         self.assertEqual(resultDict[P.Result.STATUS], P.Result.OK)
         self.assertEqual(resultDict[P.Result.MESSAGE], FINE)
 
+    def testDictConversion(self):
+        r = P.Result.warn('Careful %s', 'there', key = 'value')
+        d = r.as_dict()
+        self.assertEqual(d, {P.Result.STATUS: P.Result.WARNING,
+                             P.Result.MESSAGE: 'Careful there',
+                             'key': 'value'})
+
+        rr = P.Result.from_dict(d)
+        self.assertEqual(rr.status, r.status)
+        self.assertEqual(rr.message, r.message)
+        self.assertEqual(rr.args, {'key': 'value'})
+        self.assertIn('key', d)
+
+    def testCodecs(self):
+        r = P.Result.ok('Fine', output = 'line\n' * 3)
+        rr = P.Result.decode(r.encode())
+        self.assertEqual(rr.message, r.message)
+        self.assertEqual(rr.args, r.args)
+
+    @unittest.skipUnless(MsgPackCodec.available(), 'msgpack is not installed')
+    def testMsgPackCodec(self):
+        r = P.Result.fail('Failed', output = 'line\n' * 3)
+        data = r.encode('msgpack')
+        self.assertIsInstance(data, bytes)
+        rr = P.Result.decode(data, 'msgpack')
+        self.assertEqual(rr.status, r.status)
+        self.assertEqual(rr.message, r.message)
+        self.assertEqual(rr.args, r.args)
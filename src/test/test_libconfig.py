@@ -0,0 +1,95 @@
+from son.vmmanager import libconfig
+
+import unittest
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+
+MME_CONF = '''# MME configuration
+MME :
+{
+    REALM                                     = "openair4G.eur";
+    /* Served GUMMEIs,
+       one group per GUMMEI */
+    GUMMEI_LIST = (
+         {MCC="208" ; MNC="93"; MME_GID="4" ; MME_CODE="1"; }
+    );
+    TAI_LIST = ( {MCC="208" ; MNC="93";  TAC = 1; } );
+    S1_MAX = 0x10;
+    ENABLED = TRUE;
+    RATIO = 1.5e2;
+    CODES = [1, 2, 3,];
+
+    NETWORK_INTERFACES :
+    {
+        // S1 towards the eNBs
+        MME_INTERFACE_NAME_FOR_S1_MME         = "eth0";
+        MME_IPV4_ADDRESS_FOR_S1_MME           = "192.168.11.17/24";
+        LONG_VALUE = "first part "
+                     "second part";
+    };
+};
+'''
+
+
+class Document(unittest.TestCase):
+
+    def setUp(self):
+        self.document = libconfig.parse(MME_CONF)
+
+    def testGet(self):
+        doc = self.document
+        self.assertEqual(doc.get('MME.REALM'), 'openair4G.eur')
+        self.assertEqual(doc.get('MME.GUMMEI_LIST[0].MME_GID'), '4')
+        self.assertEqual(doc.get('MME.TAI_LIST[0].TAC'), 1)
+        self.assertEqual(doc.get('MME.S1_MAX'), 16)
+        self.assertIs(doc.get('MME.ENABLED'), True)
+        self.assertEqual(doc.get('MME.RATIO'), 150.0)
+        self.assertEqual(doc.get('MME.CODES[2]'), 3)
+        self.assertEqual(doc.get('MME.NETWORK_INTERFACES.LONG_VALUE'),
+                         'first part second part')
+        self.assertIsNone(doc.get('MME.MISSING'))
+        self.assertEqual(doc.setting('MME.GUMMEI_LIST').kind,
+                         libconfig.Setting.LIST)
+        self.assertRaises(libconfig.ParseError, doc.get, 'MME')
+
+    def testFind(self):
+        self.assertEqual(self.document.find('MME_INTERFACE_NAME_FOR_S1_MME'),
+                         ['MME.NETWORK_INTERFACES.MME_INTERFACE_NAME_FOR_S1_MME'])
+        self.assertEqual(self.document.find('MCC'),
+                         ['MME.GUMMEI_LIST[0].MCC', 'MME.TAI_LIST[0].MCC'])
+
+    def testRenderUnchanged(self):
+        self.assertEqual(self.document.render({}), MME_CONF)
+
+    def testRender(self):
+        text = self.document.render({
+            'MME.NETWORK_INTERFACES.MME_IPV4_ADDRESS_FOR_S1_MME': '10.0.0.1/24',
+            'MME.NETWORK_INTERFACES.LONG_VALUE': 'a "quoted" value',
+            'MME.TAI_LIST[0].TAC': 2,
+            'MME.ENABLED': False})
+
+        self.assertIn('MME_IPV4_ADDRESS_FOR_S1_MME           = "10.0.0.1/24";',
+                      text)
+        self.assertIn('LONG_VALUE = "a \\"quoted\\" value";\n', text)
+        self.assertIn('TAC = 2; }', text)
+        self.assertIn('ENABLED = false;', text)
+        self.assertIn('/* Served GUMMEIs,\n       one group per GUMMEI */', text)
+
+        document = libconfig.parse(text)
+        self.assertEqual(document.get('MME.NETWORK_INTERFACES.LONG_VALUE'),
+                         'a "quoted" value')
+        self.assertEqual(document.paths(), self.document.paths())
+
+    def testRenderGroup(self):
+        self.assertRaises(libconfig.ParseError, self.document.render,
+                          {'MME.NETWORK_INTERFACES': 'value'})
+
+    def testParseError(self):
+        for text in ['A = ;', 'A = "unterminated', 'A = { B = 1;',
+                     'A = (1, 2', '= 1;', 'A = 1 $']:
+            self.assertRaises(libconfig.ParseError, libconfig.parse, text)
+
+    def testWithoutTerminator(self):
+        document = libconfig.parse('A = "1"\nB = "2"\n')
+        self.assertEqual((document.get('A'), document.get('B')), ('1', '2'))
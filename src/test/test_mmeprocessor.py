@@ -1,5 +1,6 @@
 import son.vmmanager.processors.mme_processor as mme_p
 from son.vmmanager.processors.utils import CommandConfig
+from son.vmmanager.jsonserver import IJsonProcessor as P
 
 from unittest.mock import patch
 from unittest.mock import Mock
@@ -18,7 +19,7 @@ class MME_Processor(unittest.TestCase):
     def testProcess(self, MME_MessageParserMock, MME_ConfiguratorMock, RunnerMock):
         MME_MessageParserMock.return_value = Mock(wraps = MME_MessageParserMock)
         MME_ConfiguratorMock.return_value = Mock(wraps = MME_ConfiguratorMock)
-        RunnerMock.return_value = Mock(wraps = RunnerMock)
+        RunnerMock.from_options.return_value = Mock(wraps = RunnerMock)
 
         config_dict = {}
 
@@ -31,7 +32,7 @@ class MME_Processor(unittest.TestCase):
         MME_ConfiguratorMock.assert_called_once()
         MME_ConfiguratorMock.configure.assert_called_once()
 
-        RunnerMock.assert_called_once()
+        RunnerMock.from_options.assert_called_once()
 
     @patch('son.vmmanager.processors.utils.Runner')
     @patch('son.vmmanager.processors.mme_processor.MME_Configurator')
@@ -42,7 +43,7 @@ class MME_Processor(unittest.TestCase):
         MME_MessageParserMock.parse.return_value = mme_p.MME_Config(
             command = CommandConfig.START)
         MME_ConfiguratorMock.return_value = Mock(wraps = MME_ConfiguratorMock)
-        RunnerMock.return_value = Mock(wraps = RunnerMock)
+        RunnerMock.from_options.return_value = Mock(wraps = RunnerMock)
 
         config_dict = {}
 
@@ -55,7 +56,7 @@ class MME_Processor(unittest.TestCase):
         MME_ConfiguratorMock.assert_called_once()
         MME_ConfiguratorMock.configure.assert_called_once()
 
-        RunnerMock.assert_called_once()
+        RunnerMock.from_options.assert_called_once()
         RunnerMock.start.assert_called_once()
 
         MME_MessageParserMock.parse.return_value = mme_p.MME_Config(
@@ -71,10 +72,27 @@ class MME_Processor(unittest.TestCase):
         RunnerMock.restart.assert_called_once()
 
         MME_MessageParserMock.parse.return_value = mme_p.MME_Config(
-            command = CommandConfig.STATUS)
+            command = CommandConfig.STATUS, since = 42)
+        RunnerMock.getOutputSince.return_value = ('out', 'err', 43)
+        MME_ConfiguratorMock.configure.return_value = P.Result.ok(
+            'MME is configured', unchanged = True)
+        result = processor.process(config_dict)
+
+        RunnerMock.getOutputSince.assert_called_once_with(42)
+        self.assertEqual(result.args['stdout'], 'out')
+        self.assertEqual(result.args['cursor'], 43)
+        self.assertTrue(result.args['unchanged'])
+
+        MME_MessageParserMock.parse.return_value = mme_p.MME_Config(
+            command = CommandConfig.SEARCH, pattern = 'ERROR', context = 2)
         processor.process(config_dict)
 
-        self.assertEqual(RunnerMock.getOutput.call_count, 2)
+        RunnerMock.search.assert_called_once_with('ERROR', stream = None,
+                                                  since = None, until = None,
+                                                  context = 2,
+                                                  max_matches = None,
+                                                  logs = False,
+                                                  log_file = None)
 
 
 class MME_MsgParser(unittest.TestCase):
@@ -295,12 +313,24 @@ class MME_Configurator(unittest.TestCase):
         MME_IP_S1 = 'MME_IPV4_ADDRESS_FOR_S1_MME'
         SPGW_IP_S11 = 'SGW_IPV4_ADDRESS_FOR_S11'
         HSS_HOSTNAME = 'HSS_HOSTNAME'
+        self.writeContent('MME : {\n', self.mme_config)
+        self.writeContent('S6A : {\n', self.mme_config)
+        self.writeContent('%s = "oldHostName";\n' % HSS_HOSTNAME, self.mme_config)
+        self.writeContent('};\n', self.mme_config)
+        self.writeContent('NETWORK_INTERFACES : {\n', self.mme_config)
         self.writeContent('%s = "lo";\n' % MME_INTF_S11, self.mme_config)
         self.writeContent('%s = "1.1.1.1/8";\n' % MME_IP_S11, self.mme_config)
         self.writeContent('%s = "ens3";\n' % MME_INTF_S1, self.mme_config)
         self.writeContent('%s = "2.2.2.2/16";\n' % MME_IP_S1, self.mme_config)
+        self.writeContent('};\n', self.mme_config)
+        self.writeContent('};\n', self.mme_config)
+        self.writeContent('S-GW : {\n', self.mme_config)
         self.writeContent('%s = "3.3.3.3/32";\n' % SPGW_IP_S11, self.mme_config)
-        self.writeContent('%s = "oldHostName";\n' % HSS_HOSTNAME, self.mme_config)
+        self.writeContent('};\n', self.mme_config)
+        # Settings of the same name elsewhere are left as they are
+        self.writeContent('OTHER : {\n', self.mme_config)
+        self.writeContent('%s = "2.2.2.2/16";\n' % MME_IP_S1, self.mme_config)
+        self.writeContent('};\n', self.mme_config)
 
         MME_HOST, MME_IP = 'mme.domain.my', '10.0.0.2/24'
         HSS_HOST, HSS_IP = 'hss.domain.my', '10.0.0.3/24'
@@ -328,13 +358,49 @@ class MME_Configurator(unittest.TestCase):
         configurator.configure(config)
 
         mme_config = self.getContent(self.mme_config)
-        self.assertEqual(len(mme_config.splitlines()), 6)
+        self.assertEqual(len(mme_config.splitlines()), 17)
         self.assertIn('%s = "%s";' % (MME_INTF_S11, S11_INTERFACE), mme_config)
         self.assertIn('%s = "%s";' % (MME_IP_S11, MME_IP), mme_config)
         self.assertIn('%s = "%s";' % (MME_INTF_S1, S1_INTERFACE), mme_config)
         self.assertIn('%s = "%s";' % (MME_IP_S1, S1_IP), mme_config)
         self.assertIn('%s = "%s";' % (SPGW_IP_S11, SPGW_IP), mme_config)
         self.assertIn('%s = "%s";' % (HSS_HOSTNAME, HSS_HOST.split('.')[0]), mme_config)
+        self.assertIn('%s = "2.2.2.2/16";\n};\n' % MME_IP_S1, mme_config)
+
+    def testUpdateNestedMMEConfig(self):
+        self.writeContent('MME : {\n'
+                          '    NETWORK_INTERFACES : {\n'
+                          '        # S1 interface\n'
+                          '        MME_IPV4_ADDRESS_FOR_S1_MME = "2.2.2.2/16";\n'
+                          '    };\n'
+                          '};\n', self.mme_config)
+
+        configurator = mme_p.MME_Configurator(self.mme_config,
+                                              self.mme_fd_config,
+                                              self.host_file)
+        configurator.getInterfacesName = lambda ip: None
+
+        config = mme_p.MME_Config(s1_ip = '20.0.0.1/24',
+                                  hss_host = 'hss.domain.my')
+        result = configurator._configure_mme(config)
+
+        self.assertFalse(result.args['unchanged'])
+        mme_config = self.getContent(self.mme_config)
+        self.assertIn('        # S1 interface\n'
+                      '        MME_IPV4_ADDRESS_FOR_S1_MME = "20.0.0.1/24";\n',
+                      mme_config)
+
+    def testInvalidMMEConfig(self):
+        self.writeContent('MME : {\n', self.mme_config)
+
+        configurator = mme_p.MME_Configurator(self.mme_config,
+                                              self.mme_fd_config,
+                                              self.host_file)
+        configurator.getInterfacesName = lambda ip: None
+
+        result = configurator._configure_mme(mme_p.MME_Config(
+            s1_ip = '20.0.0.1/24', hss_host = 'hss.domain.my'))
+        self.assertEqual(result.status, mme_p.P.Result.FAILED)
 
     def testUpdateMMEFDConfig(self):
         IDENTITY = 'Identity'
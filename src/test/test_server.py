@@ -1,6 +1,10 @@
 from son.vmmanager.jsonserver import IJsonProcessor, JsonMsgReaderFactory
+from son.vmmanager.jsonserver import LineFraming, LengthPrefixedFraming
+from son.vmmanager.jsonserver import JsonCodec, MsgPackCodec
+from son.vmmanager.jsonserver import ZlibCompression, DeflateCompression
 
 from twisted.test import proto_helpers
+from twisted.internet import defer
 
 import time
 import threading
@@ -26,6 +30,70 @@ class TestProcessor(IJsonProcessor):
         return IJsonProcessor.Result(IJsonProcessor.Result.OK, self.ANSWER)
 
 
+class OutputProcessor(IJsonProcessor):
+
+    def process(self, json):
+        return IJsonProcessor.Result.ok('Output', output = json['output'])
+
+
+class DeferredProcessor(IJsonProcessor):
+
+    def __init__(self):
+        self.calls = []
+
+    def process(self, json):
+        d = defer.Deferred()
+        self.calls.append((json, d))
+        return d
+
+
+class PendingProcessor(IJsonProcessor):
+
+    def __init__(self):
+        self.calls = []
+
+    def process(self, json):
+        d = defer.Deferred()
+        self.calls.append((json, d))
+        return IJsonProcessor.Pending(d).addCallback(
+            lambda r: IJsonProcessor.Result.ok(r.message, pending = True))
+
+
+class QueryProcessor(DeferredProcessor):
+
+    def isQuery(self, json):
+        return json.get('command') == 'status'
+
+
+class FailingProcessor(IJsonProcessor):
+
+    def process(self, json):
+        raise Exception('Processing failed')
+
+
+class SubscriptionProcessor(IJsonProcessor):
+
+    class Subscription(IJsonProcessor.Subscription):
+
+        def __init__(self):
+            self.push = None
+            self.stopped = False
+            super().__init__(IJsonProcessor.Result.ok('Subscribed'))
+
+        def start(self, push):
+            self.push = push
+
+        def stop(self):
+            self.stopped = True
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def process(self, json):
+        self.subscriptions.append(self.Subscription())
+        return self.subscriptions[-1]
+
+
 class JsonServer(unittest.TestCase):
 
     def testProtocol(self):
@@ -47,7 +115,7 @@ class JsonServer(unittest.TestCase):
 
         answerDict = json.loads(answer.decode('utf-8'))
         self.assertIn(TEST_PROCESSOR, answerDict)
-        testProcessorAnswer = json.loads(answerDict[TEST_PROCESSOR])
+        testProcessorAnswer = answerDict[TEST_PROCESSOR]
 
         self.assertIn(IJsonProcessor.Result.STATUS, testProcessorAnswer)
         self.assertEqual(testProcessorAnswer[IJsonProcessor.Result.STATUS],
@@ -57,3 +125,398 @@ class JsonServer(unittest.TestCase):
         self.assertEqual(testProcessorAnswer[IJsonProcessor.Result.MESSAGE],
                          TestProcessor.ANSWER)
 
+    def testNdjsonProtocol(self):
+        TEST_PROCESSOR = 'testProcessor'
+
+        factory = JsonMsgReaderFactory(framing = LineFraming.NAME)
+        factory.addProcessor(TEST_PROCESSOR, TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        self.proto.dataReceived('{}\n{'.encode('utf-8'))
+        self.proto.dataReceived('}\n'.encode('utf-8'))
+
+        answers = self.tr.value().decode('utf-8').splitlines()
+        self.assertEqual(len(answers), 2)
+        for answer in answers:
+            self.assertIn(TEST_PROCESSOR, json.loads(answer))
+
+    def testInvalidFraming(self):
+        self.assertRaises(Exception, JsonMsgReaderFactory, framing = 'invalid')
+
+    def testOversizedFrame(self):
+        factory = JsonMsgReaderFactory(framing = LineFraming.NAME,
+                                       max_frame_size = 16)
+        factory.addProcessor('testProcessor', TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        self.proto.dataReceived(b'{}\n{"key": "too long value')
+
+        answers = self.tr.value().decode('utf-8').splitlines()
+        self.assertEqual(len(answers), 2)
+        self.assertIn('testProcessor', json.loads(answers[0]))
+        rejection = IJsonProcessor.Result.parse(answers[1])
+        self.assertEqual(rejection.status, IJsonProcessor.Result.FAILED)
+        self.assertTrue(self.tr.disconnecting)
+
+    def testBackpressure(self):
+        factory = JsonMsgReaderFactory()
+        factory.addProcessor('testProcessor', TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+        self.assertIs(self.tr.producer, self.proto)
+
+        self.proto.pauseProducing()
+        self.assertEqual(self.tr.producerState, 'paused')
+        self.proto.resumeProducing()
+        self.assertEqual(self.tr.producerState, 'producing')
+
+    def testSlowConsumerBackpressure(self):
+        slow = DeferredProcessor()
+        factory = JsonMsgReaderFactory(framing = LineFraming.NAME,
+                                       max_frame_size = 32,
+                                       max_buffer_size = 64)
+        factory.addProcessor('slow', slow)
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        self.proto.dataReceived(b'{"id": 1, "pad": "xxxxxxxxxx"}\n')
+        self.proto.dataReceived(b'{"id": 2, "pad": "xxxxxxxxxx"}\n')
+        self.assertEqual(self.tr.producerState, 'producing')
+        self.proto.dataReceived(b'{"id": 3, "pad": "xxxxxxxxxx"}\n')
+        self.assertEqual(self.tr.producerState, 'paused')
+
+        while slow.calls:
+            _, d = slow.calls.pop(0)
+            d.callback(IJsonProcessor.Result.ok('Done'))
+
+        self.assertEqual(self.tr.producerState, 'producing')
+        answers = [json.loads(a) for a in
+                   self.tr.value().decode('utf-8').splitlines()]
+        self.assertEqual([a['id'] for a in answers], [1, 2, 3])
+
+    def testInvalidBufferSize(self):
+        self.assertRaises(Exception, JsonMsgReaderFactory,
+                          max_frame_size = 1024, max_buffer_size = 512)
+
+    def testRequestId(self):
+        factory = JsonMsgReaderFactory(framing = LineFraming.NAME)
+        factory.addProcessor('testProcessor', TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        self.proto.dataReceived(b'{"id": 7}\n{}\n{"id": "x"}\n')
+
+        answers = [json.loads(a) for a in
+                   self.tr.value().decode('utf-8').splitlines()]
+        self.assertEqual([a.get('id') for a in answers], [7, None, 'x'])
+        for answer in answers:
+            self.assertIn('testProcessor', answer)
+
+    def _connect(self, *processors):
+        factory = JsonMsgReaderFactory(framing = LineFraming.NAME)
+        for name, processor in processors:
+            factory.addProcessor(name, processor)
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+    def _answers(self):
+        return [json.loads(a) for a in
+                self.tr.value().decode('utf-8').splitlines()]
+
+    def testDeferredProcessor(self):
+        slow, fast = DeferredProcessor(), DeferredProcessor()
+        self._connect(('slow', slow), ('fast', fast))
+
+        self.proto.dataReceived(b'{"id": 1}\n')
+        self.assertEqual(len(slow.calls), 1)
+        self.assertEqual(len(fast.calls), 1)
+
+        fast.calls[0][1].callback(IJsonProcessor.Result.ok('fast'))
+        self.assertEqual(self._answers(), [])
+        slow.calls[0][1].callback(IJsonProcessor.Result.ok('slow'))
+
+        answers = self._answers()
+        self.assertEqual(len(answers), 1)
+        self.assertEqual(answers[0]['id'], 1)
+        self.assertEqual(answers[0]['slow']['message'], 'slow')
+        self.assertEqual(answers[0]['fast']['message'], 'fast')
+
+    def testProcessorOrdering(self):
+        slow = DeferredProcessor()
+        self._connect(('slow', slow))
+
+        self.proto.dataReceived(b'{"id": 1}\n{"id": 2}\n')
+        # Messages for the same processor are processed one at a time
+        self.assertEqual(len(slow.calls), 1)
+        slow.calls[0][1].callback(IJsonProcessor.Result.ok('first'))
+        self.assertEqual(len(slow.calls), 2)
+        slow.calls[1][1].callback(IJsonProcessor.Result.ok('second'))
+        self.assertEqual([a['id'] for a in self._answers()], [1, 2])
+
+    def testPendingProcessor(self):
+        processor = PendingProcessor()
+        self._connect(('pending', processor))
+
+        self.proto.dataReceived(b'{"id": 1}\n{"id": 2}\n')
+        # The processor is not locked while its result is pending
+        self.assertEqual(len(processor.calls), 2)
+        processor.calls[1][1].callback(IJsonProcessor.Result.ok('second'))
+        processor.calls[0][1].callback(IJsonProcessor.Result.ok('first'))
+
+        answers = self._answers()
+        self.assertEqual([a['id'] for a in answers], [2, 1])
+        result = IJsonProcessor.Result.from_dict(answers[0]['pending'])
+        self.assertEqual(result.status, IJsonProcessor.Result.OK)
+        self.assertEqual(result.args, {'pending': True})
+
+    def testQueryNotQueued(self):
+        processor = QueryProcessor()
+        self._connect(('processor', processor))
+
+        self.proto.dataReceived(b'{"id": 1, "command": "stop"}\n'
+                                b'{"id": 2, "command": "status"}\n'
+                                b'{"id": 3, "command": "start"}\n')
+        # The status is not waiting for the stop, the start is
+        self.assertEqual([c[0]['command'] for c in processor.calls],
+                         ['stop', 'status'])
+        processor.calls[1][1].callback(IJsonProcessor.Result.ok('Status'))
+        self.assertEqual([a['id'] for a in self._answers()], [2])
+
+        processor.calls[0][1].callback(IJsonProcessor.Result.ok('Stopped'))
+        self.assertEqual(len(processor.calls), 3)
+
+    def testFailingProcessor(self):
+        self._connect(('failing', FailingProcessor()),
+                      ('test', TestProcessor()))
+
+        self.proto.dataReceived(b'{}\n')
+
+        answers = self._answers()
+        self.assertEqual(len(answers), 1)
+        failed = IJsonProcessor.Result.from_dict(answers[0]['failing'])
+        self.assertEqual(failed.status, IJsonProcessor.Result.FAILED)
+        ok = IJsonProcessor.Result.from_dict(answers[0]['test'])
+        self.assertEqual(ok.status, IJsonProcessor.Result.OK)
+
+    def testTargetedMessage(self):
+        first, second = DeferredProcessor(), DeferredProcessor()
+        self._connect(('first', first), ('second', second))
+
+        self.proto.dataReceived(b'{"id": 1, "target": "second"}\n')
+        self.assertEqual(len(first.calls), 0)
+        self.assertEqual(len(second.calls), 1)
+
+        self.proto.dataReceived(b'{"id": 2, "target": ["first", "third"]}\n')
+        self.assertEqual(len(first.calls), 1)
+        self.assertEqual(len(second.calls), 1)
+
+        # The reply for the first message does not wait for the second one
+        second.calls[0][1].callback(IJsonProcessor.Result.ok('second'))
+        first.calls[0][1].callback(IJsonProcessor.Result.ok('first'))
+        answers = self._answers()
+        self.assertEqual([a['id'] for a in answers], [1, 2])
+        self.assertEqual(sorted(answers[0]), ['id', 'second'])
+        self.assertEqual(sorted(answers[1]), ['first', 'id', 'third'])
+        unknown = IJsonProcessor.Result.from_dict(answers[1]['third'])
+        self.assertEqual(unknown.status, IJsonProcessor.Result.FAILED)
+
+    def testOutOfOrderReplies(self):
+        slow, fast = DeferredProcessor(), DeferredProcessor()
+        self._connect(('slow', slow), ('fast', fast))
+
+        self.proto.dataReceived(b'{"id": 1, "target": "slow"}\n'
+                                b'{"id": 2, "target": "fast"}\n')
+        fast.calls[0][1].callback(IJsonProcessor.Result.ok('fast'))
+        slow.calls[0][1].callback(IJsonProcessor.Result.ok('slow'))
+        self.assertEqual([a['id'] for a in self._answers()], [2, 1])
+
+    def testInvalidTarget(self):
+        first = DeferredProcessor()
+        self._connect(('first', first))
+
+        self.proto.dataReceived(b'{"target": 12}\n')
+        self.assertEqual(len(first.calls), 0)
+        answers = self._answers()
+        self.assertEqual(list(answers[0]), ['target'])
+
+    def testNestedResults(self):
+        factory = JsonMsgReaderFactory(nested_results = True)
+        factory.addProcessor('testProcessor', TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        self.proto.dataReceived(b'{}')
+
+        answer = json.loads(self.tr.value().decode('utf-8'))
+        result = IJsonProcessor.Result.parse(answer['testProcessor'])
+        self.assertEqual(result.message, TestProcessor.ANSWER)
+
+    def testBinaryCodecRequiresBinaryFraming(self):
+        self.assertRaises(Exception, JsonMsgReaderFactory,
+                          framing = LineFraming.NAME,
+                          codec = MsgPackCodec.NAME)
+        self.assertRaises(Exception, JsonMsgReaderFactory, codec = 'invalid')
+
+    @unittest.skipUnless(MsgPackCodec.available(), 'msgpack is not installed')
+    def testMsgPackListener(self):
+        factory = JsonMsgReaderFactory(framing = LengthPrefixedFraming.NAME,
+                                       codec = MsgPackCodec.NAME)
+        factory.addProcessor('testProcessor', TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        framing, codec = LengthPrefixedFraming(), MsgPackCodec()
+        self.proto.dataReceived(framing.encode(codec.encode({'id': 5})))
+
+        framing.feed(self.tr.value())
+        answer = codec.decode(framing.frames()[0])
+        self.assertEqual(answer['id'], 5)
+        self.assertEqual(answer['testProcessor']['message'],
+                         TestProcessor.ANSWER)
+
+    @unittest.skipUnless(MsgPackCodec.available(), 'msgpack is not installed')
+    def testCodecNegotiation(self):
+        factory = JsonMsgReaderFactory(framing = LengthPrefixedFraming.NAME)
+        factory.addProcessor('testProcessor', TestProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        framing = LengthPrefixedFraming()
+        json_codec, msgpack_codec = JsonCodec(), MsgPackCodec()
+        self.proto.dataReceived(
+            framing.encode(json_codec.encode({'id': 1, 'negotiate':
+                                              {'codec': 'msgpack'}})) +
+            framing.encode(msgpack_codec.encode({'id': 2})))
+
+        framing.feed(self.tr.value())
+        negotiation, answer = framing.frames()
+        negotiation = json_codec.decode(negotiation)
+        self.assertEqual(negotiation['id'], 1)
+        self.assertEqual(negotiation['negotiate']['status'],
+                         IJsonProcessor.Result.OK)
+        self.assertEqual(msgpack_codec.decode(answer)['id'], 2)
+
+    def testFailedNegotiation(self):
+        self._connect(('test', TestProcessor()))
+        self.proto.dataReceived(b'{"negotiate": {"codec": "msgpack"}}\n{}\n')
+
+        negotiation, answer = self._answers()
+        result = IJsonProcessor.Result.from_dict(negotiation['negotiate'])
+        self.assertEqual(result.status, IJsonProcessor.Result.FAILED)
+        self.assertIn('test', answer)
+
+    def testCompressionNegotiation(self):
+        factory = JsonMsgReaderFactory(framing = LengthPrefixedFraming.NAME)
+        factory.addProcessor('output', OutputProcessor())
+        self.proto = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.tr)
+
+        framing, codec = LengthPrefixedFraming(), JsonCodec()
+        messages = [{'negotiate': {'compression': 'zlib',
+                                   'compression_threshold': 100}},
+                    {'id': 1, 'output': 'short'},
+                    {'id': 2, 'output': 'line\n' * 1000}]
+        self.proto.dataReceived(b''.join(framing.encode(codec.encode(m))
+                                         for m in messages))
+
+        framing.feed(self.tr.value())
+        negotiation, short, big = framing.frames()
+        negotiation = codec.decode(negotiation)['negotiate']
+        self.assertEqual(negotiation['status'], IJsonProcessor.Result.OK)
+        self.assertEqual(negotiation['compression'], 'zlib')
+
+        self.assertEqual(short[:1], ZlibCompression.FLAG_PLAIN)
+        self.assertEqual(big[:1], ZlibCompression.FLAG_COMPRESSED)
+        self.assertLess(len(big), 1000)
+
+        compression = ZlibCompression()
+        self.assertEqual(codec.decode(compression.decompress(short))['id'], 1)
+        big = codec.decode(compression.decompress(big))
+        self.assertEqual(big['output']['output'], 'line\n' * 1000)
+
+    def testCompressionRequiresBinaryFraming(self):
+        self._connect(('test', TestProcessor()))
+        self.proto.dataReceived(b'{"negotiate": {"compression": "zlib"}}\n'
+                                b'{"negotiate": {"compression": "lzma"}}\n'
+                                b'{"negotiate": {"compression_threshold": 1}}\n')
+
+        for answer in self._answers():
+            result = IJsonProcessor.Result.from_dict(answer['negotiate'])
+            self.assertEqual(result.status, IJsonProcessor.Result.FAILED)
+
+    def testCompressionRoundTrip(self):
+        data = b'{"output": "%s"}' % (b'x' * 4096)
+        for compression in [ZlibCompression(), DeflateCompression()]:
+            compressed = compression.compress(data)
+            self.assertLess(len(compressed), len(data))
+            self.assertEqual(compression.decompress(compressed), data)
+
+        self.assertRaises(ValueError, ZlibCompression().decompress, b'\x01abc')
+
+    def testSubscription(self):
+        processor = SubscriptionProcessor()
+        self._connect(('sub', processor))
+
+        self.proto.dataReceived(b'{"id": 7}\n')
+        subscription, = processor.subscriptions
+        subscription.push({'line': 'first'})
+        subscription.push({'line': 'second'})
+
+        reply, first, second = self._answers()
+        self.assertEqual(reply['sub']['message'], 'Subscribed')
+        self.assertEqual(first, {'id': 7, 'sub': {'line': 'first'}})
+        self.assertEqual(second['sub']['line'], 'second')
+
+        self.tr.clear()
+        self.proto.dataReceived(b'{"id": 8, "cancel": 7}\n')
+        subscription.push({'line': 'third'})
+
+        cancel, = self._answers()
+        self.assertEqual(cancel['id'], 8)
+        self.assertEqual(cancel['cancel']['status'], IJsonProcessor.Result.OK)
+        self.assertTrue(subscription.stopped)
+
+    def testSubscriptionStoppedOnDisconnect(self):
+        processor = SubscriptionProcessor()
+        self._connect(('sub', processor))
+
+        self.proto.dataReceived(b'{"id": 1}\n{"id": 2}\n')
+        self.proto.connectionLost(None)
+
+        self.assertEqual([s.stopped for s in processor.subscriptions],
+                         [True, True])
+
+    def testSubscriptionDropsWhenBlocked(self):
+        processor = SubscriptionProcessor()
+        self._connect(('sub', processor))
+
+        self.proto.dataReceived(b'{"id": 1}\n')
+        subscription, = processor.subscriptions
+        self.proto.pauseProducing()
+        subscription.push({'line': 'lost'})
+        subscription.push({'line': 'lost'})
+        self.proto.resumeProducing()
+        subscription.push({'line': 'kept'})
+
+        reply, kept = self._answers()
+        self.assertEqual(kept['sub'], {'line': 'kept', 'dropped': 2})
+
+    def testCancelUnknown(self):
+        self._connect(('test', TestProcessor()))
+        self.proto.dataReceived(b'{"cancel": 5}\n')
+
+        cancel, = self._answers()
+        self.assertEqual(cancel['cancel']['status'],
+                         IJsonProcessor.Result.FAILED)
@@ -1,5 +1,6 @@
 import son.vmmanager.processors.spgw_processor as spgw_p
 from son.vmmanager.processors.utils import CommandConfig
+from son.vmmanager.jsonserver import IJsonProcessor as P
 
 from unittest.mock import patch
 from unittest.mock import Mock
@@ -18,7 +19,7 @@ class SPGW_Processor(unittest.TestCase):
     def testProcess(self, SPGW_MessageParserMock, SPGW_ConfiguratorMock, RunnerMock):
         SPGW_MessageParserMock.return_value = Mock(wraps = SPGW_MessageParserMock)
         SPGW_ConfiguratorMock.return_value = Mock(wraps = SPGW_ConfiguratorMock)
-        RunnerMock.return_value = Mock(wraps = RunnerMock)
+        RunnerMock.from_options.return_value = Mock(wraps = RunnerMock)
 
         config_dict = {}
 
@@ -31,7 +32,7 @@ class SPGW_Processor(unittest.TestCase):
         SPGW_ConfiguratorMock.assert_called_once()
         SPGW_ConfiguratorMock.configure.assert_called_once()
 
-        RunnerMock.assert_called_once()
+        RunnerMock.from_options.assert_called_once()
 
     @patch('son.vmmanager.processors.utils.Runner')
     @patch('son.vmmanager.processors.spgw_processor.SPGW_Configurator')
@@ -42,7 +43,7 @@ class SPGW_Processor(unittest.TestCase):
         SPGW_MessageParserMock.parse.return_value = spgw_p.SPGW_Config(
             command = CommandConfig.START)
         SPGW_ConfiguratorMock.return_value = Mock(wraps = SPGW_ConfiguratorMock)
-        RunnerMock.return_value = Mock(wraps = RunnerMock)
+        RunnerMock.from_options.return_value = Mock(wraps = RunnerMock)
 
         config_dict = {}
 
@@ -55,7 +56,7 @@ class SPGW_Processor(unittest.TestCase):
         SPGW_ConfiguratorMock.assert_called_once()
         SPGW_ConfiguratorMock.configure.assert_called_once()
 
-        RunnerMock.assert_called_once()
+        RunnerMock.from_options.assert_called_once()
         RunnerMock.start.assert_called_once()
 
         SPGW_MessageParserMock.parse.return_value = spgw_p.SPGW_Config(
@@ -71,10 +72,27 @@ class SPGW_Processor(unittest.TestCase):
         RunnerMock.restart.assert_called_once()
 
         SPGW_MessageParserMock.parse.return_value = spgw_p.SPGW_Config(
-            command = CommandConfig.STATUS)
+            command = CommandConfig.STATUS, since = 42)
+        RunnerMock.getOutputSince.return_value = ('out', 'err', 43)
+        SPGW_ConfiguratorMock.configure.return_value = P.Result.ok(
+            'SPGW is configured', unchanged = True)
+        result = processor.process(config_dict)
+
+        RunnerMock.getOutputSince.assert_called_once_with(42)
+        self.assertEqual(result.args['stdout'], 'out')
+        self.assertEqual(result.args['cursor'], 43)
+        self.assertTrue(result.args['unchanged'])
+
+        SPGW_MessageParserMock.parse.return_value = spgw_p.SPGW_Config(
+            command = CommandConfig.SEARCH, pattern = 'ERROR', context = 2)
         processor.process(config_dict)
 
-        self.assertEqual(RunnerMock.getOutput.call_count, 2)
+        RunnerMock.search.assert_called_once_with('ERROR', stream = None,
+                                                  since = None, until = None,
+                                                  context = 2,
+                                                  max_matches = None,
+                                                  logs = False,
+                                                  log_file = None)
 
 
 class SPGW_MsgParser(unittest.TestCase):
@@ -147,11 +165,19 @@ class SPGW_Configurator(unittest.TestCase):
         SGI_INTERFACE = 'PGW_INTERFACE_NAME_FOR_SGI'
         S1U_IP = 'SGW_IPV4_ADDRESS_FOR_S1U_S12_S4_UP'
         PGW_MASQ = 'PGW_MASQUERADE_SGI'
+        self.writeContent('S-GW : {\n', self.spgw_config)
+        self.writeContent('NETWORK_INTERFACES : {\n', self.spgw_config)
         self.writeContent('%s = "lo"\n' % S11_INTERFACE, self.spgw_config)
         self.writeContent('%s = "1.1.1.1/8"\n' % S11_IP, self.spgw_config)
-        self.writeContent('%s = "eth2"\n' % SGI_INTERFACE, self.spgw_config)
         self.writeContent('%s = "3.3.3.3/32"\n' % S1U_IP, self.spgw_config)
+        self.writeContent('};\n', self.spgw_config)
+        self.writeContent('};\n', self.spgw_config)
+        self.writeContent('P-GW = {\n', self.spgw_config)
+        self.writeContent('NETWORK_INTERFACES : {\n', self.spgw_config)
+        self.writeContent('%s = "eth2"\n' % SGI_INTERFACE, self.spgw_config)
         self.writeContent('%s = "no"\n' % PGW_MASQ, self.spgw_config)
+        self.writeContent('};\n', self.spgw_config)
+        self.writeContent('};\n', self.spgw_config)
 
         CONF_S11_INTERFACE = 'eth0'
         CONF_SGI_INTERFACE = 'eth2'
@@ -181,9 +207,13 @@ class SPGW_Configurator(unittest.TestCase):
         configurator.configure(config)
 
         spgw_config = self.getContent(self.spgw_config)
-        self.assertEqual(len(spgw_config.splitlines()), 5)
+        self.assertEqual(len(spgw_config.splitlines()), 13)
         self.assertIn('%s = "%s"' % (S11_INTERFACE, CONF_S11_INTERFACE), spgw_config)
         self.assertIn('%s = "%s"' % (S11_IP, SPGW_IP), spgw_config)
         self.assertIn('%s = "%s"' % (SGI_INTERFACE, CONF_SGI_INTERFACE), spgw_config)
         self.assertIn('%s = "%s"' % (S1U_IP, CONF_S1U_IP), spgw_config)
         self.assertIn('%s = "%s"' % (PGW_MASQ, 'yes'), spgw_config)
+
+        result = configurator.configure(config)
+        self.assertTrue(result.args['unchanged'])
+        self.assertEqual(self.getContent(self.spgw_config), spgw_config)
@@ -1,7 +1,19 @@
 from son.vmmanager.processors import utils
 
+from twisted.trial import unittest as trial
+from twisted.internet import defer, reactor, task, threads
+
+import errno
+import psutil
+import itertools
+import re
+import socket
+import threading
 import tempfile
+import shutil
+import gzip
 import unittest
+from unittest.mock import patch
 import logging
 import os.path
 
@@ -14,43 +26,893 @@ class ConfigurationHelper(unittest.TestCase):
         lo = ch.getInterfacesName('127.0.0.1/24')
         self.assertIsNotNone(lo)
 
+    def testWriteOutUnchanged(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        path = os.path.join(config_dir, 'config')
+        with open(path, 'w') as f:
+            f.write('a = "1";\n')
+
+        ch = utils.ConfiguratorHelpers()
+        self.assertFalse(ch.write_out('a = "1";\n', path))
+        self.assertEqual(os.listdir(config_dir), ['config'])
+
+        self.assertTrue(ch.write_out('a = "2";\n', path))
+        self.assertEqual(len(os.listdir(config_dir)), 2)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'a = "2";\n')
+
+    def testWriteOutReplaces(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        path = os.path.join(config_dir, 'config')
+        link = os.path.join(config_dir, 'link')
+        with open(path, 'w') as f:
+            f.write('old\n')
+        os.chmod(path, 0o640)
+        os.symlink(path, link)
+        inode = os.stat(path).st_ino
+
+        ch = utils.ConfiguratorHelpers()
+        self.assertTrue(ch.write_out('new\n', link))
+
+        self.assertTrue(os.path.islink(link))
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        backups = [n for n in os.listdir(config_dir) if n.endswith('.back')]
+        self.assertEqual(len(backups), 1)
+        self.assertEqual(os.stat(os.path.join(config_dir, backups[0])).st_ino,
+                         inode)
+        self.assertEqual(sorted(os.listdir(config_dir)),
+                         sorted(['config', 'link'] + backups))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new\n')
+
+    def testWriteOutWithoutLink(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        path = os.path.join(config_dir, 'config')
+        with open(path, 'w') as f:
+            f.write('old\n')
+        inode = os.stat(path).st_ino
+
+        ch = utils.ConfiguratorHelpers()
+        error = PermissionError(errno.EPERM, 'Operation not permitted')
+        with patch('os.link', side_effect = error):
+            self.assertTrue(ch.write_out('new\n', path))
+
+        self.assertNotEqual(os.stat(path).st_ino, inode)
+        backup, = [n for n in os.listdir(config_dir) if n.endswith('.back')]
+        with open(os.path.join(config_dir, backup)) as f:
+            self.assertEqual(f.read(), 'old\n')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new\n')
+
+    def testWriteOutInPlace(self):
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        path = os.path.join(config_dir, 'config')
+        with open(path, 'w') as f:
+            f.write('old\n')
+        inode = os.stat(path).st_ino
+
+        ch = utils.ConfiguratorHelpers()
+        error = OSError(errno.EBUSY, 'Device or resource busy')
+        with patch('os.replace', side_effect = error):
+            self.assertTrue(ch.write_out('new\n', path))
+
+        self.assertEqual(os.stat(path).st_ino, inode)
+        backup, = [n for n in os.listdir(config_dir) if n.endswith('.back')]
+        with open(os.path.join(config_dir, backup)) as f:
+            self.assertEqual(f.read(), 'old\n')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new\n')
+
+    def testMergeResult(self):
+        config_result = utils.P.Result.ok('Configured', unchanged = True)
+
+        result = utils.merge_result(utils.P.Result.ok('Status', cursor = 1),
+                                    config_result)
+        self.assertEqual(result.args, {'unchanged': True, 'cursor': 1})
+
+        d = defer.Deferred()
+        fired = []
+        utils.merge_result(d, config_result).addCallback(fired.append)
+        d.callback(utils.P.Result.ok('Started'))
+        self.assertEqual(fired[0].args, {'unchanged': True})
+
+
+class OutputBuffer(unittest.TestCase):
+
+    def testDropsOldLines(self):
+        buf = utils.OutputBuffer(10)
+        for line in ['aaaa\n', 'bbbb\n', 'cccc\n']:
+            buf.append(line)
+
+        self.assertEqual(buf.getvalue(), 'bbbb\ncccc\n')
+        stats = buf.stats()
+        self.assertEqual(stats['lines_seen'], 3)
+        self.assertEqual(stats['bytes_seen'], 15)
+        self.assertEqual(stats['lines_dropped'], 1)
+        self.assertEqual(stats['bytes_dropped'], 5)
+        self.assertEqual(stats['buffered_bytes'], 10)
+
+    def testTruncatesLongLine(self):
+        buf = utils.OutputBuffer(4)
+        buf.append('abcdefgh')
+
+        self.assertEqual(buf.getvalue(), 'efgh')
+        self.assertEqual(buf.stats()['bytes_dropped'], 4)
+        self.assertEqual(len(buf), 4)
+
+    def testSizeInBytes(self):
+        buf = utils.OutputBuffer(5)
+        buf.append('\u00e4\u00e4\n')
+        buf.append('\u00f6\u00f6\u00f6\n')
+
+        self.assertEqual(buf.getvalue(), '\u00f6\u00f6\n')
+        self.assertEqual(len(buf), 5)
+        stats = buf.stats()
+        self.assertEqual(stats['bytes_seen'], 12)
+        self.assertEqual(stats['bytes_dropped'], 7)
+
+    def testClear(self):
+        buf = utils.OutputBuffer(10)
+        buf.append('line\n')
+        buf.clear()
+
+        self.assertEqual(buf.getvalue(), '')
+        self.assertEqual(buf.stats()['lines_seen'], 0)
+
+    def testSince(self):
+        buf = utils.OutputBuffer(100)
+        for line in ['a\n', 'b\n', 'c\n']:
+            buf.append(line)
+
+        self.assertEqual(buf.last_seq, 3)
+        self.assertEqual(buf.getvalue(since = 1), 'b\nc\n')
+        self.assertEqual(buf.getvalue(since = 1, until = 2), 'b\n')
+        self.assertEqual(buf.getvalue(since = 3), '')
+
+    def testSharedSequence(self):
+        sequence, lock = itertools.count(1), threading.Lock()
+        out = utils.OutputBuffer(100, sequence, lock)
+        err = utils.OutputBuffer(100, sequence, lock)
+        out.append('out1\n')
+        err.append('err2\n')
+        out.append('out3\n')
+
+        self.assertEqual(out.getvalue(since = 1), 'out3\n')
+        self.assertEqual(err.getvalue(since = 1), 'err2\n')
+
+    def testSubscribe(self):
+        buf = utils.OutputBuffer(100)
+        lines = []
+        listener = lambda seq, line: lines.append((seq, line))
+        buf.subscribe(listener)
+        buf.append('a\n')
+        buf.unsubscribe(listener)
+        buf.append('b\n')
+
+        self.assertEqual(lines, [(1, 'a\n')])
+
+
+class ConfigFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.path = os.path.join(self.config_dir, 'config')
+        with open(self.path, 'w') as f:
+            f.write('A = "1";\n')
+
+    def testInvalidatedByChange(self):
+        cache = utils.ConfigFileCache()
+        config_file = cache.get(self.path)
+        self.assertEqual(config_file.lines, ['A = "1";\n'])
+        self.assertIs(cache.get(self.path), config_file)
+
+        with open(self.path, 'a') as f:
+            f.write('B = "2";\n')
+        self.assertEqual(cache.get(self.path).lines,
+                         ['A = "1";\n', 'B = "2";\n'])
+
+    def testSubstituteSkipsReads(self):
+        rules = utils.SubstitutionRules(
+            a = utils.SubstitutionRule.assignment('A', r'\d'))
+        ch = utils.ConfiguratorHelpers(utils.ConfigFileCache())
+        self.assertTrue(ch.substitute(rules, self.path, a = '2'))
+
+        with patch('builtins.open', side_effect = AssertionError):
+            self.assertFalse(ch.substitute(rules, self.path, a = '2'))
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'A = "2";\n')
+
+
+class SubstitutionRules(unittest.TestCase):
+
+    RULES = utils.SubstitutionRules(
+        ip = utils.SubstitutionRule.assignment('ADDRESS', utils.RE_IPV4),
+        realm = utils.SubstitutionRule.assignment('[Rr]ealm', utils.RE_NAME))
+
+    def testAssignmentKey(self):
+        self.assertEqual(self.RULES.rules['ip'].key, 'ADDRESS')
+        self.assertEqual(self.RULES.rules['realm'].key, 'ealm')
+
+    def testApply(self):
+        lines = ['ADDRESS = "1.2.3.4";\n',
+                 'Realm = "old.realm";\n',
+                 'OTHER = "1.2.3.4";\n']
+        content = self.RULES.apply(lines, ip = '10.0.0.1', realm = None)
+        self.assertEqual(content, 'ADDRESS = "10.0.0.1";\n'
+                                  'Realm = "old.realm";\n'
+                                  'OTHER = "1.2.3.4";\n')
+
+        content = self.RULES.apply(lines, realm = 'new.realm')
+        self.assertIn('Realm = "new.realm";\n', content)
+        self.assertIn('ADDRESS = "1.2.3.4";\n', content)
+
+
+class CommandMessageParser(unittest.TestCase):
+
+    def testSince(self):
+        cc = utils.CommandMessageParser({'command': 'status',
+                                         'since': 12}).parse()
+        self.assertEqual(cc.command, utils.CommandConfig.STATUS)
+        self.assertEqual(cc.since, 12)
+
+        cc = utils.CommandMessageParser({'since': 'latest'}).parse()
+        self.assertIsNone(cc.since)
+
+    def testTail(self):
+        cc = utils.CommandMessageParser({'command': 'tail',
+                                         'stream': 'stderr',
+                                         'pattern': 'ERROR'}).parse()
+        self.assertEqual(cc.command, utils.CommandConfig.TAIL)
+        self.assertEqual(cc.stream, 'stderr')
+        self.assertEqual(cc.pattern, 'ERROR')
+
+    def testWaitReady(self):
+        cc = utils.CommandMessageParser({'command': 'start',
+                                         'wait_ready': True}).parse()
+        self.assertTrue(cc.wait_ready)
+
+        cc = utils.CommandMessageParser({'wait_ready': 'yes'}).parse()
+        self.assertFalse(cc.wait_ready)
+
+    def testSearch(self):
+        cc = utils.CommandMessageParser({'command': 'search',
+                                         'pattern': 'ERROR',
+                                         'until': 20, 'context': 3,
+                                         'max_matches': 5,
+                                         'logs': True,
+                                         'log_file': 'stdout.1.gz'}).parse()
+        self.assertEqual(cc.command, utils.CommandConfig.SEARCH)
+        self.assertEqual((cc.until, cc.context, cc.max_matches, cc.logs,
+                          cc.log_file), (20, 3, 5, True, 'stdout.1.gz'))
+
+        cc = utils.CommandMessageParser({'context': -1,
+                                         'max_matches': 0}).parse()
+        self.assertEqual((cc.context, cc.max_matches), (0, None))
+
+    def testIsQuery(self):
+        parser = utils.CommandMessageParser
+        self.assertTrue(parser.isQuery({'id': 1, 'command': 'status',
+                                        'since': 4}))
+        self.assertTrue(parser.isQuery({'command': 'search',
+                                        'pattern': 'ERROR'}))
+        self.assertFalse(parser.isQuery({'command': 'start'}))
+        self.assertFalse(parser.isQuery({'command': 'status',
+                                         'sgi_ip': '10.0.0.1/24'}))
+        self.assertFalse(parser.isQuery({'command': ['status']}))
+        self.assertFalse(parser.isQuery({}))
+
+class OutputSearch(unittest.TestCase):
+
+    LINES = list(enumerate(['a\n', 'ERROR 1\n', 'b\n', 'c\n',
+                            'ERROR 2\n', 'd\n'], 1))
+
+    def testContext(self):
+        search = utils.OutputSearch(re.compile('ERROR'), context = 1)
+        self.assertTrue(search.search(self.LINES, 'seq', stream = 'stdout'))
+        self.assertEqual(search.matches, [
+            {'seq': 2, 'stream': 'stdout', 'line': 'ERROR 1\n',
+             'before': ['a\n'], 'after': ['b\n']},
+            {'seq': 5, 'stream': 'stdout', 'line': 'ERROR 2\n',
+             'before': ['c\n'], 'after': ['d\n']}])
+
+    def testContextOverParts(self):
+        search = utils.OutputSearch(re.compile('ERROR'), context = 1)
+        search.search(self.LINES[:2], 'seq')
+        search.search(self.LINES[2:], 'seq')
+        self.assertEqual([(m['before'], m['after']) for m in search.matches],
+                         [(['a\n'], ['b\n']), (['c\n'], ['d\n'])])
+
+    def testTruncated(self):
+        search = utils.OutputSearch(re.compile('ERROR'), context = 2,
+                                    max_matches = 1)
+        self.assertFalse(search.search(self.LINES, 'seq'))
+        self.assertTrue(search.truncated)
+        self.assertEqual(len(search.matches), 1)
+        self.assertEqual(search.matches[0]['after'], ['b\n', 'c\n'])
+
+
+class ReadinessProbe(unittest.TestCase):
+
+    def testPattern(self):
+        probe = utils.ReadinessProbe(pattern = 'listening on \\d+')
+        self.assertFalse(probe.check())
+        self.assertFalse(probe.match('starting\n'))
+        self.assertTrue(probe.match('listening on 3868\n'))
+        self.assertTrue(probe.check())
+
+        probe.reset()
+        self.assertFalse(probe.check())
+
+    def testPort(self):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+        probe = utils.ReadinessProbe(port = port)
+        self.assertFalse(probe.check())
+        sock.listen(1)
+        self.assertTrue(probe.check())
+
+    def testFile(self):
+        path = os.path.join(tempfile.mkdtemp(), 'ready')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+
+        probe = utils.ReadinessProbe(path = path)
+        self.assertFalse(probe.check())
+        open(path, 'w').close()
+        self.assertTrue(probe.check())
+
+    def testInvalidPattern(self):
+        self.assertRaises(ValueError, utils.ReadinessProbe, pattern = '(')
+
+
+class MetricsRing(unittest.TestCase):
+
+    def testWrapsAround(self):
+        ring = utils.MetricsRing(3)
+        for i in range(5):
+            ring.append(time = i, rss = i * 10)
+
+        samples = ring.samples()
+        self.assertEqual(len(ring), 3)
+        self.assertEqual(samples['time'], [2, 3, 4])
+        self.assertEqual(samples['rss'], [20, 30, 40])
+        self.assertEqual(samples['cpu_percent'], [0, 0, 0])
+
+    def testPartial(self):
+        ring = utils.MetricsRing(3)
+        ring.append(time = 1)
+
+        self.assertEqual(ring.samples()['time'], [1])
+        ring.clear()
+        self.assertEqual(ring.samples()['time'], [])
+
+
+class RotatingLogFile(trial.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        self.path = os.path.join(self.log_dir, 'stdout')
+
+    def _content(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def testBuffered(self):
+        log = utils.RotatingLogFile(self.path)
+        log.write('first\n')
+        self.assertEqual(self._content(self.path), '')
+
+        log.FLUSH_SIZE = 10
+        log.write('second\n')
+        self.assertEqual(self._content(self.path), 'first\nsecond\n')
+        return log.close()
+
+    def testFlushInterval(self):
+        log = utils.RotatingLogFile(self.path)
+        log.FLUSH_INTERVAL = 0.01
+        log.write('line\n')
 
-class Runner(unittest.TestCase):
+        d = task.deferLater(reactor, 0.05, lambda: None)
+        d.addCallback(lambda _: self.assertEqual(self._content(self.path),
+                                                 'line\n'))
+        return d.addCallback(lambda _: log.close())
+
+    @defer.inlineCallbacks
+    def testRotation(self):
+        log = utils.RotatingLogFile(self.path, max_size = 10, backups = 2)
+        for i in range(4):
+            log.write('segment %d\n' % i)
+            log.flush()
+            yield log.close()
+            log = utils.RotatingLogFile(self.path, max_size = 10, backups = 2)
+        yield log.close()
+
+        self.assertEqual(sorted(os.listdir(self.log_dir)),
+                         ['stdout', 'stdout.1.gz', 'stdout.2.gz'])
+        self.assertEqual(self._content(self.path), '')
+        with gzip.open(self.path + '.1.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'segment 3\n')
+        with gzip.open(self.path + '.2.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'segment 2\n')
+
+    @defer.inlineCallbacks
+    def testReopenWhileCompressing(self):
+        compress = utils.RotatingLogFile._compress
+        release = threading.Event()
+        def slowCompress(segment):
+            release.wait(5)
+            compress(segment)
+        patcher = patch.object(utils.RotatingLogFile, '_compress',
+                               staticmethod(slowCompress))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        log = utils.RotatingLogFile(self.path, max_size = 10, backups = 2)
+        log.write('first run\n')
+        log.flush()
+        closed = log.close()
+
+        # A restarted task opens the log file again before the segment
+        # of its last run is compressed
+        log = utils.RotatingLogFile(self.path, max_size = 10, backups = 2)
+        log.write('second run\n')
+        log.flush()
+        self.assertEqual(self._content(self.path + '.1'), 'first run\n')
+        self.assertEqual(self._content(self.path), 'second run\n')
+
+        release.set()
+        yield closed
+        log.flush()
+        yield log.close()
+
+        with gzip.open(self.path + '.1.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'second run\n')
+        with gzip.open(self.path + '.2.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'first run\n')
+
+    def testSegments(self):
+        for name in ['stdout.2.gz', 'stdout.1.gz', 'stdout']:
+            open(os.path.join(self.log_dir, name), 'w').close()
+
+        segments = utils.RotatingLogFile.segments(self.path)
+        self.assertEqual([os.path.basename(p) for p in segments],
+                         ['stdout.2.gz', 'stdout.1.gz', 'stdout'])
+
+    def testAppends(self):
+        with open(self.path, 'w') as f:
+            f.write('old\n')
+
+        log = utils.RotatingLogFile(self.path)
+        log.write('new\n')
+        log.close()
+        self.assertEqual(self._content(self.path), 'old\nnew\n')
+
+
+class Runner(trial.TestCase):
 
     def setUp(self):
         self.logger = logging.getLogger('test.%s' % Runner.__name__)
 
     def tearDown(self):
         if self.task.isRunning():
-            self.task.stop()
+            return self.task.stop()
+
+    def _runTask(self, *args, **kwargs):
+        self.task = utils.Runner(*args, **kwargs)
+        result = self.task.start()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        return self.task.whenExited().addCallback(lambda _: self.task.stop())
 
+    @defer.inlineCallbacks
     def testStart(self):
-        self.task = utils.Runner('echo Test text', start_shell=True)
-        self.task.start()
-        while self.task.isRunning(): pass
-        self.task.stop()
+        result = yield self._runTask('echo Test text', start_shell=True)
+        self.assertEqual(result.status, utils.P.Result.OK)
         self.assertIn('Test text', self.task.getOutput())
+        self.assertEqual(self.task.getReturnCode(), 0)
+
+    def testStartMissingExecutable(self):
+        self.task = utils.Runner('/nonexistent/executable')
+        result = self.task.start()
+        self.assertEqual(result.status, utils.P.Result.FAILED)
+        self.assertFalse(self.task.isRunning())
+
+    @defer.inlineCallbacks
+    def testStop(self):
+        self.task = utils.Runner('sleep 10', start_shell=True)
+        self.task.start()
+        self.assertTrue(self.task.isRunning())
+        self.assertEqual(self.task.start().status, utils.P.Result.FAILED)
+
+        result = yield self.task.stop()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertFalse(self.task.isRunning())
+        self.assertEqual(self.task.stop().status, utils.P.Result.WARNING)
+
+    @defer.inlineCallbacks
+    def testStopReportsShutdownTime(self):
+        self.task = utils.Runner('sleep 10', start_shell=True)
+        self.task.start()
+
+        result = yield self.task.stop()
+        self.assertEqual(result.args['killed'], 0)
+        self.assertLess(result.args['shutdown_time'], 1)
 
+    @defer.inlineCallbacks
+    def testStopKillsTask(self):
+        self.task = utils.Runner('trap "" TERM; echo ready; '
+                                 'while true; do sleep 0.1; done',
+                                 start_shell=True, stop_timeout=0.3)
+        self.task.start()
+        yield self._waitForOutput('ready')
+
+        result = yield self.task.stop()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertGreaterEqual(result.args['shutdown_time'], 0.3)
+        self.assertGreaterEqual(result.args['killed'], 1)
+        self.assertFalse(self.task.isRunning())
+
+    @defer.inlineCallbacks
+    def testStopKillsChildren(self):
+        self.task = utils.Runner('sh -c \'trap "" TERM; echo ready; '
+                                 'while true; do sleep 0.1; done\'; true',
+                                 start_shell=True, stop_timeout=0.3)
+        self.task.start()
+        yield self._waitForOutput('ready')
+
+        result = yield self.task.stop()
+        self.assertGreaterEqual(result.args['killed'], 1)
+        self.assertFalse(self.task.isRunning())
+
+    @defer.inlineCallbacks
+    def testStopChildrenAccessDenied(self):
+        self.task = utils.Runner('sh -c \'echo ready; sleep 1\'; true',
+                                 start_shell=True, stop_timeout=0.3)
+        self.task.start()
+        yield self._waitForOutput('ready')
+        pid = self.task._process.pid
+        children = psutil.Process(pid).children(recursive=True)
+        self.addCleanup(lambda: [c.kill() for c in children
+                                 if c.is_running()])
+
+        # Children owned by another user can not be signalled
+        send_signal, kill = psutil.Process.send_signal, psutil.Process.kill
+        def denied(method):
+            def call(proc, *args):
+                if proc.pid != pid:
+                    raise psutil.AccessDenied(proc.pid)
+                return method(proc, *args)
+            return call
+        Process = psutil.Process
+        with patch.object(Process, 'send_signal', denied(send_signal)), \
+                patch.object(Process, 'kill', denied(kill)):
+            result = yield self.task.stop()
+
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertEqual(result.args['killed'], 0)
+        self.assertFalse(self.task.isRunning())
+
+    @defer.inlineCallbacks
+    def testConcurrentStop(self):
+        self.task = utils.Runner('sleep 10', start_shell=True)
+        self.task.start()
+
+        results = yield defer.gatherResults([self.task.stop(),
+                                             self.task.stop()])
+        self.assertEqual([r.status for r in results],
+                         [utils.P.Result.OK] * 2)
+
+    @defer.inlineCallbacks
+    def testMetrics(self):
+        yield self._runTask('sleep 0.3 & sleep 0.3; wait', start_shell=True,
+                            sample_interval=0.05, sample_history=4)
+
+        metrics = self.task.getMetrics()
+        self.assertEqual(len(metrics['time']), 4)
+        self.assertEqual(metrics['time'], sorted(metrics['time']))
+        self.assertTrue(all(rss > 0 for rss in metrics['rss']))
+        self.assertTrue(all(n >= 1 for n in metrics['num_threads']))
+
+    @defer.inlineCallbacks
+    def _waitForOutput(self, text):
+        while text not in self.task.getOutput():
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
     def testLogFile(self):
-        with tempfile.TemporaryDirectory() as log_dir:
-            self.task = utils.Runner('echo Test text',
-                                     log_dir = log_dir,
-                                     start_shell=True)
-            self.task.start()
-            while self.task.isRunning(): pass
-            self.task.stop()
-            self.assertIn('Test text', self.task.getOutput())
-            self.assertEqual('', self.task.getOutput(stderr = True))
-
-            stdout_content = ""
-            with open(os.path.join(log_dir, "stdout")) as log_file:
-                for line in log_file:
-                    stdout_content += line
-
-            stderr_content = ""
-            with open(os.path.join(log_dir, "stderr")) as log_file:
-                for line in log_file:
-                    stderr_content += line
-
-            self.assertIn('Test text', stdout_content)
-            self.assertEqual('', stderr_content)
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        yield self._runTask('echo Test text', log_dir = log_dir,
+                            start_shell=True)
+        self.assertIn('Test text', self.task.getOutput())
+        self.assertEqual('', self.task.getOutput(stderr = True))
+
+        stdout_content = ""
+        with open(os.path.join(log_dir, "stdout")) as log_file:
+            for line in log_file:
+                stdout_content += line
+
+        stderr_content = ""
+        with open(os.path.join(log_dir, "stderr")) as log_file:
+            for line in log_file:
+                stderr_content += line
+
+        self.assertIn('Test text', stdout_content)
+        self.assertEqual('', stderr_content)
+
+    @defer.inlineCallbacks
+    def testPartialLines(self):
+        yield self._runTask('printf "a\\nb"; sleep 0.1; printf "c\\nd"',
+                            start_shell=True)
+        self.assertEqual(self.task.getOutput(), 'a\nbc\nd')
+        self.assertEqual(self.task.getOutputStats()['lines_seen'], 3)
+
+    @defer.inlineCallbacks
+    def testLongLine(self):
+        yield self._runTask('head -c 1000 /dev/zero | tr "\\0" a; '
+                            'sleep 0.1; echo b',
+                            start_shell=True, output_buffer_size=100)
+
+        output = self.task.getOutput()
+        self.assertLessEqual(len(output), 100)
+        self.assertTrue(output.endswith('b\n'))
+        self.assertEqual(self.task.getOutputStats()['lines_seen'], 2)
+
+    @defer.inlineCallbacks
+    def testOutputBufferSize(self):
+        yield self._runTask('seq 1000', start_shell=True,
+                            output_buffer_size=100)
+
+        output = self.task.getOutput()
+        self.assertLessEqual(len(output), 100)
+        self.assertTrue(output.endswith('1000\n'))
+        stats = self.task.getOutputStats()
+        self.assertEqual(stats['lines_seen'], 1000)
+        self.assertGreater(stats['lines_dropped'], 0)
+
+    @defer.inlineCallbacks
+    def testOutputSince(self):
+        yield self._runTask('echo out; echo err >&2', start_shell=True)
+
+        stdout, stderr, cursor = self.task.getOutputSince()
+        self.assertEqual((stdout, stderr, cursor), ('out\n', 'err\n', 2))
+        self.assertEqual(self.task.getOutputSince(cursor), ('', '', 2))
+
+    def testFromOptions(self):
+        self.task = utils.Runner.from_options('true', 'runner.test',
+                                              supervise = 'yes',
+                                              ready_port = '8080',
+                                              ready_timeout = '5')
+        self.assertTrue(self.task._supervise)
+        self.assertEqual(self.task._probe.port, 8080)
+        self.assertEqual(self.task._ready_timeout, 5.0)
+        self.assertTrue(os.path.isdir(self.task._log_dir))
+        self.assertTrue(os.path.basename(self.task._log_dir)
+                        .startswith('runner.test'))
+
+        log_dir = os.path.join(tempfile.mkdtemp(), 'logs')
+        self.addCleanup(shutil.rmtree, os.path.dirname(log_dir))
+        self.task = utils.Runner.from_options('true', 'runner.test',
+                                              log_dir = log_dir)
+        self.assertTrue(os.path.isdir(log_dir))
+
+    def testTail(self):
+        self.task = utils.Runner('true')
+        pushed = []
+        subscription = self.task.tail(stream = 'stderr', pattern = 'ERR')
+        subscription.start(pushed.append)
+        self.task._std_contents[1].append('ERROR on stdout\n')
+        self.task._std_contents[2].append('INFO on stderr\n')
+        self.task._std_contents[2].append('ERROR on stderr\n')
+        subscription.stop()
+        self.task._std_contents[2].append('ERROR after stop\n')
+
+        self.assertEqual(pushed, [{'stream': 'stderr', 'seq': 3,
+                                   'line': 'ERROR on stderr\n'}])
+
+    def testTailInvalidFilter(self):
+        self.task = utils.Runner('true')
+        for result in [self.task.tail(stream = 'stdin'),
+                       self.task.tail(pattern = '(')]:
+            self.assertEqual(result.status, utils.P.Result.FAILED)
+
+    @defer.inlineCallbacks
+    def _waitForSupervision(self, key, value):
+        while self.task.getSupervision()[key] != value:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def testSupervisedRestart(self):
+        self.task = utils.Runner('echo run', start_shell=True, supervise=True,
+                                 restart_backoff=0.01, crash_loop_restarts=2,
+                                 crash_loop_window=60)
+        self.task.start()
+        yield self._waitForSupervision('crash_loop', True)
+
+        supervision = self.task.getSupervision()
+        self.assertEqual(supervision['restarts'], 2)
+        self.assertEqual(len(supervision['restart_times']), 2)
+        self.assertIsNone(supervision['next_restart'])
+        self.assertFalse(self.task.isRunning())
+        self.assertEqual(self.task.getOutput(), 'run\n' * 3)
+
+        yield self.task.restart()
+        self.assertFalse(self.task.getSupervision()['crash_loop'])
+        yield self._waitForSupervision('crash_loop', True)
+        self.assertEqual(self.task.getSupervision()['restarts'], 4)
+
+        result = self.task.start()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertFalse(self.task.getSupervision()['crash_loop'])
+        yield self._waitForSupervision('crash_loop', True)
+        self.assertEqual(self.task.getSupervision()['restarts'], 6)
+
+    def testFailedStartKeepsCrashLoop(self):
+        self.task = utils.Runner('/nonexistent/executable', supervise=True)
+        self.task._crash_loop = True
+        result = self.task.start()
+        self.assertEqual(result.status, utils.P.Result.FAILED)
+        self.assertTrue(self.task.getSupervision()['crash_loop'])
+
+    @defer.inlineCallbacks
+    def testStartExitedTask(self):
+        self.task = utils.Runner('true')
+        self.task.start()
+        yield self.task.whenExited()
+
+        result = self.task.start()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        yield self.task.whenExited()
+
+    @defer.inlineCallbacks
+    def testStopCancelsRestart(self):
+        self.task = utils.Runner('true', supervise=True, restart_backoff=10)
+        self.task.start()
+        yield self.task.whenExited()
+        self.assertIsNotNone(self.task.getSupervision()['next_restart'])
+
+        result = yield self.task.stop()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        supervision = self.task.getSupervision()
+        self.assertIsNone(supervision['next_restart'])
+        self.assertEqual(supervision['restarts'], 0)
+
+    @defer.inlineCallbacks
+    def testStopIsNotSupervised(self):
+        self.task = utils.Runner('sleep 10', start_shell=True, supervise=True,
+                                 restart_backoff=0.01)
+        self.task.start()
+        yield self.task.stop()
+        self.assertIsNone(self.task.getSupervision()['next_restart'])
+        self.assertIsNotNone(self.task.getSupervision()['last_exit'])
+
+    @defer.inlineCallbacks
+    def testWaitReady(self):
+        self.task = utils.Runner('sleep 0.2; echo ready; sleep 10',
+                                 start_shell=True, ready_pattern='^ready')
+        result = yield self.task.start(wait_ready=True)
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertGreaterEqual(result.args['ready_time'], 0.15)
+        self.assertEqual(self.task.getReadiness(),
+                         {'ready': True,
+                          'ready_time': result.args['ready_time']})
+
+    @defer.inlineCallbacks
+    def testWaitReadyInThread(self):
+        self.task = utils.Runner('sleep 0.2; echo ready; sleep 10',
+                                 start_shell=True, ready_pattern='^ready')
+        # The thread is not kept waiting for the task to get ready
+        pending = yield threads.deferToThread(self.task.start, True)
+        self.assertIsInstance(pending, utils.P.Pending)
+        self.assertFalse(self.task.isReady())
+
+        result = yield pending.deferred()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertTrue(self.task.isReady())
+
+    @defer.inlineCallbacks
+    def testReadyFile(self):
+        path = os.path.join(tempfile.mkdtemp(), 'ready')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.task = utils.Runner('sleep 0.2; touch %s; sleep 10' % path,
+                                 start_shell=True, ready_file=path)
+        result = self.task.start()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertFalse(self.task.isReady())
+
+        result = yield self.task.whenReady()
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertTrue(self.task.isReady())
+
+    @defer.inlineCallbacks
+    def testNotReady(self):
+        self.task = utils.Runner('echo starting', start_shell=True,
+                                 ready_pattern='^ready')
+        result = yield self.task.start(wait_ready=True)
+        self.assertEqual(result.status, utils.P.Result.FAILED)
+        self.assertIsNone(self.task.getReadiness()['ready_time'])
+
+        self.task = utils.Runner('sleep 10', start_shell=True,
+                                 ready_pattern='^ready', ready_timeout=0.1)
+        result = yield self.task.start(wait_ready=True)
+        self.assertEqual(result.status, utils.P.Result.FAILED)
+        self.assertTrue(self.task.isRunning())
+        self.assertFalse(self.task.isReady())
+
+    def testReadyWithoutProbe(self):
+        self.task = utils.Runner('sleep 10', start_shell=True)
+        self.task.start()
+        self.assertTrue(self.task.isReady())
+        self.assertLess(self.task.getReadiness()['ready_time'], 0.1)
+
+    @defer.inlineCallbacks
+    def testSearch(self):
+        yield self._runTask('echo a; echo ERROR 1; echo b >&2; '
+                            'echo ERROR 2 >&2; echo c', start_shell=True)
+
+        result = self.task.search('ERROR', context=1)
+        self.assertEqual(result.status, utils.P.Result.OK)
+        self.assertFalse(result.args['truncated'])
+        self.assertEqual([(m['stream'], m['line'], m['before'], m['after'])
+                          for m in result.args['matches']],
+                         [('stdout', 'ERROR 1\n', ['a\n'], ['c\n']),
+                          ('stderr', 'ERROR 2\n', ['b\n'], [])])
+
+        first = result.args['matches'][0]['seq']
+        result = self.task.search('ERROR', since=first)
+        self.assertEqual([m['line'] for m in result.args['matches']],
+                         ['ERROR 2\n'])
+
+        result = self.task.search('ERROR', stream='stdout', max_matches=1)
+        self.assertEqual(len(result.args['matches']), 1)
+
+        for result in [self.task.search('('), self.task.search(None),
+                       self.task.search('ERROR', stream='stdin'),
+                       self.task.search('ERROR', logs=True)]:
+            self.assertEqual(result.status, utils.P.Result.FAILED)
+
+    @defer.inlineCallbacks
+    def testSearchLogs(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        with gzip.open(os.path.join(log_dir, 'stdout.1.gz'), 'wt') as f:
+            f.write('ERROR old\nlast old\n')
+        yield self._runTask('echo ERROR new; echo ok; echo ERROR err >&2',
+                            log_dir=log_dir, start_shell=True)
+
+        result = self.task.search('ERROR', stream='stdout', logs=True,
+                                  context=1)
+        self.assertEqual([(m['file'], m['line_no'], m['line'], m['before'])
+                          for m in result.args['matches']],
+                         [('stdout.1.gz', 1, 'ERROR old\n', []),
+                          ('stdout', 1, 'ERROR new\n', ['last old\n'])])
+
+        result = self.task.search('ERROR', logs=True, log_file='stdout',
+                                  since=1)
+        self.assertEqual(result.args['matches'], [])
+        result = self.task.search('ERROR', logs=True, log_file='stdout.1.gz',
+                                  until=1)
+        self.assertEqual([m['line'] for m in result.args['matches']],
+                         ['ERROR old\n'])
+
+        # Each stream has its own limit
+        result = self.task.search('ERROR', logs=True, max_matches=1)
+        self.assertEqual([(m['stream'], m['line'])
+                          for m in result.args['matches']],
+                         [('stderr', 'ERROR err\n'),
+                          ('stdout', 'ERROR old\n')])
+        self.assertTrue(result.args['truncated'])
+
+        for result in [self.task.search('ERROR', logs=True, since=1),
+                       self.task.search('ERROR', logs=True,
+                                        log_file='stdout.3.gz')]:
+            self.assertEqual(result.status, utils.P.Result.FAILED)